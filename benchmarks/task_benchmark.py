@@ -0,0 +1,72 @@
+import gc
+import timeit
+import argparse
+import tracemalloc
+
+from mediaire_toolbox.queue.tasks import Task, CompactTask
+
+"""
+Microbenchmark comparing the memory footprint and (de)serialization cost of
+Task and CompactTask.
+
+    python benchmarks/task_benchmark.py [--count N]
+"""
+
+PAYLOAD = {'t_id': 1, 'user_id': 2, 'product_id': 1, 'tag': 'spm_lesion',
+           'timestamp': 1530368396, 'update_timestamp': 1530368400,
+           'data': {'dicom_info': {'t1': {'path': '/src/shared_data/1/t1'}}},
+           'error': None}
+
+
+def bytes_per_instance(task_class, count):
+    """Memory allocated per task read from a parsed payload, not counting
+    the payload values which are shared by all of them."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    task_list = [task_class().read_dict(PAYLOAD) for _ in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in
+                    after.compare_to(before, 'filename'))
+    # the list holding the tasks
+    allocated -= task_list.__sizeof__()
+    return allocated / count
+
+
+def microseconds_per_call(statement, number):
+    return min(timeit.repeat(statement, number=number, repeat=5)) \
+        / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='compare Task and CompactTask')
+    parser.add_argument('--count', type=int, default=100000,
+                        help='number of tasks / calls per measurement')
+    args = parser.parse_args()
+
+    serialized = Task().read_dict(PAYLOAD).to_bytes()
+    print('{:<12} {:>10} {:>12} {:>12} {:>12} {:>12}'.format(
+        '', 'B/task', 'read_dict', 'to_dict', 'to_bytes', 'read_bytes'))
+    for task_class in (Task, CompactTask):
+        task = task_class().read_dict(PAYLOAD)
+        print('{:<12} {:>10.0f} {:>10.2f}us {:>10.2f}us {:>10.2f}us '
+              '{:>10.2f}us'.format(
+                  task_class.__name__,
+                  bytes_per_instance(task_class, args.count),
+                  microseconds_per_call(
+                      lambda: task_class().read_dict(PAYLOAD), args.count),
+                  microseconds_per_call(task.to_dict, args.count),
+                  microseconds_per_call(task.to_bytes, args.count),
+                  microseconds_per_call(
+                      lambda: task_class().read_bytes(serialized),
+                      args.count)))
+    print('{:<12} {:>10} {:>10.2f}us'.format(
+        'from_dict', '',
+        microseconds_per_call(lambda: CompactTask.from_dict(PAYLOAD),
+                              args.count)))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,8 @@ import os
 import logging
 import time
 
-from mediaire_toolbox.queue.tasks import Task
+from mediaire_toolbox.queue.tasks import BaseTask
+from mediaire_toolbox.resource_usage import ResourceMeter, record_resources
 
 """
 Provide a common interface for all our components to do logging
@@ -55,9 +56,10 @@ def logger_for_transaction(name: str, t_id: int):
 
 def log_task_runtime(f):
     """Function decorator for logging and recording
-    the runtime of a task in a component.
+    the runtime and resource usage of a task in a component.
     NOTE function with side effects; the runtime is logged
-    to the task.data dict
+    to the task.data dict, and the CPU time, peak RSS delta and
+    I/O bytes to task.data['resources'] (see `record_resources`)
     NOTE this decorator should be decorating a plain
     process_task function, that takes an task object as the first
     arguement. The task object should be sent to the result queue after
@@ -70,24 +72,33 @@ def log_task_runtime(f):
     def process_task(task):
         ...
     """
-    def wrapper(task: Task, *args, **kwargs):
-        if not isinstance(task, Task):
+    def wrapper(task: BaseTask, *args, **kwargs):
+        if not isinstance(task, BaseTask):
             raise TypeError(
                 "First arguement of the decorated"
                 "function must be a task object!")
 
         start_time = time.time()
-        result = f(task, *args, **kwargs)
+        # resetting the peak RSS of the process would distort the figures
+        # of concurrent threads, e.g. of the daemon's worker slots
+        with ResourceMeter(reset_peak=False) as meter:
+            result = f(task, *args, **kwargs)
         end_time = time.time()
         runtime = round(end_time - start_time, 4)
+        resources = meter.resources
 
         logger_transaction = logger_for_transaction(
             'runtime_logger', task.t_id)
         logger_transaction.info(
-            "Finished in {} seconds.".format(runtime))
+            "Finished in {} seconds (cpu user {}s, system {}s, peak rss "
+            "+{} bytes, read {} bytes, written {} bytes).".format(
+                runtime, resources.cpu_user, resources.cpu_system,
+                resources.peak_rss_delta, resources.read_bytes,
+                resources.write_bytes))
         if task.data.get('runtime', []):
             task.data['runtime'].append([task.tag, runtime])
         else:
             task.data['runtime'] = [[task.tag, runtime]]
+        record_resources(task, resources)
         return result
     return wrapper
@@ -1,2 +1,3 @@
 from . import redis_wq
 from . import tasks
+from . import task_codecs
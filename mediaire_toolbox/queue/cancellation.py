@@ -0,0 +1,140 @@
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+"""
+Cancellation of transactions signalled through Redis, as a fast
+alternative to the `cancel-<t_id>` marker files in the shared data folder.
+"""
+
+
+class CancellationSignal(object):
+    """Requests and checks the cancellation of transactions.
+
+    A cancellation is stored as a key `<prefix>:<t_id>` (expiring after
+    `ttl_secs`) and published on the channel `<prefix>`. After `listen()`
+    a background thread receives the published cancellations into a local
+    cache, so `is_cancelled()` doesn't need a round trip to Redis and
+    notices a cancellation within milliseconds. Without listening, Redis is
+    queried at most once per `poll_secs` and transaction.
+    """
+
+    CACHE_SIZE = 10000
+
+    def __init__(self, db, prefix='cancellations', ttl_secs=24 * 60 * 60,
+                 poll_secs=1.0):
+        """
+        Parameters
+        ----------
+        db:
+            A redis.StrictRedis instance, e.g. the one of a RedisWQ
+        prefix: str
+            Prefix of the cancellation keys and name of the channel
+        ttl_secs: int
+            Seconds after which a cancellation request is forgotten
+        poll_secs: float
+            Seconds for which the result of a query to Redis is cached
+            when not listening.
+        """
+        self._db = db
+        self.prefix = prefix
+        self.ttl_secs = ttl_secs
+        self.poll_secs = poll_secs
+        # t_id -> (cancelled, time of the check)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def _key(self, t_id):
+        return '{}:{}'.format(self.prefix, t_id)
+
+    def _remember(self, t_id, cancelled):
+        with self._lock:
+            self._cache[t_id] = (cancelled, time.time())
+            self._cache.move_to_end(t_id)
+            while len(self._cache) > self.CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+    def request_cancel(self, t_id: int):
+        """Signals all the daemons that transaction `t_id` is cancelled."""
+        pipe = self._db.pipeline()
+        pipe.setex(self._key(t_id), self.ttl_secs, 1)
+        pipe.publish(self.prefix, str(t_id))
+        pipe.execute()
+        self._remember(int(t_id), True)
+
+    def clear(self, t_id: int):
+        """Withdraws the cancellation of transaction `t_id`, e.g. before
+        reprocessing it."""
+        pipe = self._db.pipeline()
+        pipe.delete(self._key(t_id))
+        pipe.publish(self.prefix, '-{}'.format(t_id))
+        pipe.execute()
+        self._remember(int(t_id), False)
+
+    @property
+    def listening(self) -> bool:
+        return self._listener is not None
+
+    def is_cancelled(self, t_id: int) -> bool:
+        if not t_id:
+            return False
+        t_id = int(t_id)
+        with self._lock:
+            cached = self._cache.get(t_id)
+        if cached is not None:
+            cancelled, checked = cached
+            # while listening, the cache is kept up to date by the listener
+            if (cancelled or self.listening or
+                    time.time() - checked < self.poll_secs):
+                return cancelled
+        cancelled = bool(self._db.exists(self._key(t_id)))
+        self._remember(t_id, cancelled)
+        return cancelled
+
+    def _on_message(self, message):
+        data = message['data']
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        try:
+            # withdrawn cancellations are published as -<t_id>
+            if data.startswith('-'):
+                self._remember(int(data[1:]), False)
+            else:
+                self._remember(int(data), True)
+        except (AttributeError, ValueError):
+            logger.warning('Invalid cancellation message {}'.format(message))
+
+    def _listen_loop(self, pubsub, sleep_time):
+        while self._listener is threading.current_thread():
+            try:
+                # messages are dispatched to _on_message
+                pubsub.get_message(timeout=sleep_time)
+            except Exception:
+                logger.exception('Error receiving cancellations')
+                time.sleep(1)
+        pubsub.close()
+
+    def listen(self, sleep_time=0.1):
+        """Starts receiving cancellations in a background thread."""
+        if self._listener is not None:
+            return
+        pubsub = self._db.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.prefix: self._on_message})
+        with self._lock:
+            # cached negative results may be outdated by now, but any
+            # cancellation from now on will be received
+            self._cache = OrderedDict(
+                (t_id, v) for t_id, v in self._cache.items() if v[0])
+        self._listener = threading.Thread(
+            target=self._listen_loop, args=(pubsub, sleep_time),
+            name='cancellation-listener', daemon=True)
+        self._listener.start()
+
+    def stop(self):
+        """Stops the background thread receiving cancellations."""
+        self._listener = None
@@ -0,0 +1,128 @@
+import logging
+import threading
+import traceback
+
+from collections import deque
+
+from mediaire_toolbox.queue import tasks, task_codecs
+from mediaire_toolbox.queue.daemon import QueueDaemon
+
+logger = logging.getLogger(__name__)
+
+"""
+Runs several co-located daemons as one, handing the Task objects from one
+stage to the next directly instead of through Redis.
+"""
+
+
+class StageLink(object):
+    """Stands in for the result queue of a stage run by a ChainDaemon and
+    collects the tasks emitted by the calling thread."""
+
+    def __init__(self, result_queue):
+        # used by QueueDaemon.task_to_bytes() for looking up the codec
+        self._main_q_key = result_queue._main_q_key if result_queue else ''
+        self._local = threading.local()
+
+    def _emitted(self):
+        emitted = getattr(self._local, 'emitted', None)
+        if emitted is None:
+            emitted = self._local.emitted = []
+        return emitted
+
+    def put_task(self, task):
+        self._emitted().append(task)
+
+    def put(self, item):
+        """For stages which put serialized tasks into their result queue
+        directly. They still skip Redis, but pay for the serialization."""
+        _, task_class = task_codecs.get_queue_codec(self._main_q_key)
+        self.put_task((task_class or tasks.Task)().read_bytes(item))
+
+    def pop_emitted(self):
+        emitted = self._emitted()
+        self._local.emitted = []
+        return emitted
+
+
+class ChainDaemon(QueueDaemon):
+    """
+    Runs a chain of daemons (stages) in one process. The first stage
+    processes the tasks of the input queue. The tasks it emits (see
+    `QueueDaemon.emit()`) are handed over directly to the stage registered
+    for their tag, and so on. Tasks with a tag which is not handled by any
+    stage, as well as failed tasks, leave the chain through the result
+    queue of the ChainDaemon.
+
+    Per-stage durations and outcomes are recorded in the metrics of the
+    ChainDaemon, labelled with the daemon name of the stage. Only the
+    config of the ChainDaemon applies (pool mode, timeouts...), the stages
+    are only used for their `setup()` and `process_task()`.
+    """
+
+    def __init__(self,
+                 input_queue,
+                 result_queue,
+                 lease_secs: int,
+                 daemon_name: str,
+                 config: dict,
+                 stages: list):
+        """
+        Parameters
+        ----------
+        stages: list
+            List of (tag, daemon) tuples, the daemon processes the tasks
+            with the given tag. The first stage additionally processes all
+            the tasks of the input queue.
+        """
+        super().__init__(input_queue, result_queue, lease_secs,
+                         daemon_name, config)
+        if not stages:
+            raise ValueError('A chain needs at least one stage')
+        self.stages = [daemon for _, daemon in stages]
+        self.routes = {tag: daemon for tag, daemon in stages}
+        for stage in self.stages:
+            stage.result_queue = StageLink(result_queue)
+            stage.cancellation = self.cancellation
+
+    def setup(self):
+        for stage in self.stages:
+            stage.setup()
+
+    def process_task(self, task):
+        pending = deque([(self.stages[0], task)])
+        while pending:
+            stage, task = pending.popleft()
+            for child in self._run_stage(stage, task):
+                next_stage = self.routes.get(child.tag)
+                if next_stage is None or child.error:
+                    self.emit(child)
+                else:
+                    pending.append((next_stage, child))
+
+    def _run_stage(self, stage, task):
+        """Runs one stage and returns the tasks it emitted."""
+        stage._local.slot = self.slot
+        if task.t_id:
+            stage.set_processing_t_id(task.t_id)
+        try:
+            with self.process_seconds.time(daemon=stage.daemon_name,
+                                           tag=task.tag):
+                stage.process_task(task)
+        except Exception as e:
+            stage.result_queue.pop_emitted()
+            self.tasks_counter.inc(daemon=stage.daemon_name, tag=task.tag,
+                                   outcome='failure')
+            if not task.t_id or not self.result_queue:
+                # let the chain move the input item to the error queue
+                raise
+            logger.exception("transaction={} Error processing task in {}"
+                             .format(task.t_id, stage.daemon_name))
+            task.error = "{} --> in '{}': {}".format(
+                e, __file__, traceback.format_exc())
+            return [task]
+        finally:
+            stage.set_processing_t_id(None)
+        self.tasks_counter.inc(daemon=stage.daemon_name, tag=task.tag,
+                               outcome='success')
+        return stage.result_queue.pop_emitted()
@@ -0,0 +1,129 @@
+from copy import deepcopy
+from collections.abc import Mapping, MutableMapping
+
+"""
+Copy-on-write mappings for sharing the `data` of tasks between a task and
+its children without copying it.
+"""
+
+_IMMUTABLE = (str, int, float, bool, bytes, tuple, type(None))
+
+
+class CowDict(MutableMapping):
+    """A mapping layered over a shared `base` mapping which is never
+    modified: changes are recorded in the layer itself.
+
+    Nested dictionaries read from the base are returned as CowDicts layered
+    over them, and other mutable values (lists...) as copies, so a task
+    only pays for the parts of the payload it reads or changes. Views are
+    flattened when they are layered more than `MAX_DEPTH` times, which
+    bounds the cost of a lookup.
+
+    CowDicts aren't dicts, use `to_dict()` (or `materialize()`) to get a
+    plain dictionary, e.g. for serialization.
+    """
+
+    MAX_DEPTH = 8
+
+    __slots__ = ('_base', '_own', '_deleted', '_depth')
+
+    def __init__(self, base: Mapping):
+        depth = base._depth + 1 if isinstance(base, CowDict) else 0
+        if depth >= self.MAX_DEPTH:
+            base, depth = base.to_dict(), 0
+        self._base = base
+        # the keys set or read (as a copy) through this layer
+        self._own = {}
+        self._deleted = set()
+        self._depth = depth
+
+    def _peek(self, key):
+        """Returns the value of `key` without copying it."""
+        if key in self._own:
+            return self._own[key]
+        if key in self._deleted:
+            raise KeyError(key)
+        if isinstance(self._base, CowDict):
+            return self._base._peek(key)
+        return self._base[key]
+
+    def __getitem__(self, key):
+        if key in self._own:
+            return self._own[key]
+        value = self._peek(key)
+        if isinstance(value, _IMMUTABLE):
+            return value
+        if isinstance(value, (dict, CowDict)):
+            value = CowDict(value)
+        else:
+            value = deepcopy(value)
+        self._own[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._own[key] = value
+        self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._own.pop(key, None)
+        if key in self._base:
+            self._deleted.add(key)
+
+    def __contains__(self, key):
+        if key in self._own:
+            return True
+        return key not in self._deleted and key in self._base
+
+    def __iter__(self):
+        for key in self._base:
+            if key not in self._deleted:
+                yield key
+        for key in self._own:
+            if key not in self._base:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def to_dict(self) -> dict:
+        """Returns the content as plain dictionary, sharing the unchanged
+        values with the base."""
+        d = {}
+        for key in self:
+            if key in self._own:
+                d[key] = materialize(self._own[key])
+            else:
+                value = self._peek(key)
+                d[key] = (value.to_dict() if isinstance(value, CowDict)
+                          else value)
+        return d
+
+    def copy(self):
+        return CowDict(self.to_dict())
+
+    def __deepcopy__(self, memo):
+        return deepcopy(self.to_dict(), memo)
+
+    def __repr__(self):
+        return 'CowDict({!r})'.format(self.to_dict())
+
+
+def materialize(value):
+    """Replaces the CowDicts in `value` by plain dictionaries."""
+    if isinstance(value, CowDict):
+        return value.to_dict()
+    if isinstance(value, dict):
+        return {k: materialize(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [materialize(v) for v in value]
+    return value
+
+
+def fork(data):
+    """Returns two independent copy-on-write views of `data` (e.g. for a
+    task and its child). Other values than mappings are copied."""
+    if isinstance(data, (dict, CowDict)):
+        return CowDict(data), CowDict(data)
+    return data, deepcopy(data)
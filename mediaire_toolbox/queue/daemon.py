@@ -1,12 +1,29 @@
+import gc
 import os
+import time
+import select
 import signal
+import struct
+import marshal
 import logging
+import tempfile
+import threading
 import traceback
 
+from copy import deepcopy
+from collections import deque
+
 from abc import ABC, abstractmethod
 
 from mediaire_toolbox.queue.redis_wq import RedisWQ
-from mediaire_toolbox.queue import tasks
+from mediaire_toolbox.queue import tasks, task_codecs, metrics, tracing
+from mediaire_toolbox.queue.profiling import TaskProfiler
+from mediaire_toolbox.queue.watchdog import Watchdog, WatchedTasks
+from mediaire_toolbox.queue.cancellation import CancellationSignal
+from mediaire_toolbox.queue.result_buffer import ResultBuffer
+from mediaire_toolbox.shared_data_cache import SharedDataCache
+from mediaire_toolbox.resource_usage import (
+    current_rss_bytes, ResourceMeter, record_resources)
 
 logger = logging.getLogger(__name__)
 
@@ -22,7 +39,177 @@ our queues.
 ASSUMED_SHARED_DATA = '/src/shared_data'
 
 
+class _NoMeter(object):
+    """Stands in for a ResourceMeter when resource accounting is off."""
+
+    resources = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NO_METER = _NoMeter()
+
+
+class _WorkerReports(object):
+    """Parent side of the pipe through which a worker process reports the
+    items it is processing and their deadline."""
+
+    HEADER = struct.Struct('>I')
+
+    def __init__(self, fd, slot):
+        self.fd = fd
+        self.slot = slot
+        self._buffer = b''
+        # (deadline, timeout, items) of the watched tasks, or None
+        self.watch = None
+        self.eof = False
+        self.killed = False
+
+    @classmethod
+    def encode(cls, report) -> bytes:
+        payload = marshal.dumps(report)
+        return cls.HEADER.pack(len(payload)) + payload
+
+    def read(self):
+        """Reads the reports available without blocking."""
+        while not self.eof:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            if not data:
+                self.eof = True
+                return
+            self._buffer += data
+            self._parse()
+
+    def _parse(self):
+        size = self.HEADER.size
+        while len(self._buffer) >= size:
+            end = size + self.HEADER.unpack_from(self._buffer)[0]
+            if len(self._buffer) < end:
+                return
+            report = marshal.loads(self._buffer[size:end])  # nosec
+            self._buffer = self._buffer[end:]
+            if report[0] == 'watch':
+                self.watch = report[1:]
+            else:
+                self.watch = None
+
+
 class QueueDaemon(ABC):
+    """
+    Base class for daemons consuming Tasks from a RedisWQ.
+
+    By default the daemon leases and processes one task at a time. Setting
+    `pool_size` > 1 in the config dictionary enables the pool mode, which
+    processes up to `pool_size` tasks concurrently inside one daemon:
+
+    * `pool_mode: 'thread'` (default) runs one worker thread per slot, which
+      is suited for I/O bound work.
+    * `pool_mode: 'process'` pre-forks one worker process per slot, which is
+      suited for CPU bound work. Worker processes which die unexpectedly
+      are replaced. This mode is also available with a `pool_size` of 1.
+
+    Expensive state shared by all tasks (models, atlases...) should be
+    loaded in `setup()`, which runs once before the workers start. In
+    process pool mode the worker processes are forked afterwards and share
+    this state copy-on-write. To keep memory in check, a worker process is
+    replaced by a fresh fork after `max_tasks_per_child` tasks or once its
+    RSS exceeds `max_rss_mb` megabytes.
+
+    In pool mode the workers lease with a timeout (`lease_timeout`, 5
+    seconds by default) so that they notice when the daemon is stopped.
+    On SIGINT / SIGTERM no new tasks are leased, all the in-flight tasks
+    are cancelled and the daemon waits for the workers to finish.
+
+    Setting `prefetch` > 0 in the config dictionary leases up to `prefetch`
+    items in a background thread while tasks are being processed, so that
+    the lease latency (including the rate limiting round trips) is not paid
+    before starting the next task. The leases of prefetched items are
+    extended until they are used, and prefetched items are returned to the
+    input queue when the daemon stops.
+
+    Items are read into the Task class and result tasks are written with the
+    codec registered for the respective queue with
+    `task_codecs.register_queue()`.
+
+    Setting `batch_size` > 1 in the config dictionary enables the batch
+    mode: the daemon leases up to `batch_size` items, waiting at most
+    `batch_max_wait` seconds (1 by default) for the batch to fill up, and
+    hands them over to `process_tasks()` all at once. Daemons whose
+    business logic has a high setup cost per call should override
+    `process_tasks()`.
+
+    Timings of every step (queue wait, lease, deserialization, processing,
+    complete / error) and success / failure counters by tag are recorded in
+    `self.metrics`. Setting `metrics_port` in the config dictionary serves
+    them in the Prometheus text exposition format on
+    http://`metrics_addr`:`metrics_port`/metrics (`metrics_addr` is
+    127.0.0.1 by default). In process pool mode every worker process serves
+    its own metrics on `metrics_port` + slot.
+
+    A watchdog enforces processing timeouts, configured in seconds per tag
+    with `task_timeouts` (a dictionary) and `task_timeout` as default. When
+    a task exceeds its timeout it is errored, or returned to the input
+    queue with `timeout_policy: 'requeue'`. In process pool mode the worker
+    processes report their deadlines to the parent process, which kills a
+    worker that is still busy at the deadline (even if it is stuck in C
+    code holding the GIL), handles the task and replaces the worker. Other
+    workers only get the cancellation flagged (see `task_timed_out()`) as
+    Python threads can't be interrupted, and the outcome of the task is
+    ignored, including the tasks it emits past the timeout.
+
+    Transactions are cancelled through Redis with `request_cancel()`, and
+    long running business logic can cheaply poll `is_cancelled()`. With
+    `listen_cancellations: True` cancellations are pushed to the daemon
+    (see `CancellationSignal`), which then also skips leased tasks of
+    cancelled transactions.
+
+    Setting `result_buffer_size` > 0 in the config dictionary coalesces the
+    completion of tasks and the results put with `emit()` into pipelined
+    flushes, sent once `result_buffer_size` operations are buffered or the
+    oldest one is `result_buffer_delay` seconds old (0.1 by default), and
+    when the daemon stops. This cuts the per-task overhead of high-rate,
+    short tasks.
+
+    Setting `resource_accounting: True` in the config dictionary measures
+    the CPU user / system time, the rise of the peak RSS and the bytes read
+    and written while processing each task (see `ResourceMeter`). The
+    figures are appended to `task.data['resources']` of the task and of the
+    tasks it emits, which are held back until the task is processed, and
+    aggregated by tag in the metrics. In batch mode they are only recorded
+    in the metrics, for the whole batch under the tag `batch`.
+
+    Setting `shared_data_cache_dir` in the config dictionary provides a
+    node-local cache of the input files on the shared data storage as
+    `self.shared_data_cache` (see `SharedDataCache`), capped to
+    `shared_data_cache_mb` megabytes (10240 by default). Its hit / miss
+    counters are part of the metrics.
+
+    Setting `trace_file` in the config dictionary records the spans of
+    every task (`queue_wait` since it was emitted, `process` and `publish`
+    of its follow-up tasks) in the trace carried by `task.trace`, and
+    appends them to that file in the OTLP/JSON format (see `tracing`). The
+    tasks emitted while processing a task continue its trace.
+
+    Profiling of the business logic is switched on with `profile: True` in
+    the config dictionary or toggled at runtime by sending SIGUSR1 to the
+    daemon. Every `profile_every_n`th task (1 by default) and every task
+    running for at least `profile_min_seconds` is profiled, and the
+    profiles are aggregated per tag in pstats files in `profile_dir`.
+    """
+
+    POOL_LEASE_TIMEOUT = 5
+    # exit code of worker processes asking to be replaced
+    RECYCLE_EXIT_CODE = 75
+    # maximum time between two checks of the worker processes
+    POOL_POLL_INTERVAL = 0.5
+    BATCH_POLL_INTERVAL = 0.05
 
     def __init__(self,
                  input_queue: RedisWQ,
@@ -44,7 +231,17 @@ class QueueDaemon(ABC):
             A unique identifier for this daemon, will be used for logging
         config:
             A configuration dictionary with all the necessary extra parameters
-            for this daemon.
+            for this daemon. Generic keys understood by the base class:
+            `lease_limit`, `limit_timeunit`, `lease_timeout`, `pool_size`,
+            `pool_mode`, `prefetch`, `batch_size`, `batch_max_wait`,
+            `metrics_port`, `metrics_addr`, `profile`, `profile_dir`,
+            `profile_every_n`, `profile_min_seconds`, `max_tasks_per_child`,
+            `max_rss_mb`, `task_timeout`, `task_timeouts`,
+            `timeout_policy`, `cancellation_prefix`,
+            `listen_cancellations`, `result_buffer_size`,
+            `result_buffer_delay`, `resource_accounting`,
+            `shared_data_cache_dir`, `shared_data_cache_mb` and
+            `trace_file`.
         """
         self.input_queue = input_queue
         self.result_queue = result_queue
@@ -52,10 +249,70 @@ class QueueDaemon(ABC):
         self.daemon_name = daemon_name
         self.config = config
         self.stopped = False
-        self.processing_t_id = None
+        self.pool_size = config.get('pool_size', 1)
+        self.pool_mode = config.get('pool_mode', 'thread')
+        if self.pool_mode not in ('thread', 'process'):
+            raise ValueError('Invalid pool_mode {}'.format(self.pool_mode))
+        # t_id being processed by each worker slot
+        self.processing_t_ids = {}
+        # t_ids of the batch being processed by each worker slot
+        self.processing_batches = {}
+        self._local = threading.local()
+        self._children = {}
+        # pid -> _WorkerReports of each worker process
+        self._worker_reports = {}
+        self._report_fd = None
+        self.prefetch = config.get('prefetch', 0)
+        self._prefetched = deque()
+        self._prefetch_cond = threading.Condition()
+        self._prefetcher = None
+        self.batch_size = config.get('batch_size', 1)
+        self.batch_max_wait = config.get('batch_max_wait', 1)
+        self.max_tasks_per_child = config.get('max_tasks_per_child', 0)
+        self.max_rss_mb = config.get('max_rss_mb', 0)
+        self.tasks_processed = 0
+        self.task_timeout = config.get('task_timeout')
+        self.task_timeouts = config.get('task_timeouts', {})
+        self.timeout_policy = config.get('timeout_policy', 'error')
+        if self.timeout_policy not in ('error', 'requeue'):
+            raise ValueError('Invalid timeout_policy {}'.format(
+                self.timeout_policy))
+        self.watchdog = Watchdog(self._on_task_timeout,
+                                 '{}-watchdog'.format(daemon_name))
+        self._in_worker_process = False
+        self.cancellation = CancellationSignal(
+            input_queue._db if input_queue is not None else None,
+            prefix=config.get('cancellation_prefix', 'cancellations'))
+        self.listen_cancellations = config.get('listen_cancellations', False)
+        self.result_buffer = None
+        if config.get('result_buffer_size', 0) > 0:
+            self.result_buffer = ResultBuffer(
+                config['result_buffer_size'],
+                config.get('result_buffer_delay', 0.1))
+        self.resource_accounting = config.get('resource_accounting', False)
+        self.tracer = None
+        if config.get('trace_file'):
+            self.tracer = tracing.TraceExporter(config['trace_file'],
+                                                daemon_name)
+        self._setup_metrics()
+        self._metrics_server = None
+        self.shared_data_cache = None
+        if config.get('shared_data_cache_dir'):
+            self.shared_data_cache = SharedDataCache(
+                config['shared_data_cache_dir'],
+                config.get('shared_data_cache_mb', 10240) * 1024 * 1024,
+                registry=self.metrics)
+        self.profiler = TaskProfiler(
+            config.get('profile_dir',
+                       os.path.join(tempfile.gettempdir(), 'profiles')),
+            daemon_name,
+            every_n=config.get('profile_every_n', 1),
+            min_seconds=config.get('profile_min_seconds'),
+            enabled=config.get('profile', False))
 
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
+        signal.signal(signal.SIGUSR1, self.toggle_profiling)
 
     @abstractmethod
     def process_task(self, task):
@@ -65,22 +322,271 @@ class QueueDaemon(ABC):
         """
         pass
 
+    def setup(self):
+        """
+        Hook for loading expensive state shared by all tasks, called once
+        when the daemon starts running and, in process pool mode, before
+        forking the worker processes.
+        """
+        pass
+
+    def process_tasks(self, tasks: list) -> list:
+        """
+        Batch business logic, receiving a list of already deserialized
+        tasks when the daemon runs in batch mode. By default every task is
+        handed over to `process_task()`.
+
+        Returns
+        -------
+        list
+            One result per task, in the same order. An Exception instance
+            marks the task as failed, any other value as successful.
+        """
+        results = []
+        for task in tasks:
+            try:
+                self.process_task(task)
+                results.append(None)
+            except Exception as e:
+                logger.exception(
+                    "transaction={} Error processing task in {}"
+                    .format(task.t_id if task.t_id else -1,
+                            self.daemon_name))
+                results.append(e)
+        return results
+
+    def _setup_metrics(self):
+        self.metrics = metrics.MetricsRegistry()
+        self.queue_wait_seconds = self.metrics.histogram(
+            'queue_daemon_queue_wait_seconds',
+            'Time between task creation / update and its deserialization',
+            ('daemon', 'tag'))
+        self.lease_seconds = self.metrics.histogram(
+            'queue_daemon_lease_seconds',
+            'Duration of successful leases, including rate limiting and '
+            'waiting for an item',
+            ('daemon',))
+        self.deserialize_seconds = self.metrics.histogram(
+            'queue_daemon_deserialize_seconds',
+            'Time spent deserializing leased items',
+            ('daemon',))
+        self.process_seconds = self.metrics.histogram(
+            'queue_daemon_process_seconds',
+            'Duration of process_task() by tag',
+            ('daemon', 'tag'))
+        self.batch_seconds = self.metrics.histogram(
+            'queue_daemon_batch_seconds',
+            'Duration of process_tasks() in batch mode',
+            ('daemon',))
+        self.ack_seconds = self.metrics.histogram(
+            'queue_daemon_ack_seconds',
+            'Time spent marking a task as completed or failed',
+            ('daemon', 'op'))
+        self.tasks_counter = self.metrics.counter(
+            'queue_daemon_tasks',
+            'Processed tasks by tag and outcome',
+            ('daemon', 'tag', 'outcome'))
+        self.cpu_seconds = self.metrics.counter(
+            'queue_daemon_cpu_seconds',
+            'CPU time spent processing tasks by tag and mode (user / '
+            'system), with resource_accounting',
+            ('daemon', 'tag', 'mode'))
+        self.io_bytes = self.metrics.counter(
+            'queue_daemon_io_bytes',
+            'Bytes read / written while processing tasks by tag, with '
+            'resource_accounting',
+            ('daemon', 'tag', 'direction'))
+        self.peak_rss_delta_bytes = self.metrics.histogram(
+            'queue_daemon_peak_rss_delta_bytes',
+            'Rise of the peak RSS while processing a task, with '
+            'resource_accounting',
+            ('daemon', 'tag'),
+            buckets=tuple(2 ** i * 1024 * 1024 for i in range(0, 15, 2)))
+
+    def _start_metrics_server(self, port_offset=0):
+        port = self.config.get('metrics_port')
+        if port is None or self._metrics_server is not None:
+            return
+        self._metrics_server = metrics.start_http_server(
+            self.metrics, port + port_offset,
+            self.config.get('metrics_addr', '127.0.0.1'))
+
+    def _stop_metrics_server(self):
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+            self._metrics_server.server_close()
+            self._metrics_server = None
+
+    @property
+    def pooled(self) -> bool:
+        """Whether tasks are processed by a pool of worker slots."""
+        return self.pool_size > 1 or self.pool_mode == 'process'
+
+    @property
+    def slot(self) -> int:
+        """The worker slot of the calling thread, 0 if not in pool mode."""
+        return getattr(self._local, 'slot', 0)
+
+    @property
+    def processing_t_id(self):
+        """The t_id being processed by the worker slot of the caller."""
+        return self.processing_t_ids.get(self.slot)
+
     def set_processing_t_id(self, t_id: int):
-        self.processing_t_id = t_id
+        if t_id is None:
+            self.processing_t_ids.pop(self.slot, None)
+        else:
+            self.processing_t_ids[self.slot] = t_id
 
-    def run_once(self):
-        logger.info('Waiting for items from queue {}'.format(
-            self.input_queue._main_q_key))
+    def _lease_timeout(self):
+        return self.config.get(
+            'lease_timeout',
+            self.POOL_LEASE_TIMEOUT
+            if self.pooled or self.prefetch > 0 else None)
 
+    def _lease(self, timeout, block=True):
         limit = self.config.get('lease_limit', -1)
         limit_timeunit = self.config.get('limit_timeunit', 'hour')
+        start = time.time()
         item = self.input_queue.lease(
-            lease_secs=self.lease_secs, block=True,
+            lease_secs=self.lease_secs, block=block, timeout=timeout,
             limit=limit, timeunit=limit_timeunit)
+        if item:
+            self.lease_seconds.observe(time.time() - start,
+                                       daemon=self.daemon_name)
+        return item
+
+    def _prefetch_loop(self):
+        """Keeps up to `prefetch` leased items in the prefetch buffer and
+        extends their leases until they are taken by a worker."""
+        extend_every = max(self.lease_secs / 2.0, 1)
+        last_extension = time.time()
+        while not self.stopped:
+            with self._prefetch_cond:
+                full = len(self._prefetched) >= self.prefetch
+                if full:
+                    self._prefetch_cond.wait(timeout=1.0)
+            if not full:
+                item = self._lease(self._lease_timeout())
+                if item:
+                    with self._prefetch_cond:
+                        self._prefetched.append(item)
+                        self._prefetch_cond.notify()
+            if time.time() - last_extension >= extend_every:
+                with self._prefetch_cond:
+                    buffered = list(self._prefetched)
+                for item in buffered:
+                    self.input_queue.extend_lease(item, self.lease_secs)
+                last_extension = time.time()
+
+    def _start_prefetching(self):
+        with self._prefetch_cond:
+            if self._prefetcher is None:
+                self._prefetcher = threading.Thread(
+                    target=self._prefetch_loop,
+                    name='{}-prefetch'.format(self.daemon_name),
+                    daemon=True)
+                self._prefetcher.start()
+
+    def _stop_prefetching(self):
+        """Waits for the prefetcher and returns the prefetched items to the
+        input queue."""
+        if self._prefetcher is None:
+            return
+        self._prefetcher.join()
+        self._prefetcher = None
+        self._release_prefetched()
+
+    def _release_prefetched(self):
+        with self._prefetch_cond:
+            items = list(self._prefetched)
+            self._prefetched.clear()
+        # return them in reverse order, so that they keep their position
+        for item in reversed(items):
+            self.input_queue.release(item)
+        if items:
+            logger.info('Returned {} prefetched items to queue {}'.format(
+                len(items), self.input_queue._main_q_key))
+
+    def _next_item(self):
+        """Returns the next leased item, or None if there was none within
+        the lease timeout or the daemon was stopped."""
+        timeout = self._lease_timeout()
+        if self.prefetch <= 0:
+            return self._lease(timeout)
+        self._start_prefetching()
+        deadline = None if timeout is None else time.time() + timeout
+        with self._prefetch_cond:
+            while not self._prefetched:
+                if self.stopped or (deadline and time.time() >= deadline):
+                    return None
+                self._prefetch_cond.wait(timeout=1.0)
+            item = self._prefetched.popleft()
+            self._prefetch_cond.notify()
+            return item
+
+    def _poll_item(self):
+        """Returns an already available item without blocking, or None."""
+        if self.prefetch <= 0:
+            return self._lease(None, block=False)
+        with self._prefetch_cond:
+            if not self._prefetched:
+                return None
+            item = self._prefetched.popleft()
+            self._prefetch_cond.notify()
+            return item
+
+    def _next_items(self):
+        """Returns up to `batch_size` leased items, waiting at most
+        `batch_max_wait` seconds for more items after the first one."""
+        item = self._next_item()
+        if not item:
+            return []
+        items = [item]
+        deadline = time.time() + self.batch_max_wait
+        while len(items) < self.batch_size and not self.stopped:
+            item = self._poll_item()
+            if item:
+                items.append(item)
+            elif time.time() >= deadline:
+                break
+            else:
+                time.sleep(self.BATCH_POLL_INTERVAL)
+        return items
+
+    def run_once(self):
+        logger.info('Waiting for items from queue {}'.format(
+            self.input_queue._main_q_key))
+
+        if self.batch_size > 1:
+            items = self._next_items()
+            if items:
+                self._process_items(items)
+            return
+
+        item = self._next_item()
+        if not item:
+            # lease timed out
+            return
+        self._process_item(item)
+
+    def _read_task(self, item):
+        """Deserializes a leased item, moving it to the error queue if that
+        fails."""
         try:
-            # TODO Make this class a parameter for better generalization
-            # how to do reflection in python?
-            task = tasks.Task().read_bytes(item)
+            start = time.time()
+            _, task_class = task_codecs.get_queue_codec(
+                self.input_queue._main_q_key)
+            task = (task_class or tasks.Task)().read_bytes(item)
+            now = time.time()
+            self.deserialize_seconds.observe(now - start,
+                                             daemon=self.daemon_name)
+            created = task.update_timestamp or task.timestamp
+            if created:
+                self.queue_wait_seconds.observe(
+                    max(now - created, 0), daemon=self.daemon_name,
+                    tag=task.tag)
+            return task
         except Exception as e:
             logger.exception(
                 "Operating error or error deserializing task object")
@@ -89,53 +595,580 @@ class QueueDaemon(ABC):
             self.input_queue.error(item,
                                    msg="{} --> in '{}': {}"
                                        "".format(e, __file__, tb))
+            return None
+
+    def _skip_cancelled(self, item, task):
+        """Completes the item without processing it if its transaction was
+        cancelled. Only done while listening for cancellations, so that
+        this doesn't cost a round trip to Redis."""
+        if not self.cancellation.listening or not self.is_cancelled(
+                task.t_id):
+            return False
+        logger.info('transaction={} Skipping task {} of cancelled '
+                    'transaction'.format(task.t_id, task.tag))
+        self.input_queue.complete(item)
+        self.tasks_counter.inc(daemon=self.daemon_name, tag=task.tag,
+                               outcome='cancelled')
+        return True
+
+    def _process_item(self, item):
+        picked_up = time.time()
+        task = self._read_task(item)
+        if task is None or self._skip_cancelled(item, task):
             return
 
+        watched = self._watch([(item, task)])
+        meter = self._resource_meter()
+        if meter is not _NO_METER:
+            # published once the resources are recorded in them
+            self._local.pending = []
+        span = self._start_span(task, picked_up)
         try:
             if task.t_id:
                 self.set_processing_t_id(task.t_id)
-            self.process_task(task)
-            self.input_queue.complete(item)
+            with self.process_seconds.time(daemon=self.daemon_name,
+                                           tag=task.tag), \
+                    self.profiler.profile(task.tag), meter:
+                self.process_task(task)
+            self._account_resources(meter, task.tag, task)
+            self._finish_span(span)
+            if self._unwatch(watched):
+                self._publish_pending()
+                self._task_succeeded(item, task)
         except Exception as e:
-            t_id = task.t_id if task.t_id else -1
-            logger.exception(
-                "transaction={} Error processing task in {}"
-                .format(t_id, self.daemon_name))
-            tb = traceback.format_exc()
-            msg = "{} --> in '{}': {}".format(e, __file__, tb)
-            if task.t_id and self.result_queue:
-                # send the task back to the task manager with an error
-                # so the task manager can decide what to do with it
-                # for example executing a subflow or simply marking the
-                # transaction as failed in db
-                task.error = msg
-                self.result_queue.put(task.to_bytes())
-            else:
-                # if the task doesn't yet have a transactionid, default
-                # to error queue
-                self.input_queue.error(item, msg=msg)
+            self._account_resources(meter, task.tag, task)
+            self._finish_span(span, e)
+            if self._unwatch(watched):
+                self._publish_pending()
+                t_id = task.t_id if task.t_id else -1
+                logger.exception(
+                    "transaction={} Error processing task in {}"
+                    .format(t_id, self.daemon_name))
+                self._task_failed(item, task, e, traceback.format_exc())
         finally:
+            self._local.pending = None
             self.set_processing_t_id(None)
+            self._export_spans()
+
+    def _process_items(self, items):
+        picked_up = time.time()
+        leased = []
+        for item in items:
+            task = self._read_task(item)
+            if task is not None and not self._skip_cancelled(item, task):
+                leased.append((item, task))
+        if not leased:
+            return
+
+        batch = [task for _, task in leased]
+        self.processing_batches[self.slot] = [
+            task.t_id for task in batch if task.t_id]
+        watched = self._watch(leased)
+        meter = self._resource_meter()
+        spans = [self._start_span(task, picked_up) for task in batch]
+        try:
+            try:
+                with self.batch_seconds.time(daemon=self.daemon_name), \
+                        self.profiler.profile('batch'), meter:
+                    results = self.process_tasks(batch)
+                if len(results) != len(batch):
+                    raise ValueError(
+                        'process_tasks returned {} results for {} tasks'
+                        .format(len(results), len(batch)))
+            except Exception as e:
+                logger.exception("Error processing batch of {} tasks in {}"
+                                 .format(len(batch), self.daemon_name))
+                results = [e] * len(batch)
+            self._account_resources(meter, 'batch')
+            for span, result in zip(spans, results):
+                self._finish_span(
+                    span, result if isinstance(result, Exception) else None)
+
+            if not self._unwatch(watched):
+                return
+            for (item, task), result in zip(leased, results):
+                if isinstance(result, Exception):
+                    tb = ''.join(traceback.format_exception(
+                        type(result), result, result.__traceback__))
+                    self._task_failed(item, task, result, tb)
+                else:
+                    self._task_succeeded(item, task)
+        finally:
+            self.processing_batches.pop(self.slot, None)
+            self._export_spans()
+
+    def _start_span(self, task, picked_up):
+        """Records how long the task waited in the queue and starts the
+        span of its processing, which becomes the parent of the tasks
+        emitted meanwhile."""
+        if self.tracer is None:
+            return None
+        context = task.trace or tracing.new_context()
+        trace_id, parent_span_id = context['trace_id'], context['span_id']
+        attributes = {'daemon': self.daemon_name, 'tag': task.tag,
+                      't_id': task.t_id or -1}
+        spans = getattr(self._local, 'spans', None)
+        if spans is None:
+            spans = self._local.spans = []
+        enqueued = (context.get('emitted') or task.update_timestamp or
+                    task.timestamp)
+        if enqueued:
+            spans.append(tracing.Span(
+                'queue_wait', trace_id, parent_span_id, start=enqueued,
+                attributes=attributes).finish(end=picked_up))
+        span = tracing.Span('process', trace_id, parent_span_id,
+                            attributes=attributes)
+        spans.append(span)
+        task.trace = tracing.new_context(trace_id, span.span_id)
+        return span
+
+    def _finish_span(self, span, error=None):
+        if span is not None and span.end is None:
+            span.finish(error=error)
+
+    def _export_spans(self):
+        spans = getattr(self._local, 'spans', None)
+        self._local.spans = None
+        if spans:
+            self.tracer.export(spans)
+
+    def _resource_meter(self):
+        if not self.resource_accounting:
+            return _NO_METER
+        # the peak RSS is per process, resetting it would distort the
+        # figures of concurrent threads
+        return ResourceMeter(reset_peak=not (self.pooled and
+                                             self.pool_mode == 'thread'))
+
+    def _account_resources(self, meter, tag, task=None):
+        resources, meter.resources = meter.resources, None
+        if resources is None:
+            return
+        self.cpu_seconds.inc(resources.cpu_user, daemon=self.daemon_name,
+                             tag=tag, mode='user')
+        self.cpu_seconds.inc(resources.cpu_system, daemon=self.daemon_name,
+                             tag=tag, mode='system')
+        self.io_bytes.inc(resources.read_bytes, daemon=self.daemon_name,
+                          tag=tag, direction='read')
+        self.io_bytes.inc(resources.write_bytes, daemon=self.daemon_name,
+                          tag=tag, direction='write')
+        self.peak_rss_delta_bytes.observe(
+            resources.peak_rss_delta, daemon=self.daemon_name, tag=tag)
+        if task is None:
+            return
+        record_resources(task, resources)
+        for emitted in getattr(self._local, 'pending', None) or []:
+            if emitted is not task:
+                record_resources(emitted, resources, tag)
+
+    def _timeout_for(self, tag):
+        return self.task_timeouts.get(tag, self.task_timeout)
+
+    def _watch(self, leased):
+        """Starts enforcing the timeout of the given (item, task) tuples,
+        for a batch the largest timeout applies."""
+        timeouts = [self._timeout_for(task.tag) for _, task in leased]
+        if any(timeout is None for timeout in timeouts):
+            return None
+        if not self._in_worker_process:
+            return self.watchdog.watch(self.slot, leased, max(timeouts))
+        # the parent process enforces the deadline
+        watched = WatchedTasks(self.slot, leased, max(timeouts))
+        self._report(('watch', watched.deadline, watched.timeout,
+                      [item for item, _ in leased]))
+        self._local.watched = watched
+        return watched
+
+    def _unwatch(self, watched):
+        """Returns True if the worker still owns the watched tasks."""
+        if watched is None:
+            return True
+        if not self._in_worker_process:
+            return self.watchdog.unwatch(watched)
+        # once reported, the parent leaves the tasks to this process even
+        # if it kills it past the deadline
+        self._report(('unwatch',))
+        self._local.watched = None
+        if time.time() < watched.deadline:
+            return True
+        # handled here like the parent would have, what the task emitted
+        # past the deadline was dropped
+        self._on_task_timeout(watched)
+        return False
+
+    def _report(self, report):
+        data = memoryview(_WorkerReports.encode(report))
+        while data:
+            data = data[os.write(self._report_fd, data):]
+
+    def task_timed_out(self) -> bool:
+        """Whether the task(s) of the calling worker slot exceeded their
+        timeout. Long running business logic may check this to stop early,
+        its outcome is ignored in any case."""
+        if self._in_worker_process:
+            watched = getattr(self._local, 'watched', None)
+            return watched is not None and time.time() >= watched.deadline
+        return self.watchdog.timed_out(self.slot)
+
+    def _on_task_timeout(self, watched):
+        for item, task in watched.leased:
+            # the worker may still be processing the task
+            task = deepcopy(task)
+            logger.error("transaction={} Task {} timed out after {} seconds "
+                         "in {}".format(task.t_id if task.t_id else -1,
+                                        task.tag, watched.timeout,
+                                        self.daemon_name))
+            self.tasks_counter.inc(daemon=self.daemon_name, tag=task.tag,
+                                   outcome='timeout')
+            if self.timeout_policy == 'requeue':
+                self.input_queue.release(item)
+            else:
+                e = TimeoutError('Task {} timed out after {} seconds'.format(
+                    task.tag, watched.timeout))
+                self._task_failed(item, task, e, 'killed by the watchdog')
+
+    def _task_succeeded(self, item, task):
+        self.tasks_processed += 1
+        with self.ack_seconds.time(daemon=self.daemon_name, op='complete'):
+            if self.result_buffer is not None:
+                self.result_buffer.complete(self.input_queue, item)
+            else:
+                self.input_queue.complete(item)
+        self.tasks_counter.inc(daemon=self.daemon_name, tag=task.tag,
+                               outcome='success')
+
+    def _task_failed(self, item, task, e, tb):
+        self.tasks_processed += 1
+        self.tasks_counter.inc(daemon=self.daemon_name, tag=task.tag,
+                               outcome='failure')
+        with self.ack_seconds.time(daemon=self.daemon_name, op='error'):
+            self._publish_failure(item, task, e, tb)
+
+    def _publish_failure(self, item, task, e, tb):
+        msg = "{} --> in '{}': {}".format(e, __file__, tb)
+        if task.t_id and self.result_queue:
+            # send the task back to the task manager with an error
+            # so the task manager can decide what to do with it
+            # for example executing a subflow or simply marking the
+            # transaction as failed in db
+            task.error = msg
+            self._publish(task)
+        else:
+            # if the task doesn't yet have a transactionid, default
+            # to error queue
+            self.input_queue.error(item, msg=msg)
+
+    def emit(self, task):
+        """Publishes a follow-up (or failed) task into the result queue.
+        Prefer this over putting into `result_queue` directly, so that the
+        daemon can be chained in-process with others (see `ChainDaemon`).
+        Tasks emitted once the task(s) of the worker slot timed out are
+        dropped, as the timeout was already handled."""
+        if self.task_timed_out():
+            logger.warning('Dropping task {} emitted after the timeout in {}'
+                           .format(task.tag, self.daemon_name))
+            return
+        pending = getattr(self._local, 'pending', None)
+        if pending is not None:
+            pending.append(task)
+        else:
+            self._publish(task)
+
+    def _publish_pending(self):
+        pending, self._local.pending = getattr(
+            self._local, 'pending', None), None
+        for task in pending or []:
+            self._publish(task)
+
+    def _publish(self, task):
+        span = None
+        if self.tracer is not None and task.trace:
+            span = tracing.Span('publish', task.trace['trace_id'],
+                                task.trace['span_id'],
+                                attributes={'daemon': self.daemon_name,
+                                            'tag': task.tag})
+            task.trace['emitted'] = span.start
+        put_task = getattr(self.result_queue, 'put_task', None)
+        if put_task is not None:
+            put_task(task)
+        elif self.result_buffer is not None:
+            self.result_buffer.put(self.result_queue,
+                                   self.task_to_bytes(task))
+        else:
+            self.result_queue.put(self.task_to_bytes(task))
+        if span is not None:
+            spans = getattr(self._local, 'spans', None)
+            if spans is None:
+                # emitted outside of the processing of a task
+                self.tracer.export([span.finish()])
+            else:
+                spans.append(span.finish())
+
+    def _flush_results(self):
+        if self.result_buffer is not None:
+            self.result_buffer.stop()
+
+    def task_to_bytes(self, task, queue: RedisWQ = None) -> bytes:
+        """Serializes a task with the codec registered for the given queue,
+        by default the result queue."""
+        queue = queue or self.result_queue
+        codec, _ = task_codecs.get_queue_codec(queue._main_q_key)
+        return task.to_bytes(codec=codec)
 
     def run(self):
-        while not self.stopped:
-            self.run_once()
+        self.setup()
+        try:
+            if self.pool_mode == 'process':
+                self._run_process_pool()
+            elif self.pool_size > 1:
+                self._start_metrics_server()
+                self._start_listening()
+                self._run_thread_pool()
+            else:
+                self._start_metrics_server()
+                self._start_listening()
+                while not self.stopped:
+                    self.run_once()
+        finally:
+            self.stop()
+            self.watchdog.stop()
+            self.cancellation.stop()
+            self._stop_prefetching()
+            self._flush_results()
+            self._stop_metrics_server()
+            if self.tracer is not None:
+                self.tracer.close()
+
+    def _should_recycle(self):
+        if (self.max_tasks_per_child > 0 and
+                self.tasks_processed >= self.max_tasks_per_child):
+            logger.info('Worker process {} processed {} tasks, recycling'
+                        .format(os.getpid(), self.tasks_processed))
+            return True
+        if self.max_rss_mb > 0:
+            rss_mb = current_rss_bytes() / (1024 * 1024)
+            if rss_mb > self.max_rss_mb:
+                logger.info('Worker process {} uses {:.0f}MB RSS, recycling'
+                            .format(os.getpid(), rss_mb))
+                return True
+        return False
+
+    def _run_slot(self, slot: int, recycle=False):
+        """Worker loop of one slot of the pool. Returns True if the worker
+        should be recycled."""
+        self._local.slot = slot
+        try:
+            while not self.stopped:
+                self.run_once()
+                if recycle and not self.stopped and self._should_recycle():
+                    return True
+            return False
+        except Exception:
+            logger.exception('Worker slot {} of {} crashed, stopping'
+                             .format(slot, self.daemon_name))
+            self.stop()
+            raise
+
+    def _run_thread_pool(self):
+        workers = [
+            threading.Thread(target=self._run_slot, args=(slot,),
+                             name='{}-{}'.format(self.daemon_name, slot),
+                             daemon=True)
+            for slot in range(self.pool_size)]
+        for worker in workers:
+            worker.start()
+        # join with a timeout so that the main thread keeps handling signals
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(timeout=1.0)
 
-    def exit_gracefully(self, _, __):
+    def _fork_worker(self, slot: int):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                os.close(read_fd)
+                for reports in self._worker_reports.values():
+                    os.close(reports.fd)
+                self._worker_reports = {}
+                self._report_fd = write_fd
+                self._children = {}
+                self._in_worker_process = True
+                self._start_metrics_server(port_offset=slot)
+                # threads don't survive the fork
+                self.cancellation.stop()
+                self._start_listening()
+                if self._run_slot(slot, recycle=True):
+                    exit_code = self.RECYCLE_EXIT_CODE
+            except BaseException:
+                exit_code = 1
+            finally:
+                try:
+                    self.stop()
+                    self._stop_prefetching()
+                    self._flush_results()
+                finally:
+                    os._exit(exit_code)
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        logger.info('Started worker process {} for slot {}'.format(pid, slot))
+        self._children[pid] = slot
+        self._worker_reports[pid] = _WorkerReports(read_fd, slot)
+
+    def _run_process_pool(self):
+        # move the state loaded in setup() out of reach of the garbage
+        # collector, so that its bookkeeping doesn't touch (and copy) the
+        # shared memory pages in the workers (Python 3.7 and later)
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+        for slot in range(self.pool_size):
+            self._fork_worker(slot)
+        while self._children:
+            self._read_worker_reports()
+            self._kill_expired_workers()
+            if not self._reap_workers():
+                break
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+
+    def _read_worker_reports(self):
+        """Waits for reports of the worker processes until the next deadline,
+        at most `POOL_POLL_INTERVAL` seconds."""
+        timeout = self.POOL_POLL_INTERVAL
+        open_reports = {}
+        for reports in self._worker_reports.values():
+            if reports.eof:
+                continue
+            open_reports[reports.fd] = reports
+            if reports.watch is not None and not reports.killed:
+                timeout = min(timeout, reports.watch[0] - time.time())
+        readable, _, _ = select.select(list(open_reports), [], [],
+                                       max(timeout, 0))
+        for fd in readable:
+            open_reports[fd].read()
+
+    def _kill_expired_workers(self):
+        now = time.time()
+        for pid, reports in self._worker_reports.items():
+            if (reports.watch is not None and not reports.killed and
+                    now >= reports.watch[0]):
+                logger.error('Killing worker process {} of slot {}, its task '
+                             'timed out'.format(pid, reports.slot))
+                reports.killed = True
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def _reap_workers(self):
+        """Handles the worker processes which exited, replacing them as
+        needed. Returns False if there are no worker processes left."""
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return False
+            if pid == 0:
+                return True
+            slot = self._children.pop(pid, None)
+            reports = self._worker_reports.pop(pid, None)
+            if reports is not None:
+                self._close_worker_reports(reports)
+            if slot is None or self.stopped:
+                continue
+            if (os.WIFEXITED(status) and
+                    os.WEXITSTATUS(status) == self.RECYCLE_EXIT_CODE):
+                self._fork_worker(slot)
+            elif status != 0:
+                logger.warning('Worker process {} for slot {} died with '
+                               'status {}, replacing it'.format(
+                                   pid, slot, status))
+                self._fork_worker(slot)
+        return True
+
+    def _close_worker_reports(self, reports):
+        # the last reports tell whether the worker still claimed its tasks
+        # before it was killed, all of them are buffered in the pipe by now
+        reports.read()
+        os.close(reports.fd)
+        if not reports.killed or reports.watch is None:
+            return
+        _, timeout, items = reports.watch
+        leased = [(item, task) for item, task in
+                  ((item, self._read_task(item)) for item in items)
+                  if task is not None]
+        self._on_task_timeout(WatchedTasks(reports.slot, leased, timeout))
+
+    def request_cancel(self, t_id: int):
+        """Cancels the transaction `t_id` in all daemons."""
+        self.cancellation.request_cancel(t_id)
+
+    def is_cancelled(self, t_id: int = None) -> bool:
+        """Whether the transaction `t_id`, by default the one being
+        processed by the calling worker slot, was cancelled."""
+        t_id = t_id or self.processing_t_id
+        try:
+            return self.cancellation.is_cancelled(t_id)
+        except Exception:
+            logger.warning('Could not check the cancellation of t_id {}'
+                           .format(t_id), exc_info=True)
+            return False
+
+    def _start_listening(self):
+        if self.listen_cancellations:
+            self.cancellation.listen()
+
+    def _cancel_processing(self, t_id: int):
+        logger.warn('Processing t_id {} should be properly cancelled!'.
+                    format(t_id))
+        try:
+            self.request_cancel(t_id)
+        except Exception:
+            logger.warning('Could not signal the cancellation of t_id {} '
+                           'through Redis'.format(t_id), exc_info=True)
+        if os.path.exists(ASSUMED_SHARED_DATA):
+            logger.warn('Writing a cancellation file in assumed '
+                        'shared data folder {}'.format(
+                            ASSUMED_SHARED_DATA))
+            c_file = os.path.join(ASSUMED_SHARED_DATA,
+                                  'cancel-{}'.format(t_id))
+            if not os.path.exists(c_file):
+                open(c_file, 'a').close()
+            return True
+        return False
+
+    def exit_gracefully(self, signum, __):
         logger.info("Ok, no rush, people. Terminating gracefully now.")
-        if self.processing_t_id:
-            logger.warn('Processing t_id {} should be properly cancelled!'.
-                        format(self.processing_t_id))
-            if os.path.exists(ASSUMED_SHARED_DATA):
-                logger.warn('Writing a cancellation file in assumed '
-                            'shared data folder {}'.format(
-                                ASSUMED_SHARED_DATA))
-                c_file = os.path.join(ASSUMED_SHARED_DATA,
-                                      'cancel-{}'.format(self.processing_t_id))
-                if not os.path.exists(c_file):
-                    open(c_file, 'a').close()
-            else:
+        if self.pooled:
+            # pool mode: stop leasing and cancel all in-flight tasks, the
+            # run() loop waits for the workers to finish
+            self.stop()
+            for pid in list(self._children):
+                os.kill(pid, signum)
+            for t_id in self._in_flight_t_ids():
+                if not self._cancel_processing(t_id):
+                    logger.warn('Waiting for t_id {} to finish'.format(t_id))
+        else:
+            if self.prefetch > 0:
+                # the run() loop returns the prefetched items once stopped
+                self.stop()
+            cancelled = [self._cancel_processing(t_id)
+                         for t_id in self._in_flight_t_ids()]
+            if not all(cancelled):
                 raise Exception('Transaction cancelled due to shutdown')
 
+    def toggle_profiling(self, signum, __):
+        self.profiler.toggle()
+        for pid in list(self._children):
+            os.kill(pid, signum)
+
+    def _in_flight_t_ids(self):
+        t_ids = list(self.processing_t_ids.values())
+        for batch in list(self.processing_batches.values()):
+            t_ids.extend(batch)
+        return t_ids
+
     def stop(self):
         self.stopped = True
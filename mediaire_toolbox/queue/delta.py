@@ -0,0 +1,172 @@
+import json
+import hashlib
+import logging
+import threading
+
+from collections import OrderedDict
+
+from mediaire_toolbox.queue.task_codecs import TaskCodec, STATE_KEY
+
+logger = logging.getLogger(__name__)
+
+"""
+Delta encoding of Task payloads: the data of a task is stored once in Redis
+as a base, and the tasks derived from it only carry a patch against it.
+"""
+
+
+def diff(old: dict, new: dict) -> dict:
+    """Returns the patch turning `old` into `new`, empty if they are equal.
+
+    Values shared by both (e.g. the unchanged parts of copy-on-write data)
+    are skipped without comparing them, nested dictionaries are compared
+    recursively. A patch has the keys `s` (set values), `d` (deleted keys)
+    and `n` (patches of nested dictionaries), each only if not empty.
+    """
+    sets, nested = {}, {}
+    for key, value in new.items():
+        if key in old:
+            old_value = old[key]
+            if value is old_value:
+                continue
+            if isinstance(value, dict) and isinstance(old_value, dict):
+                patch = diff(old_value, value)
+                if patch:
+                    nested[key] = patch
+                continue
+            if type(value) is type(old_value) and value == old_value:
+                continue
+        sets[key] = value
+    deleted = [key for key in old if key not in new]
+    patch = {}
+    if sets:
+        patch['s'] = sets
+    if deleted:
+        patch['d'] = deleted
+    if nested:
+        patch['n'] = nested
+    return patch
+
+
+def apply_patch(base: dict, patch: dict) -> dict:
+    """Returns `base` with the patch applied, without modifying `base`. The
+    unchanged values are shared with it."""
+    result = dict(base)
+    for key in patch.get('d', ()):
+        result.pop(key, None)
+    result.update(patch.get('s', {}))
+    for key, nested in patch.get('n', {}).items():
+        result[key] = apply_patch(result.get(key) or {}, nested)
+    return result
+
+
+class DeltaCodec(TaskCodec):
+    """Encodes the data of a task as a patch against a base stored in Redis.
+
+    A task decoded with this codec remembers its base in `task.codec_state`,
+    so that its children (see `Task.create_child()`) only carry the keys
+    they changed. Tasks re-encoded with another codec lose it. After
+    `compact_every` hops, or when the base isn't available anymore, the
+    whole data is stored as a new base. Bases are content addressed and
+    expire after `ttl_secs`, so a task must be consumed within that time.
+
+    As it needs a Redis connection, the codec has to be registered by the
+    producers and the consumers of a queue before use:
+
+        task_codecs.register_codec(DeltaCodec(redis_db))
+        task_codecs.register_queue(queue_name, codec='delta')
+
+    Layout: header, then JSON of the task without its data, with `delta`:
+    {base, hops, patch}. Data which isn't a dictionary is stored in full.
+    """
+
+    name = 'delta'
+    header = b'\x03'
+    CACHE_SIZE = 64
+
+    def __init__(self, db, prefix='task_bases', compact_every=10,
+                 ttl_secs=7 * 24 * 60 * 60):
+        """
+        Parameters
+        ----------
+        db:
+            A redis.StrictRedis instance, e.g. the one of a RedisWQ
+        prefix: str
+            Prefix of the Redis keys of the bases
+        compact_every: int
+            Number of hops after which the data is stored as a new base
+        ttl_secs: int
+            Seconds after which unused bases expire
+        """
+        self._db = db
+        self.prefix = prefix
+        self.compact_every = compact_every
+        self.ttl_secs = ttl_secs
+        # base reference -> (JSON payload, decoded base), the decoded base
+        # is only read for diffing and treated as immutable
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, ref, payload):
+        # decoded again, so that it doesn't share values with the data of
+        # the task
+        cached = (payload, json.loads(payload.decode('utf-8')))
+        with self._lock:
+            self._cache[ref] = cached
+            self._cache.move_to_end(ref)
+            while len(self._cache) > self.CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return cached
+
+    def _load_base(self, ref):
+        """Returns the (JSON payload, decoded base) tuple of the base, None if
+        it expired."""
+        with self._lock:
+            cached = self._cache.get(ref)
+        if cached is not None:
+            return cached
+        payload = self._db.get('{}:{}'.format(self.prefix, ref))
+        if payload is None:
+            return None
+        return self._remember(ref, payload)
+
+    def _store_base(self, data):
+        payload = json.dumps(data, sort_keys=True).encode('utf-8')
+        ref = hashlib.sha256(payload).hexdigest()
+        self._db.setex('{}:{}'.format(self.prefix, ref), self.ttl_secs,
+                       payload)
+        self._remember(ref, payload)
+        return ref
+
+    def encode(self, d, state=None):
+        d = dict(d)
+        data = d.pop('data', None)
+        if isinstance(data, dict):
+            cached = None
+            if state and state['hops'] + 1 < self.compact_every:
+                cached = self._load_base(state['base'])
+            if cached is None:
+                d['delta'] = {'base': self._store_base(data), 'hops': 0}
+            else:
+                d['delta'] = {'base': state['base'],
+                              'hops': state['hops'] + 1,
+                              'patch': diff(cached[1], data)}
+        else:
+            d['data'] = data
+        return self.header + json.dumps(d).encode('utf-8')
+
+    def decode(self, payload):
+        d = json.loads(bytes(memoryview(payload)[1:]).decode('utf-8'))
+        delta = d.pop('delta', None)
+        if delta is None:
+            return d
+        cached = self._load_base(delta['base'])
+        if cached is None:
+            raise ValueError('Base {} of the delta encoded payload expired'
+                             .format(delta['base']))
+        # decoded from the cached payload, so that the data is a plain
+        # dictionary the task may modify
+        base = json.loads(cached[0].decode('utf-8'))
+        d['data'] = apply_patch(base, delta.get('patch', {}))
+        d[STATE_KEY] = {'base': delta['base'], 'hops': delta['hops']}
+        return d
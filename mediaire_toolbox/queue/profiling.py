@@ -0,0 +1,109 @@
+import os
+import time
+import pstats
+import cProfile
+import logging
+import threading
+
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+"""
+Opt-in profiling of the business logic of our daemons, so that the hot
+spots of real workloads can be inspected without rebuilding images.
+"""
+
+
+class TaskProfiler(object):
+    """Profiles tasks with cProfile and aggregates the profiles per tag in
+    pstats files `<profile_dir>/<name>-<tag>.pstats`, which can be inspected
+    with e.g. `python -m pstats` or snakeviz.
+
+    A task is kept in the aggregated profile if it is every `every_n`th
+    task or if it ran for at least `min_seconds`. Note that with
+    `min_seconds` every task has to be profiled, as we only know afterwards
+    whether it was slow.
+    """
+
+    def __init__(self, profile_dir: str, name: str, every_n=1,
+                 min_seconds=None, enabled=False):
+        """
+        Parameters
+        ----------
+        profile_dir: str
+            Folder in which the aggregated profiles are written
+        name: str
+            Prefix for the profile files, e.g. the daemon name
+        every_n: int
+            Keep the profile of every n-th task, 0 to disable.
+        min_seconds: float
+            Keep the profile of tasks which took at least this long, None
+            to disable.
+        enabled: bool
+            Whether to start profiling right away.
+        """
+        self.profile_dir = profile_dir
+        self.name = name
+        self.every_n = every_n
+        self.min_seconds = min_seconds
+        self.enabled = enabled
+        self._count = 0
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        logger.info('Profiling {} for {}, writing to {}'.format(
+            'enabled' if self.enabled else 'disabled', self.name,
+            self.profile_dir))
+
+    def _sampled(self):
+        if self.every_n <= 0:
+            return False
+        with self._lock:
+            self._count += 1
+            return self._count % self.every_n == 0
+
+    def profile_path(self, tag):
+        return os.path.join(self.profile_dir,
+                            '{}-{}.pstats'.format(self.name, tag))
+
+    @contextmanager
+    def profile(self, tag):
+        """Profiles the with block if the profiler is enabled."""
+        if not self.enabled:
+            yield
+            return
+        sampled = self._sampled()
+        if not sampled and self.min_seconds is None:
+            yield
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is already active
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            duration = time.time() - start
+            if sampled or duration >= self.min_seconds:
+                self._add(tag, profiler)
+
+    def _add(self, tag, profiler):
+        try:
+            with self._lock:
+                stats = self._stats.get(tag)
+                if stats is None:
+                    stats = self._stats[tag] = pstats.Stats(profiler)
+                else:
+                    stats.add(profiler)
+                os.makedirs(self.profile_dir, exist_ok=True)
+                stats.dump_stats(self.profile_path(tag))
+        except Exception:
+            logger.exception('Could not write profile for {}'.format(tag))
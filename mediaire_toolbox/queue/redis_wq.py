@@ -46,6 +46,7 @@ class RedisWQ(object):
         self._error_messages_q_key = name + ":error_messages"
         self._lease_key_prefix = name + ":leased_by_session:"
         self._limit_key_prefix = name + ":limit:"
+        self._unlink_supported = True
 
     def sessionID(self):
         """Return the ID for this session."""
@@ -59,6 +60,25 @@ class RedisWQ(object):
         """Return the size of the processing queue."""
         return self._db.llen(self._processing_q_key)
 
+    def _lease_count(self):
+        """Return the number of live leases, i.e. of items being worked on.
+        Unlike the processing queue this doesn't count the items of failed
+        or crashed workers once their lease expired. Checks the lease of
+        every item of the processing queue in one pipelined round trip, the
+        processing queue is about as long as the number of workers."""
+        items = self._db.lrange(self._processing_q_key, 0, -1)
+        if not items:
+            return 0
+        pipe = self._db.pipeline(transaction=False)
+        for item in items:
+            pipe.exists(self._lease_key_prefix + self._itemkey(item))
+        return sum(1 for exists in pipe.execute() if exists)
+
+    def peek(self):
+        """Return the item which will be leased next without leasing it, or
+        None if the main queue is empty."""
+        return self._db.lindex(self._main_q_key, -1)
+
     def empty(self):
         """Return True if the queue is empty, including work being done, False
         otherwise.
@@ -94,8 +114,10 @@ class RedisWQ(object):
         """True if a lease on 'item' exists."""
         return self._db.exists(self._lease_key_prefix + self._itemkey(item))
 
-    def put(self, item):
-        self._db.lpush(self._main_q_key, item)
+    def put(self, item, pipe=None):
+        """Adds an item to the queue. If given, the command is only queued
+        in the pipeline `pipe`."""
+        (self._db if pipe is None else pipe).lpush(self._main_q_key, item)
 
     @staticmethod
     def _get_limit_key(timeunit):
@@ -216,6 +238,24 @@ class RedisWQ(object):
                            self._session)
         return item
 
+    def extend_lease(self, value, lease_secs):
+        """Renews the lease on the item with 'value' for another
+        `lease_secs` seconds."""
+        itemkey = self._itemkey(value)
+        self._db.setex(self._lease_key_prefix + itemkey, lease_secs,
+                       self._session)
+
+    def release(self, value):
+        """Gives up the lease on the item with 'value' without completing
+        it. The item is moved back to the head of the main queue, so it is
+        the next one to be leased."""
+        itemkey = self._itemkey(value)
+        pipe = self._db.pipeline()
+        pipe.lrem(self._processing_q_key, 0, value)
+        pipe.rpush(self._main_q_key, value)
+        pipe.delete(self._lease_key_prefix + itemkey)
+        pipe.execute()
+
     def error(self, value, msg=None):
         """Handle the case when processing of the item with 'value' failed.
 
@@ -240,20 +280,157 @@ class RedisWQ(object):
                                                      self._error_q_key))
             assert len_errors == len_msgs
 
-    def complete(self, value):
+    def complete(self, value, pipe=None):
         """Complete working on the item with 'value'.
 
         If the lease expired, the item may not have completed, and some
         other worker may have picked it up.  There is no indication
         of what happened.
+
+        If given, the commands are only queued in the pipeline `pipe`.
         """
-        self._db.lrem(self._processing_q_key, 0, value)
+        db = self._db if pipe is None else pipe
+        db.lrem(self._processing_q_key, 0, value)
         # If we crash here, then the GC code will try to move the value,
         # but it will
         # not be here, which is fine.  So this does not need to be a
         # transaction.
         itemkey = self._itemkey(value)
-        self._db.delete(self._lease_key_prefix + itemkey, self._session)
+        db.delete(self._lease_key_prefix + itemkey, self._session)
+
+    def _key_kind(self, key):
+        """Returns the kind of an auxiliary key of this queue, e.g.
+        'processing', 'errors' or 'leased_by_session'."""
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        return key[len(self._main_q_key) + 1:].split(':', 1)[0]
+
+    def _unlink_batch(self, keys, removed):
+        """Deletes a batch of keys in one pipelined round trip and counts
+        the keys which were actually removed by kind.
+
+        UNLINK reclaims the memory in a background thread on the Redis
+        server, so large error lists don't block other clients. Servers
+        older than Redis 4.0 don't know UNLINK, there we fall back to DEL.
+        """
+        if not keys:
+            return
+        command = 'UNLINK' if self._unlink_supported else 'DEL'
+        pipe = self._db.pipeline(transaction=False)
+        for key in keys:
+            pipe.execute_command(command, key)
+        try:
+            results = pipe.execute()
+        except redis.exceptions.ResponseError:
+            if not self._unlink_supported:
+                raise
+            logger.warning('UNLINK not supported by the Redis server, '
+                           'falling back to DEL')
+            self._unlink_supported = False
+            self._unlink_batch(keys, removed)
+            return
+        for key, result in zip(keys, results):
+            if result:
+                kind = self._key_kind(key)
+                removed[kind] = removed.get(kind, 0) + 1
+
+    def _scan_and_unlink(self, pattern, batch_size, predicate=None):
+        """Incrementally iterates over all keys matching `pattern` with SCAN
+        and unlinks them in batches of `batch_size`. If given, only keys for
+        which `predicate(keys)` returns True are removed."""
+        removed = {}
+        batch = []
+        for key in self._db.scan_iter(match=pattern, count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                if predicate:
+                    batch = predicate(batch)
+                self._unlink_batch(batch, removed)
+                batch = []
+        if predicate and batch:
+            batch = predicate(batch)
+        self._unlink_batch(batch, removed)
+        return removed
+
+    def purge(self, batch_size=500, include_main_queue=False):
+        """Removes all the keys associated with this queue, i.e.
+        `<name>:*` (processing and error lists, leases and rate limit
+        buckets).
+
+        The keys are enumerated with incremental SCAN and deleted with
+        UNLINK in pipelined batches, so this is safe to run against a Redis
+        instance which is serving production traffic. It is meant to be
+        called once processing on the queue is complete, items which are
+        currently being processed will be lost otherwise.
+
+        Parameters
+        ----------
+        batch_size: int
+            Number of keys to scan and delete per round trip.
+        include_main_queue: bool
+            Also remove the main queue, i.e. all the pending items.
+
+        Returns
+        -------
+        dict
+            Number of removed keys by kind, e.g. {'errors': 1, 'limit': 3}
+        """
+        removed = self._scan_and_unlink(
+            self._main_q_key + ':*', batch_size)
+        if include_main_queue:
+            if self._db.delete(self._main_q_key):
+                removed['main'] = 1
+        logger.info('Purged queue {}: {}'.format(self._main_q_key, removed))
+        return removed
+
+    def gc(self, batch_size=500):
+        """Removes the auxiliary keys of this queue which don't back any
+        work anymore, while leaving the queue itself operational:
+
+        * lease keys of items which are not in the processing queue
+          anymore (e.g. the lease outlived the item after an error).
+        * rate limit buckets which lost their expiry time.
+
+        Like `purge()` this only uses SCAN and pipelined UNLINK.
+
+        Parameters
+        ----------
+        batch_size: int
+            Number of keys to scan and delete per round trip.
+
+        Returns
+        -------
+        dict
+            Number of removed keys by kind.
+        """
+        def stale_lease(keys):
+            # The processing list is read again for every batch, just
+            # before unlinking it, so that the leases of items leased since
+            # the SCAN started are kept. It should not be _too_ long since
+            # it is approximately as long as the number of active and
+            # recently active workers.
+            processing = set(
+                self._lease_key_prefix + self._itemkey(item)
+                for item in self._db.lrange(self._processing_q_key, 0, -1))
+            return [k for k in keys
+                    if (k.decode('utf-8') if isinstance(k, bytes) else k)
+                    not in processing]
+
+        def no_expiry(keys):
+            pipe = self._db.pipeline(transaction=False)
+            for key in keys:
+                pipe.ttl(key)
+            # -1 means the key exists but has no associated expire
+            return [key for key, ttl in zip(keys, pipe.execute())
+                    if ttl == -1]
+
+        removed = self._scan_and_unlink(
+            self._lease_key_prefix + '*', batch_size, stale_lease)
+        removed.update(self._scan_and_unlink(
+            self._limit_key_prefix + '*', batch_size, no_expiry))
+        logger.info('Garbage collected queue {}: {}'.format(
+            self._main_q_key, removed))
+        return removed
 
     @staticmethod
     def get_all_queues_from_config(appconfig: dict, redis_args: dict):
@@ -263,10 +440,6 @@ class RedisWQ(object):
         }
         return queues
 
-
-# TODO: add functions to clean up all keys associated with "name" when
-# processing is complete.
-
 # TODO(etune): finish code to GC expired leases, and call periodically
 #  e.g. each time lease times out.
 # edit: each leased item generates a leased_key dicom_folders:leased_
@@ -0,0 +1,99 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+"""
+Coalesces the Redis round trips a daemon does after processing its tasks.
+"""
+
+
+class ResultBuffer(object):
+    """Buffers `put()` and `complete()` calls on RedisWQs and sends them in
+    one pipeline per Redis connection, once `max_size` operations are
+    buffered or the oldest one is `max_delay` seconds old. Failed flushes
+    keep the operations for the next one.
+
+    Operations are sent in the order in which they were buffered, so the
+    results of a task are put before the task is completed. Call `flush()`
+    before shutting down.
+    """
+
+    def __init__(self, max_size=100, max_delay=0.1):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        # list of (queue, method name, item)
+        self._ops = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+
+    def __len__(self):
+        return len(self._ops)
+
+    def put(self, queue, item):
+        self._add(queue, 'put', item)
+
+    def complete(self, queue, item):
+        self._add(queue, 'complete', item)
+
+    def _add(self, queue, op, item):
+        with self._lock:
+            if not self._ops:
+                self._oldest = time.time()
+            self._ops.append((queue, op, item))
+            full = len(self._ops) >= self.max_size
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='result-buffer', daemon=True)
+                self._thread.start()
+        if full:
+            try:
+                self.flush()
+            except Exception:
+                # the operations are kept for the next flush, the buffered
+                # task itself went fine
+                logger.exception('Error flushing results, retrying later')
+
+    def _run(self):
+        while not self._stopped:
+            time.sleep(self.max_delay / 2.0)
+            if self._ops and time.time() - self._oldest >= self.max_delay:
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception('Error flushing results')
+
+    def flush(self):
+        """Sends all the buffered operations."""
+        # keeps flushes in order if called from several threads
+        with self._flush_lock:
+            with self._lock:
+                ops, self._ops = self._ops, []
+            if not ops:
+                return
+            try:
+                pipes = {}
+                for queue, op, item in ops:
+                    pipe = pipes.get(id(queue._db))
+                    if pipe is None:
+                        pipe = pipes[id(queue._db)] = queue._db.pipeline(
+                            transaction=False)
+                    getattr(queue, op)(item, pipe=pipe)
+                for pipe in pipes.values():
+                    pipe.execute()
+            except Exception:
+                # keep them for the next flush, a partially sent flush
+                # will result in duplicated results at worst
+                with self._lock:
+                    self._ops = ops + self._ops
+                raise
+            logger.debug('Flushed {} results'.format(len(ops)))
+
+    def stop(self):
+        """Stops the background flushes and flushes what is left."""
+        self._stopped = True
+        self.flush()
@@ -0,0 +1,374 @@
+import os
+import json
+import math
+import time
+import signal
+import logging
+import argparse
+import importlib
+import threading
+
+from mediaire_toolbox.logging.base_logging_conf import basic_logging_conf
+from mediaire_toolbox.queue import tasks, task_codecs
+from mediaire_toolbox.queue.redis_wq import RedisWQ
+
+logger = logging.getLogger(__name__)
+
+"""
+Supervisor scaling the number of local worker processes of a daemon with
+the depth of its input queue.
+"""
+
+
+class ScalingPolicy(object):
+    """Decides how many workers should run for the observed backlog.
+
+    The target is one worker per `backlog_per_worker` tasks waiting or
+    leased, and one more worker than running whenever the oldest waiting
+    task waits for longer than `max_wait_secs`, between `min_workers` and
+    `max_workers`. To avoid flapping, the workers are only scaled up after
+    the target was above the number of running workers for
+    `scale_up_checks` consecutive checks, and scaled down (one at a time)
+    after it was below for `scale_down_checks` consecutive checks.
+    """
+
+    def __init__(self, min_workers=1, max_workers=None, backlog_per_worker=1,
+                 max_wait_secs=None, scale_up_checks=2,
+                 scale_down_checks=12):
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        if not 0 <= min_workers <= max_workers:
+            raise ValueError('Invalid worker bounds {} - {}'.format(
+                min_workers, max_workers))
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.backlog_per_worker = backlog_per_worker
+        self.max_wait_secs = max_wait_secs
+        self.scale_up_checks = scale_up_checks
+        self.scale_down_checks = scale_down_checks
+        self._above = 0
+        self._below = 0
+
+    def target(self, workers: int, backlog: int, wait_secs=None) -> int:
+        """The number of workers needed, without hysteresis."""
+        target = math.ceil(backlog / self.backlog_per_worker)
+        if (self.max_wait_secs is not None and wait_secs is not None and
+                wait_secs > self.max_wait_secs):
+            target = max(target, workers + 1)
+        return min(max(target, self.min_workers), self.max_workers)
+
+    def desired(self, workers: int, backlog: int, wait_secs=None) -> int:
+        """The number of workers which should run after this check.
+
+        Parameters
+        ----------
+        workers: int
+            Number of running workers
+        backlog: int
+            Number of tasks waiting in the input queue or with a live lease
+        wait_secs: float
+            Time the oldest waiting task has been waiting, if known
+        """
+        if workers < self.min_workers or workers > self.max_workers:
+            self._above = self._below = 0
+            return min(max(workers, self.min_workers), self.max_workers)
+        target = self.target(workers, backlog, wait_secs)
+        if target > workers:
+            self._above += 1
+            self._below = 0
+            if self._above >= self.scale_up_checks:
+                self._above = 0
+                return target
+        elif target < workers:
+            self._below += 1
+            self._above = 0
+            if self._below >= self.scale_down_checks:
+                self._below = 0
+                return workers - 1
+        else:
+            self._above = self._below = 0
+        return workers
+
+
+class Supervisor(object):
+    """Runs between `policy.min_workers` and `policy.max_workers` forked
+    worker processes, each running the daemon returned by
+    `daemon_factory(slot)`, and checks the input queue every
+    `check_interval` seconds to scale them with the backlog.
+
+    Workers which are scaled down are sent SIGUSR2, which stops their daemon
+    after the tasks in flight (unlike SIGTERM, which cancels them), so
+    their daemons should lease with a `lease_timeout`. Worker processes
+    which die unexpectedly are replaced. On SIGINT / SIGTERM the supervisor
+    forwards SIGTERM to all the workers, which cancel their tasks in flight
+    (see `QueueDaemon.exit_gracefully()`) and stop, and waits for them for
+    up to `shutdown_timeout` seconds before killing them.
+    """
+
+    def __init__(self, daemon_factory, input_queue: RedisWQ,
+                 policy: ScalingPolicy, name='supervisor', check_interval=5,
+                 shutdown_timeout=60):
+        """
+        Parameters
+        ----------
+        daemon_factory:
+            Callable returning the daemon for the given worker slot, called
+            in the worker process. Anything with `run()` and `stop()`
+            methods, usually a QueueDaemon.
+        input_queue:
+            The input queue of the daemons, only used for observing it
+        policy:
+            The ScalingPolicy deciding the number of workers
+        name:
+            Identifier used for logging
+        check_interval:
+            Seconds between two checks of the input queue
+        shutdown_timeout:
+            Seconds to wait for the workers to exit on shutdown before
+            sending them SIGKILL
+        """
+        self.daemon_factory = daemon_factory
+        self.input_queue = input_queue
+        self.policy = policy
+        self.name = name
+        self.check_interval = check_interval
+        self.shutdown_timeout = shutdown_timeout
+        self.stopped = False
+        # pid -> slot of the running workers
+        self._workers = {}
+        # pids of the workers being scaled down
+        self._stopping = set()
+        self._wakeup = threading.Event()
+
+        signal.signal(signal.SIGINT, self.exit_gracefully)
+        signal.signal(signal.SIGTERM, self.exit_gracefully)
+
+    @classmethod
+    def from_config(cls, config: dict):
+        """Creates a supervisor from a configuration dictionary, e.g. read
+        from a JSON file, with the keys:
+
+        * `daemon_class`: the QueueDaemon subclass as 'package.module:Class'
+        * `daemon_name`, `input_queue`, `result_queue` (optional),
+          `lease_secs` and `daemon_config`: the arguments of the daemon.
+          Worker slots serve their metrics on `metrics_port` + slot.
+        * `redis`: keyword arguments of the Redis connections
+        * `min_workers`, `max_workers`, `backlog_per_worker`,
+          `max_wait_secs`, `scale_up_checks` and `scale_down_checks`: see
+          ScalingPolicy
+        * `check_interval` and `shutdown_timeout`: see Supervisor
+        """
+        module_name, class_name = config['daemon_class'].split(':')
+        daemon_class = getattr(importlib.import_module(module_name),
+                               class_name)
+        redis_kwargs = config.get('redis', {})
+        daemon_name = config['daemon_name']
+
+        def daemon_factory(slot):
+            daemon_config = dict(config.get('daemon_config', {}))
+            # stop promptly when scaled down
+            daemon_config.setdefault('lease_timeout', 5)
+            if 'metrics_port' in daemon_config:
+                daemon_config['metrics_port'] += slot
+            result_queue = config.get('result_queue')
+            return daemon_class(
+                RedisWQ(config['input_queue'], **redis_kwargs),
+                RedisWQ(result_queue, **redis_kwargs)
+                if result_queue else None,
+                config.get('lease_secs', 60 * 30),
+                daemon_name,
+                daemon_config)
+
+        policy = ScalingPolicy(
+            min_workers=config.get('min_workers', 1),
+            max_workers=config.get('max_workers'),
+            backlog_per_worker=config.get('backlog_per_worker', 1),
+            max_wait_secs=config.get('max_wait_secs'),
+            scale_up_checks=config.get('scale_up_checks', 2),
+            scale_down_checks=config.get('scale_down_checks', 12))
+        return cls(daemon_factory,
+                   RedisWQ(config['input_queue'], **redis_kwargs),
+                   policy,
+                   name='{}-supervisor'.format(daemon_name),
+                   check_interval=config.get('check_interval', 5),
+                   shutdown_timeout=config.get('shutdown_timeout', 60))
+
+    @property
+    def workers(self) -> int:
+        """Number of running workers, not counting the ones stopping."""
+        return len(self._workers) - len(self._stopping)
+
+    def observe(self):
+        """Returns the backlog of the input queue (waiting tasks and live
+        leases) and the time its oldest waiting task has been waiting (None
+        if unknown).
+
+        The processing queue isn't counted, as it keeps the items of failed
+        tasks and of crashed workers."""
+        backlog = (self.input_queue._main_qsize() +
+                   self.input_queue._lease_count())
+        wait_secs = None
+        item = self.input_queue.peek()
+        if item is not None:
+            try:
+                _, task_class = task_codecs.get_queue_codec(
+                    self.input_queue._main_q_key)
+                task = (task_class or tasks.Task)().read_bytes(item)
+                created = task.update_timestamp or task.timestamp
+                if created:
+                    wait_secs = max(0, time.time() - created)
+            except Exception:
+                logger.debug('Could not read the oldest waiting task',
+                             exc_info=True)
+        return backlog, wait_secs
+
+    def _start_worker(self, slot: int):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                daemon = self.daemon_factory(slot)
+                # replaces the handlers of the daemon, which only cancel its
+                # tasks in flight
+                signal.signal(signal.SIGINT, _terminate_handler(daemon))
+                signal.signal(signal.SIGTERM, _terminate_handler(daemon))
+                signal.signal(signal.SIGUSR2, lambda *_: daemon.stop())
+                daemon.run()
+            except BaseException:
+                logger.exception('Worker {} of {} crashed'.format(
+                    slot, self.name))
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        logger.info('Started worker process {} for slot {}'.format(pid, slot))
+        self._workers[pid] = slot
+
+    def _scale_to(self, target: int):
+        if target > self.workers:
+            logger.info('{}: scaling up from {} to {} workers'.format(
+                self.name, self.workers, target))
+        elif target < self.workers:
+            logger.info('{}: scaling down from {} to {} workers'.format(
+                self.name, self.workers, target))
+        while self.workers < target:
+            used = set(self._workers.values())
+            self._start_worker(min(set(range(len(used) + 1)) - used))
+        while self.workers > target:
+            # the newest worker is the least likely to hold a warm state
+            pid = max((slot, pid) for pid, slot in self._workers.items()
+                      if pid not in self._stopping)[1]
+            self._stopping.add(pid)
+            os.kill(pid, signal.SIGUSR2)
+
+    def reap(self):
+        """Collects the exited workers and replaces the crashed ones."""
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            slot = self._workers.pop(pid, None)
+            if slot is None:
+                continue
+            if pid in self._stopping:
+                self._stopping.discard(pid)
+            elif not self.stopped:
+                logger.warning('Worker process {} for slot {} exited with '
+                               'status {}, replacing it'.format(
+                                   pid, slot, status))
+                self._start_worker(slot)
+
+    def step(self):
+        """Runs one check of the input queue and scales the workers."""
+        self.reap()
+        try:
+            backlog, wait_secs = self.observe()
+        except Exception:
+            logger.exception('Could not observe the input queue')
+            # make sure the bounds are kept anyway
+            self._scale_to(self.policy.desired(self.workers, 0))
+            return
+        self._scale_to(
+            self.policy.desired(self.workers, backlog, wait_secs))
+
+    def run(self):
+        try:
+            while not self.stopped:
+                self.step()
+                self._wakeup.wait(self.check_interval)
+        finally:
+            self.shutdown()
+
+    def shutdown(self, timeout=None):
+        """Sends SIGTERM to all the workers and waits for them to exit, for
+        at most `timeout` seconds (by default `shutdown_timeout`), then
+        kills the remaining ones."""
+        if timeout is None:
+            timeout = self.shutdown_timeout
+        self.stopped = True
+        self._signal_workers(signal.SIGTERM)
+        start = time.time()
+        while self._workers and time.time() - start < timeout:
+            self.reap()
+            time.sleep(0.05)
+        if self._workers:
+            logger.warning('{}: killing {} workers which did not exit within '
+                           '{} seconds'.format(self.name, len(self._workers),
+                                               timeout))
+            self._signal_workers(signal.SIGKILL)
+            for pid in list(self._workers):
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+                self._workers.pop(pid, None)
+            self._stopping.clear()
+
+    def _signal_workers(self, signum):
+        for pid in list(self._workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(self):
+        self.stopped = True
+        self._wakeup.set()
+
+    def exit_gracefully(self, signum, frame):
+        logger.info('{} received signal {}, stopping'.format(
+            self.name, signum))
+        self.stop()
+
+
+def _terminate_handler(daemon):
+    """Signal handler cancelling the tasks in flight of the daemon of a
+    worker process, if it supports it, and stopping it."""
+    def terminate(signum, frame):
+        daemon.stop()
+        exit_gracefully = getattr(daemon, 'exit_gracefully', None)
+        if exit_gracefully is not None:
+            exit_gracefully(signum, frame)
+    return terminate
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='run a daemon with autoscaled worker processes')
+    parser.add_argument('config', type=str,
+                        help='path of the JSON configuration file')
+    args = parser.parse_args()
+
+    basic_logging_conf()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    Supervisor.from_config(config).run()
+
+
+if __name__ == "__main__":
+    main()
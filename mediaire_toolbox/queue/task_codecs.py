@@ -0,0 +1,243 @@
+import json
+import struct
+import marshal
+
+from abc import ABC, abstractmethod
+
+"""
+Serializers for Task payloads which are put into our queues.
+
+Every encoded payload starts with a header byte identifying its codec, so
+that consumers can decode items regardless of the codec the producer used.
+JSON documents always start with '{', which doubles as the header of the
+JSON codec. This keeps plain JSON items (and consumers which only know
+JSON) compatible.
+
+Which codec and which Task class are used for a queue can be selected with
+`register_queue()`; queues which are not registered use JSON and the plain
+Task class.
+"""
+
+# key of a decoded payload holding state private to its codec (e.g. the base
+# of a delta encoded payload), which the task keeps as `codec_state` apart
+# from its fields and hands back when it is encoded again
+STATE_KEY = '__codec_state__'
+
+
+class RawData(object):
+    """The still encoded `data` section of a payload, see LazyCodec."""
+
+    __slots__ = ('payload', 'codec')
+
+    def __init__(self, payload, codec: str):
+        self.payload = payload
+        self.codec = codec
+
+    def decode(self):
+        return json.loads(bytes(self.payload).decode('utf-8'))
+
+    def __deepcopy__(self, memo):
+        # immutable
+        return self
+
+
+class TaskCodec(ABC):
+    """Base class for Task payload serializers."""
+
+    name = None
+    header = None
+
+    @abstractmethod
+    def encode(self, d: dict, state=None) -> bytes:
+        """Encodes a task dictionary. `state` is the codec state the task
+        was decoded with, if any, see `STATE_KEY`."""
+        pass
+
+    @abstractmethod
+    def decode(self, payload: bytes) -> dict:
+        pass
+
+    def decode_envelope(self, payload: bytes) -> dict:
+        """Decodes everything but the `data` of the payload, which may be
+        returned as RawData. By default the whole payload is decoded."""
+        return self.decode(payload)
+
+
+class JsonCodec(TaskCodec):
+    """Human readable, the format that all our queues used historically."""
+
+    name = 'json'
+    header = b'{'
+
+    def encode(self, d, state=None):
+        return json.dumps(d).encode('utf-8')
+
+    def decode(self, payload):
+        return json.loads(payload.decode('utf-8'))
+
+
+def check_json_types(value, path='task'):
+    """Raises a TypeError if `value` contains anything else than what JSON
+    round trips unchanged: dicts with str keys, lists, str, int, float,
+    bool and None. E.g. tuples would come back as lists and int keys as
+    str from the JSON codec."""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if not isinstance(key, str):
+                raise TypeError('{} has a key of type {}, only str keys are '
+                                'supported'.format(path, type(key).__name__))
+            check_json_types(item, '{}[{!r}]'.format(path, key))
+    elif isinstance(value, list):
+        for i, item in enumerate(value):
+            check_json_types(item, '{}[{}]'.format(path, i))
+    elif not (value is None or isinstance(value, (str, int, float))):
+        raise TypeError('{} is of type {}, which is not supported'.format(
+            path, type(value).__name__))
+
+
+class MarshalCodec(TaskCodec):
+    """Compact binary format based on the `marshal` module of the standard
+    library. It encodes and decodes faster than JSON and produces smaller
+    payloads. Only meant for payloads produced by our own services, as
+    marshal data is not validated on decoding.
+
+    Unlike JSON, marshal round trips tuples, int keys, bytes... unchanged,
+    so such tasks decode differently depending on the codec of their
+    queue. With `strict=True` only the types which JSON round trips are
+    accepted (see `check_json_types()`), which is meant for development
+    and tests, as the check costs more than encoding. The payloads are
+    written in marshal format version 4, which all the Python versions we
+    run (3.4 and later) read, whichever version the producer runs.
+    """
+
+    name = 'marshal'
+    header = b'\x01'
+    VERSION = 4
+
+    def __init__(self, strict=False):
+        self.strict = strict
+
+    def encode(self, d, state=None):
+        if self.strict:
+            check_json_types(d)
+        return self.header + marshal.dumps(d, self.VERSION)
+
+    def decode(self, payload):
+        return marshal.loads(memoryview(payload)[1:])  # nosec
+
+
+class LazyCodec(TaskCodec):
+    """Stores the `data` of a payload apart from the other (envelope)
+    fields, so that consumers can decode the envelope only and decode the
+    data on demand (see `LazyTask`). Data which was not decoded is
+    re-encoded as is.
+
+    Layout: header, length of the envelope (4 bytes, big endian), envelope
+    and data, both as JSON.
+    """
+
+    name = 'lazy'
+    header = b'\x02'
+    _length = struct.Struct('>I')
+
+    def encode(self, d, state=None):
+        data = d.get('data')
+        if isinstance(data, RawData) and data.codec == self.name:
+            data = data.payload
+        else:
+            data = json.dumps(data).encode('utf-8')
+        envelope = json.dumps(
+            {k: v for k, v in d.items() if k != 'data'}).encode('utf-8')
+        return b''.join((self.header, self._length.pack(len(envelope)),
+                         envelope, data))
+
+    def _split(self, payload):
+        payload = memoryview(payload)
+        end = 5 + self._length.unpack_from(payload, 1)[0]
+        d = json.loads(bytes(payload[5:end]).decode('utf-8'))
+        return d, payload[end:]
+
+    def decode(self, payload):
+        d, data = self._split(payload)
+        d['data'] = json.loads(bytes(data).decode('utf-8'))
+        return d
+
+    def decode_envelope(self, payload):
+        d, data = self._split(payload)
+        d['data'] = RawData(data, self.name)
+        return d
+
+
+_codecs_by_name = {}
+_codecs_by_header = {}
+_queues = {}
+
+
+def register_codec(codec: TaskCodec):
+    """Makes a codec available by its name and for decoding by its
+    header byte."""
+    if len(codec.header) != 1:
+        raise ValueError('The header of a codec must be a single byte')
+    other = _codecs_by_header.get(codec.header)
+    if other is not None and other.name != codec.name:
+        raise ValueError('Header {} already used by codec {}'.format(
+            codec.header, other.name))
+    _codecs_by_name[codec.name] = codec
+    _codecs_by_header[codec.header] = codec
+
+
+def get_codec(name: str) -> TaskCodec:
+    try:
+        return _codecs_by_name[name]
+    except KeyError:
+        raise ValueError('Unknown codec {}'.format(name))
+
+
+def codec_for(payload: bytes) -> TaskCodec:
+    """Returns the codec which encoded the given payload."""
+    try:
+        return _codecs_by_header[payload[:1]]
+    except KeyError:
+        raise ValueError('Unknown codec header {}'.format(payload[:1]))
+
+
+def encode(d: dict, codec='json', state=None) -> bytes:
+    return get_codec(codec).encode(d, state)
+
+
+def decode(payload: bytes) -> dict:
+    return codec_for(payload).decode(payload)
+
+
+def decode_envelope(payload: bytes) -> dict:
+    """Decodes the payload, leaving its `data` encoded as RawData if
+    the codec supports it."""
+    return codec_for(payload).decode_envelope(payload)
+
+
+def register_queue(queue_name: str, codec='json', task_class=None):
+    """Selects the codec and the Task class used for the queue with the
+    given name.
+
+    Parameters
+    ----------
+    queue_name: str
+        Name of the RedisWQ
+    codec: str
+        Name of the codec used to encode the items put into this queue
+    task_class:
+        Task subclass that the items of this queue are read into, None for
+        the plain Task class.
+    """
+    get_codec(codec)
+    _queues[queue_name] = (codec, task_class)
+
+
+def get_queue_codec(queue_name: str):
+    """Returns a tuple (codec name, task class or None) for the queue."""
+    return _queues.get(queue_name, ('json', None))
+
+
+register_codec(JsonCodec())
+register_codec(MarshalCodec())
+register_codec(LazyCodec())
@@ -1,15 +1,101 @@
 import time
 import json
 
+from abc import ABC, abstractmethod
 from copy import deepcopy
 
+from mediaire_toolbox.queue import task_codecs
+from mediaire_toolbox.queue.cow import CowDict, fork
 
-class Task(object):
+
+class BaseTask(ABC):
+    """Methods shared by the task representations, which differ only in how
+    they store their fields (see Task and CompactTask)."""
+
+    __slots__ = ()
+
+    def to_dict(self):
+        return self._to_dict(self.data)
+
+    def _to_dict(self, data):
+        if isinstance(data, CowDict):
+            data = data.to_dict()
+        return {'tag': self.tag,
+                'timestamp': self.timestamp,
+                'update_timestamp': self.update_timestamp,
+                'data': data,
+                't_id': self.t_id,
+                'user_id': self.user_id,
+                'product_id': self.product_id,
+                'error': self.error,
+                'trace': self.trace}
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def to_bytes(self, codec='json'):
+        """Serializes the task with the codec of the given name, see
+        `task_codecs`."""
+        return task_codecs.encode(self.to_dict(), codec, self.codec_state)
+
+    @abstractmethod
+    def read_dict(self, d):
+        """Reads the fields of the task from a dictionary."""
+        pass
+
+    def read_bytes(self, bytestring):
+        """Deserializes a task encoded with any of the registered codecs."""
+        d = task_codecs.decode(bytestring)
+        self.read_dict(d)
+        return self
+
+    def read_json(self, json_path):
+        with open(json_path, 'r') as f:
+            d = json.load(f)
+        self.read_dict(d)
+        return self
+
+    def create_child(self, tag=None, share_data=False):
+        """Creates and returns a follow up task object.
+
+        Parameters
+        ----------
+        tag: str
+            Tag of the child, by default the one of this task + '__child'
+        share_data: bool
+            By default the data of the child is a deep copy. If True, the
+            data is instead shared copy-on-write between both tasks, so
+            this takes constant time whatever the size of the data. The
+            `data` of both tasks then becomes a `CowDict`, which isn't a
+            dict, and references to the data (or parts of it) taken before
+            must not be used for changing it afterwards.
+        """
+        if tag is None:
+            tag = self.tag + '__child'
+        if share_data:
+            self.data, child_data = fork(self.data)
+            # everything but the data is still copied
+            child_task = deepcopy(self, {id(self.data): child_data})
+        else:
+            child_task = deepcopy(self)
+        child_task.tag = tag
+        child_task.update_timestamp = int(time.time())
+        return child_task
+
+    def __str__(self):
+        return str(self.to_dict())
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class Task(BaseTask):
     """Defines task objects that can be handled by the task manager."""
 
     def __init__(self, t_id=None, user_id=None, product_id=None,
                  tag=None, data=None,
-                 timestamp=None, update_timestamp=None, error=None):
+                 timestamp=None, update_timestamp=None, error=None,
+                 trace=None):
         """Initializes the Task object.
 
         Parameters
@@ -30,6 +116,9 @@ class Task(object):
             Timestamp of task update (via `create_child()`) from `time.time()`
         error: str
             a serialized error string in case the task failed while executing
+        trace: dict
+            Trace context, see `tracing.new_context()`. It is inherited by
+            the children of the task.
         """
         self.t_id = t_id
         self.user_id = user_id
@@ -39,24 +128,11 @@ class Task(object):
         self.update_timestamp = update_timestamp
         self.data = data
         self.error = error
+        self.trace = trace
+        # see task_codecs.STATE_KEY, not serialized
+        self.codec_state = None
         # self.update = None
 
-    def to_dict(self):
-        return {'tag': self.tag,
-                'timestamp': self.timestamp,
-                'update_timestamp': self.update_timestamp,
-                'data': self.data,
-                't_id': self.t_id,
-                'user_id': self.user_id,
-                'product_id': self.product_id,
-                'error': self.error}
-
-    def to_json(self):
-        return json.dumps(self.to_dict())
-
-    def to_bytes(self):
-        return self.to_json().encode('utf-8')
-
     def read_dict(self, d):
         tag = d['tag']
         timestamp = d['timestamp']
@@ -66,35 +142,111 @@ class Task(object):
         update_timestamp = d.get('update_timestamp', None)
         data = d.get('data', None)
         error = d.get('error', None)
+        trace = d.get('trace', None)
         Task.__init__(
             self, t_id=t_id, user_id=user_id,
             product_id=product_id, tag=tag, data=data,
             timestamp=timestamp, update_timestamp=update_timestamp,
-            error=error)
+            error=error, trace=trace)
+        self.codec_state = d.get(task_codecs.STATE_KEY)
         return self
 
-    def read_bytes(self, bytestring):
-        d = json.loads(bytestring.decode('utf-8'))
-        self.read_dict(d)
+
+class CompactTask(BaseTask):
+    """A task storing its fields in slots instead of a per-instance
+    `__dict__`, for keeping many tasks in memory. It is read and written
+    like a Task, but can't carry additional attributes. Register it for a
+    queue with `task_codecs.register_queue(queue, task_class=CompactTask)`
+    for daemons to read it from that queue.
+    """
+
+    __slots__ = ('t_id', 'user_id', 'product_id', 'tag', 'timestamp',
+                 'update_timestamp', 'data', 'error', 'trace', 'codec_state')
+
+    def __init__(self, t_id=None, user_id=None, product_id=None,
+                 tag=None, data=None,
+                 timestamp=None, update_timestamp=None, error=None,
+                 trace=None):
+        """See Task."""
+        self.t_id = t_id
+        self.user_id = user_id
+        self.product_id = product_id
+        self.tag = tag
+        self.timestamp = timestamp or int(time.time())
+        self.update_timestamp = update_timestamp
+        self.data = data
+        self.error = error
+        self.trace = trace
+        self.codec_state = None
+
+    @classmethod
+    def from_dict(cls, d):
+        """Creates a task from a parsed payload without running
+        `__init__()`."""
+        return cls.__new__(cls).read_dict(d)
+
+    def read_dict(self, d):
+        get = d.get
+        self.t_id = get('t_id')
+        self.user_id = get('user_id')
+        self.product_id = get('product_id')
+        self.tag = d['tag']
+        self.timestamp = d['timestamp'] or int(time.time())
+        self.update_timestamp = get('update_timestamp')
+        self.data = get('data')
+        self.error = get('error')
+        self.trace = get('trace')
+        self.codec_state = get(task_codecs.STATE_KEY)
         return self
 
-    def read_json(self, json_path):
-        with open(json_path, 'r') as f:
-            d = json.load(f)
+
+class LazyTask(Task):
+    """A task which decodes its `data` only when it is accessed, for
+    consumers which mostly look at the other fields, e.g. for routing.
+    Data which was never accessed is re-encoded as it was received, without
+    decoding and encoding it again.
+
+    This needs payloads encoded with the `lazy` codec, other payloads are
+    decoded entirely. Select both for a queue with
+    `task_codecs.register_queue(queue, codec='lazy', task_class=LazyTask)`.
+    """
+
+    @property
+    def data(self):
+        if isinstance(self._data, task_codecs.RawData):
+            self._data = self._data.decode()
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    @property
+    def data_decoded(self) -> bool:
+        return not isinstance(self._data, task_codecs.RawData)
+
+    def read_bytes(self, bytestring):
+        """Deserializes a task, leaving its data encoded if possible."""
+        d = task_codecs.decode_envelope(bytestring)
         self.read_dict(d)
         return self
 
-    def create_child(self, tag=None):
-        """Creates and returns a follow up task object."""
+    def to_bytes(self, codec='json'):
+        if (isinstance(self._data, task_codecs.RawData) and
+                self._data.codec == codec):
+            # unchanged data is passed through
+            return task_codecs.encode(self._to_dict(self._data), codec,
+                                      self.codec_state)
+        return super().to_bytes(codec)
+
+    def create_child(self, tag=None, share_data=False):
+        """Creates and returns a follow up task object, which shares the
+        data if it wasn't decoded yet, see `Task.create_child()`."""
+        if self.data_decoded:
+            return super().create_child(tag, share_data)
         if tag is None:
             tag = self.tag + '__child'
         child_task = deepcopy(self)
         child_task.tag = tag
         child_task.update_timestamp = int(time.time())
         return child_task
-
-    def __str__(self):
-        return str(self.to_dict())
-
-    def __repr__(self):
-        return self.__str__()
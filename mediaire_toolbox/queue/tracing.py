@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+"""
+Distributed tracing of tasks: the trace context travels with the Task
+(`task.trace`) from stage to stage, and the spans recorded by the daemons
+are exported to a local collector file in the OTLP/JSON format of
+OpenTelemetry, one export request per line, as read by the `otlpjsonfile`
+receiver of the OpenTelemetry collector.
+"""
+
+
+def new_trace_id() -> str:
+    return os.urandom(16).hex()
+
+
+def new_span_id() -> str:
+    return os.urandom(8).hex()
+
+
+def new_context(trace_id=None, span_id=None) -> dict:
+    """Returns a trace context for `task.trace`: the trace and the span
+    the task was emitted from (None for the first task of a trace)."""
+    return {'trace_id': trace_id or new_trace_id(), 'span_id': span_id}
+
+
+class Span(object):
+    """A timed operation within a trace."""
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_span_id', 'start',
+                 'end', 'attributes', 'error')
+
+    def __init__(self, name, trace_id, parent_span_id=None, start=None,
+                 attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_span_id = parent_span_id
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    def finish(self, end=None, error=None):
+        self.end = time.time() if end is None else end
+        if error is not None:
+            self.error = str(error)
+        return self
+
+    def to_otlp(self) -> dict:
+        span = {'traceId': self.trace_id,
+                'spanId': self.span_id,
+                'name': self.name,
+                # SPAN_KIND_INTERNAL
+                'kind': 1,
+                'startTimeUnixNano': str(int(self.start * 1e9)),
+                'endTimeUnixNano': str(int((self.end or self.start) * 1e9)),
+                'attributes': [_attribute(k, v)
+                               for k, v in self.attributes.items()]}
+        if self.parent_span_id:
+            span['parentSpanId'] = self.parent_span_id
+        if self.error is not None:
+            # STATUS_CODE_ERROR
+            span['status'] = {'code': 2, 'message': self.error[:1000]}
+        return span
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        typed = {'boolValue': value}
+    elif isinstance(value, int):
+        typed = {'intValue': str(value)}
+    elif isinstance(value, float):
+        typed = {'doubleValue': value}
+    else:
+        typed = {'stringValue': str(value)}
+    return {'key': key, 'value': typed}
+
+
+class TraceExporter(object):
+    """Appends finished spans to a local collector file.
+
+    Every export is written with a single `write()` to a file opened for
+    appending, so several processes can share the same file.
+    """
+
+    def __init__(self, path: str, service_name: str):
+        self.path = path
+        self.service_name = service_name
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _file(self):
+        # forked worker processes open their own file descriptor
+        if self._fd is None or self._pid != os.getpid():
+            self._fd = os.open(self.path,
+                               os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        return self._fd
+
+    def export(self, spans: list):
+        if not spans:
+            return
+        request = {'resourceSpans': [{
+            'resource': {'attributes': [
+                _attribute('service.name', self.service_name)]},
+            'scopeSpans': [{
+                'scope': {'name': 'mediaire_toolbox'},
+                'spans': [span.to_otlp() for span in spans]}]}]}
+        line = (json.dumps(request) + '\n').encode('utf-8')
+        try:
+            with self._lock:
+                os.write(self._file(), line)
+        except OSError:
+            logger.exception('Could not export {} spans to {}'.format(
+                len(spans), self.path))
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None and self._pid == os.getpid():
+                os.close(self._fd)
+            self._fd = None
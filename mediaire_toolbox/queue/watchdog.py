@@ -0,0 +1,88 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+"""
+Watchdog enforcing timeouts on the tasks being processed by a daemon.
+"""
+
+
+class WatchedTasks(object):
+    """The leased items and tasks being processed by one worker slot."""
+
+    def __init__(self, slot, leased, timeout):
+        self.slot = slot
+        # list of (item, task) tuples
+        self.leased = leased
+        self.timeout = timeout
+        self.deadline = time.time() + timeout
+        self.timed_out = False
+
+
+class Watchdog(object):
+    """Keeps track of the deadlines of the tasks being processed by each
+    worker slot and calls `on_timeout(watched)` from a background thread
+    for the ones which exceed them.
+
+    Ownership of the tasks is decided under a lock: once they timed out,
+    `unwatch()` returns False and the worker must not complete or error
+    them anymore, as the timeout handler already did.
+    """
+
+    INTERVAL = 0.5
+
+    def __init__(self, on_timeout, name='watchdog'):
+        self.on_timeout = on_timeout
+        self.name = name
+        self._watched = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+
+    def watch(self, slot, leased, timeout) -> WatchedTasks:
+        watched = WatchedTasks(slot, leased, timeout)
+        with self._lock:
+            self._watched[slot] = watched
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+        return watched
+
+    def unwatch(self, watched: WatchedTasks) -> bool:
+        """Stops watching the tasks, returns True if the worker still owns
+        them, i.e. they didn't time out."""
+        with self._lock:
+            if self._watched.get(watched.slot) is watched:
+                del self._watched[watched.slot]
+            return not watched.timed_out
+
+    def timed_out(self, slot) -> bool:
+        watched = self._watched.get(slot)
+        return watched is not None and watched.timed_out
+
+    def _expired(self):
+        now = time.time()
+        expired = []
+        with self._lock:
+            for watched in self._watched.values():
+                # timed out tasks stay registered until the worker
+                # returns, so that it can check for the cancellation
+                if not watched.timed_out and now >= watched.deadline:
+                    watched.timed_out = True
+                    expired.append(watched)
+        return expired
+
+    def _run(self):
+        while not self._stopped:
+            for watched in self._expired():
+                try:
+                    self.on_timeout(watched)
+                except Exception:
+                    logger.exception('Error handling task timeout')
+            time.sleep(self.INTERVAL)
+
+    def stop(self):
+        self._stopped = True
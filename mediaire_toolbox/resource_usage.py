@@ -0,0 +1,127 @@
+import os
+import resource
+
+from collections import namedtuple
+from collections.abc import MutableMapping
+
+"""
+Helpers for measuring the resource usage of the current process.
+"""
+
+
+def current_rss_bytes() -> int:
+    """Returns the current resident set size of this process in bytes.
+
+    Reads /proc/self/statm on Linux and falls back to the peak RSS reported
+    by getrusage() elsewhere.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def peak_rss_bytes() -> int:
+    """Returns the peak resident set size of this process in bytes, since
+    its start or the last `reset_peak_rss()`."""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss() -> bool:
+    """Resets the peak RSS of this process to its current RSS, returns
+    False if this isn't supported (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def thread_io_bytes() -> tuple:
+    """Returns the bytes read and written by the calling thread, including
+    the ones served by the page cache and network filesystems, or (0, 0)
+    if unknown."""
+    try:
+        read_bytes = write_bytes = 0
+        with open('/proc/thread-self/io', 'r') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    read_bytes = int(line.split()[1])
+                elif line.startswith('wchar:'):
+                    write_bytes = int(line.split()[1])
+        return read_bytes, write_bytes
+    except (OSError, ValueError, IndexError):
+        return 0, 0
+
+
+def thread_cpu_times() -> tuple:
+    """Returns the user and system CPU seconds used by the calling thread,
+    or by the whole process where per thread figures aren't available."""
+    usage = resource.getrusage(getattr(resource, 'RUSAGE_THREAD',
+                                       resource.RUSAGE_SELF))
+    return usage.ru_utime, usage.ru_stime
+
+
+TaskResources = namedtuple('TaskResources', [
+    'cpu_user', 'cpu_system', 'peak_rss_delta', 'read_bytes', 'write_bytes'])
+
+
+class ResourceMeter(object):
+    """Context manager measuring the resources used by the calling thread
+    while running its body. The result is available as `resources`, a
+    TaskResources tuple, afterwards.
+
+    CPU times and I/O bytes are per thread. The peak RSS is per process:
+    `peak_rss_delta` is how far the peak RSS rose above the RSS at the
+    start. With `reset_peak=False` (e.g. when several threads are measured
+    concurrently) or where the peak can't be reset, only increases of the
+    peak RSS of the process are visible.
+    """
+
+    def __init__(self, reset_peak=True):
+        self.reset_peak = reset_peak
+        self.resources = None
+
+    def __enter__(self):
+        self._peak_reset = self.reset_peak and reset_peak_rss()
+        self._rss = current_rss_bytes()
+        self._peak_rss = peak_rss_bytes()
+        self._cpu = thread_cpu_times()
+        self._io = thread_io_bytes()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        cpu = thread_cpu_times()
+        io = thread_io_bytes()
+        peak_rss = peak_rss_bytes()
+        if peak_rss <= self._peak_rss and not self._peak_reset:
+            peak_rss = self._rss
+        self.resources = TaskResources(
+            cpu_user=round(cpu[0] - self._cpu[0], 4),
+            cpu_system=round(cpu[1] - self._cpu[1], 4),
+            peak_rss_delta=max(0, peak_rss - self._rss),
+            read_bytes=io[0] - self._io[0],
+            write_bytes=io[1] - self._io[1])
+        return False
+
+
+def record_resources(task, resources: TaskResources, tag: str = None):
+    """Appends the resources used for processing the task with the given
+    tag (`task.tag` by default) to `task.data['resources']` as [tag,
+    cpu_user, cpu_system, peak_rss_delta, read_bytes, write_bytes] lists,
+    next to the `runtime` entries."""
+    if not isinstance(task.data, MutableMapping):
+        return
+    task.data.setdefault('resources', []).append(
+        [tag or task.tag] + list(resources))
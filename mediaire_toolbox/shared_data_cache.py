@@ -0,0 +1,229 @@
+import os
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+
+from mediaire_toolbox.queue import metrics
+
+logger = logging.getLogger(__name__)
+
+"""
+Node-local read-through cache for input files on the (network) shared data
+storage.
+"""
+
+
+def _digest(value: str) -> str:
+    return hashlib.sha224(value.encode('utf-8')).hexdigest()
+
+
+class SharedDataCache(object):
+    """Caches files read from the shared data storage on a local disk, so
+    that consecutive stages on the same node read them only once over the
+    network.
+
+    The cached files are content addressed: a file is stored once as
+    `blobs/<sha256 of its content>`, however many paths point to it. The
+    index `index/<path digest>/<version digest>` links a path in a given
+    version to its blob. The version is the one passed by the caller (e.g.
+    the transaction version) or otherwise the size and modification time of
+    the file, so a rewritten file is fetched again. `invalidate()` drops
+    all the versions of a path.
+
+    Once the blobs exceed `max_bytes`, the least recently used ones are
+    evicted down to 90% of it. Blobs used during the last `min_age_secs`
+    seconds are kept, as they may be being read. Several processes may share
+    the same cache directory, every one of them rescans it at most every
+    `RESCAN_SECS` seconds to account for the files added by the others.
+
+    Hits, misses, evictions and the bytes fetched from the shared storage
+    are counted in the `shared_data_cache_*` counters of `registry`.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+    RESCAN_SECS = 60
+
+    def __init__(self, cache_dir: str, max_bytes: int, min_age_secs=60,
+                 registry: metrics.MetricsRegistry = None):
+        """
+        Parameters
+        ----------
+        cache_dir: str
+            Local directory of the cache, created if missing
+        max_bytes: int
+            Size cap of the cached files
+        min_age_secs: float
+            Seconds after their last use during which files aren't evicted
+        registry: MetricsRegistry
+            Registry of the hit / miss counters, e.g. the one of a daemon
+        """
+        if max_bytes <= 0:
+            raise ValueError('Invalid cache size {}'.format(max_bytes))
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.min_age_secs = min_age_secs
+        self._blob_dir = os.path.join(cache_dir, 'blobs')
+        self._index_dir = os.path.join(cache_dir, 'index')
+        self._tmp_dir = os.path.join(cache_dir, 'tmp')
+        for directory in (self._blob_dir, self._index_dir, self._tmp_dir):
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        registry = registry or metrics.MetricsRegistry()
+        self._requests = registry.counter(
+            'shared_data_cache_requests',
+            'Reads through the shared data cache by outcome (hit / miss)',
+            ('outcome',))
+        self._evictions = registry.counter(
+            'shared_data_cache_evictions',
+            'Files evicted from the shared data cache')
+        self._fetched_bytes = registry.counter(
+            'shared_data_cache_fetched_bytes',
+            'Bytes fetched from the shared data storage on misses')
+        self._rescan()
+
+    def _rescan(self):
+        size = 0
+        for entry in os.scandir(self._blob_dir):
+            try:
+                size += entry.stat().st_size
+            except FileNotFoundError:
+                pass
+        self._size = size
+        self._scanned = time.time()
+
+    def _index_path(self, path, version):
+        if version is None:
+            stat = os.stat(path)
+            version = '{}-{}'.format(stat.st_size, stat.st_mtime_ns)
+        return os.path.join(self._index_dir, _digest(os.path.abspath(path)),
+                            _digest(str(version)))
+
+    def get(self, path: str, version=None) -> str:
+        """Returns the path of a local copy of the file, fetching it from
+        the shared storage on a miss.
+
+        Parameters
+        ----------
+        path: str
+            Path of the file on the shared storage
+        version:
+            Version of the file, e.g. of its transaction. If None, the size
+            and modification time of the file are used, which costs a stat
+            on the shared storage on every call.
+        """
+        index_path = self._index_path(path, version)
+        try:
+            blob_path = os.path.join(os.path.dirname(index_path),
+                                     os.readlink(index_path))
+            # marks the blob as recently used
+            os.utime(blob_path)
+            self._requests.inc(outcome='hit')
+            return blob_path
+        except FileNotFoundError:
+            # not cached, or the blob was evicted
+            pass
+        self._requests.inc(outcome='miss')
+        blob_path = self._fetch(path)
+        link = os.path.join(self._tmp_dir, uuid.uuid4().hex)
+        os.symlink(os.path.relpath(blob_path, os.path.dirname(index_path)),
+                   link)
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        os.replace(link, index_path)
+        return blob_path
+
+    def open(self, path: str, mode='rb', version=None):
+        """Opens a local copy of the file for reading, see `get()`."""
+        if any(c in mode for c in 'wax+'):
+            raise ValueError('The shared data cache is read only')
+        try:
+            return open(self.get(path, version), mode)
+        except FileNotFoundError:
+            if not os.path.exists(path):
+                raise
+            # evicted in the meantime by another process
+            return open(self.get(path, version), mode)
+
+    def _fetch(self, path):
+        sha256 = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir)
+        try:
+            with open(path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+                for chunk in iter(lambda: src.read(self.CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+                    dst.write(chunk)
+                size = dst.tell()
+            blob_path = os.path.join(self._blob_dir, sha256.hexdigest())
+            if os.path.exists(blob_path):
+                # same content already cached for another path
+                os.unlink(tmp_path)
+                os.utime(blob_path)
+            else:
+                os.replace(tmp_path, blob_path)
+                with self._lock:
+                    self._size += size
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self._fetched_bytes.inc(size)
+        if (self._size > self.max_bytes or
+                time.time() - self._scanned > self.RESCAN_SECS):
+            self._evict()
+        return blob_path
+
+    def _evict(self):
+        with self._lock:
+            self._rescan()
+            if self._size <= self.max_bytes:
+                return
+            blobs = []
+            for entry in os.scandir(self._blob_dir):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, entry.path))
+            blobs.sort()
+            recent = time.time() - self.min_age_secs
+            target = self.max_bytes * 0.9
+            for mtime, size, blob_path in blobs:
+                if self._size <= target or mtime > recent:
+                    break
+                try:
+                    os.unlink(blob_path)
+                except FileNotFoundError:
+                    pass
+                self._size -= size
+                self._evictions.inc()
+            self._remove_dangling_links()
+            logger.debug('Evicted shared data cache down to {} bytes'
+                         .format(self._size))
+
+    def _remove_dangling_links(self):
+        for path_dir in os.scandir(self._index_dir):
+            for link in os.scandir(path_dir.path):
+                if not os.path.exists(link.path):
+                    try:
+                        os.unlink(link.path)
+                    except FileNotFoundError:
+                        pass
+
+    def invalidate(self, path: str):
+        """Drops all the cached versions of the file. Its blob is evicted
+        eventually unless the content is cached for another path."""
+        shutil.rmtree(os.path.join(self._index_dir,
+                                   _digest(os.path.abspath(path))),
+                      ignore_errors=True)
+
+    def stats(self) -> dict:
+        """Returns the hits, misses, evictions and fetched bytes of this
+        process and the size of the cached files."""
+        return {'hits': self._requests.get(outcome='hit'),
+                'misses': self._requests.get(outcome='miss'),
+                'evictions': self._evictions.get(),
+                'fetched_bytes': self._fetched_bytes.get(),
+                'size_bytes': self._size}
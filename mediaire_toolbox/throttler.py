@@ -1,11 +1,20 @@
 import time
+import uuid
 import heapq
+import asyncio
+import threading
+from collections import deque, OrderedDict
 from _thread import RLock
 
 """
 A thread-safe simple class for throttling, configured to allow
 X events per every Y seconds. When calling the method throttle(),
 throttling will occur if needed (the method will block).
+
+Variants: SlidingWindowThrottler (exact, waits without polling),
+TokenBucketThrottler (bursts and weighted events), KeyedThrottler (one
+limit per key), AsyncThrottler (asyncio) and RedisThrottler (one limit
+shared by several processes).
 """
 
 
@@ -47,3 +56,365 @@ class Throttler():
             heapq.heappush(self.events, int(time.time()))
         finally:
             self.lock.release()
+
+
+class SlidingWindowThrottler():
+    """Throttler with the same API and limits as Throttler, but exact and
+    cheaper under contention.
+
+    The times of the last `max_events` events are kept on the monotonic
+    clock in a deque. A caller reserves the earliest free slot (the time
+    at which the oldest of them leaves the window, or now) in O(1) under
+    the lock, and then sleeps until that slot without holding the lock, so
+    that other threads can reserve the following slots meanwhile. Waiting
+    callers are served in the order of their calls.
+    """
+
+    def __init__(self, max_events: int, per_every_seconds=60):
+        if max_events < 1:
+            raise ValueError('max_events must be at least 1')
+        self.max_events = max_events
+        self.per_every_seconds = per_every_seconds
+        # monotonic times of the last events, including reserved ones
+        self.events = deque(maxlen=max_events)
+        self.lock = threading.Lock()
+
+    def _expire(self, now):
+        window_start = now - self.per_every_seconds
+        while self.events and self.events[0] <= window_start:
+            self.events.popleft()
+
+    def current_rate(self) -> int:
+        """Number of events in the current window, including the ones
+        reserved by waiting callers."""
+        with self.lock:
+            self._expire(time.monotonic())
+            return len(self.events)
+
+    def reserve(self) -> float:
+        """Reserves the next free slot and returns the number of seconds
+        until it, without waiting."""
+        with self.lock:
+            now = time.monotonic()
+            self._expire(now)
+            if len(self.events) < self.max_events:
+                slot = now
+            else:
+                slot = self.events[0] + self.per_every_seconds
+            self.events.append(slot)
+        return slot - now
+
+    def is_idle(self) -> bool:
+        """Whether all the events, including the reserved ones, have left
+        the window, i.e. whether the throttler can be dropped without
+        loosening the limit."""
+        with self.lock:
+            return not self.events or \
+                self.events[-1] <= time.monotonic() - self.per_every_seconds
+
+    def throttle(self):
+        """Blocks until the event may happen."""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+
+class TokenBucketThrottler():
+    """Throttler where events have a cost, e.g. the size of an export, and
+    bursts of up to `burst` are allowed.
+
+    The bucket holds up to `burst` tokens (by default `max_events`) and is
+    refilled continuously with `max_events` tokens per every
+    `per_every_seconds`. An event of cost `n` takes `n` tokens. A caller
+    which finds too few tokens takes them anyway, leaving the bucket in
+    debt, and sleeps until the debt is paid off, without holding the lock:
+    the callers are served in the order of their calls, and the events are
+    spread evenly once the burst is used up instead of bunching at the
+    boundaries of the windows.
+    """
+
+    def __init__(self, max_events: int, per_every_seconds=60, burst=None):
+        """
+        Parameters
+        ----------
+        max_events: int
+            Tokens refilled per every `per_every_seconds`
+        per_every_seconds: float
+            Refill period
+        burst: float
+            Capacity of the bucket, `max_events` by default. A smaller
+            burst smoothes the events.
+        """
+        if max_events <= 0:
+            raise ValueError('max_events must be positive')
+        burst = max_events if burst is None else burst
+        if burst <= 0:
+            raise ValueError('burst must be positive')
+        self.rate = max_events / per_every_seconds
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self) -> float:
+        """Tokens currently in the bucket, negative while in debt."""
+        with self.lock:
+            self._refill(time.monotonic())
+            return self.tokens
+
+    def reserve(self, cost=1) -> float:
+        """Takes `cost` tokens and returns the number of seconds until the
+        event may happen, without waiting."""
+        if cost > self.burst:
+            raise ValueError('Cost {} exceeds the burst capacity {}'
+                             .format(cost, self.burst))
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= cost
+            return max(0, -self.tokens / self.rate)
+
+    def throttle(self, cost=1):
+        """Blocks until the event of the given cost may happen."""
+        wait = self.reserve(cost)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class KeyedThrottler():
+    """Throttles every key (e.g. a destination AE title, or the `user_id`
+    of a task) separately, with a SlidingWindowThrottler each.
+
+    Keys use the default limit unless another one is configured for them
+    in `limits` or with `set_limit()`. The throttlers are created on first
+    use and kept in least recently used order: the idle ones (see
+    `SlidingWindowThrottler.is_idle()`) are evicted on every call, and the
+    least recently used ones beyond `max_keys` even if they aren't idle,
+    which bounds the memory but loosens their limit.
+    """
+
+    def __init__(self, max_events: int, per_every_seconds=60, limits=None,
+                 max_keys=10000):
+        """
+        Parameters
+        ----------
+        max_events: int
+            Default number of events allowed per every `per_every_seconds`
+        per_every_seconds: float
+            Default length of the window
+        limits: dict
+            key -> (max_events, per_every_seconds) of the keys with other
+            limits than the default
+        max_keys: int
+            Maximum number of throttlers kept
+        """
+        if max_keys < 1:
+            raise ValueError('max_keys must be at least 1')
+        self.default_limit = (max_events, per_every_seconds)
+        self.limits = dict(limits or {})
+        self.max_keys = max_keys
+        # key -> SlidingWindowThrottler, least recently used first
+        self._throttlers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set_limit(self, key, max_events: int, per_every_seconds=60):
+        """Changes the limit of a key, its past events are forgotten."""
+        with self._lock:
+            self.limits[key] = (max_events, per_every_seconds)
+            self._throttlers.pop(key, None)
+
+    def _throttler(self, key):
+        throttler = self._throttlers.get(key)
+        if throttler is None:
+            throttler = SlidingWindowThrottler(
+                *self.limits.get(key, self.default_limit))
+            self._throttlers[key] = throttler
+        else:
+            self._throttlers.move_to_end(key)
+        return throttler
+
+    def _evict(self):
+        while len(self._throttlers) > 1:
+            oldest = next(iter(self._throttlers.values()))
+            if len(self._throttlers) <= self.max_keys and \
+                    not oldest.is_idle():
+                break
+            self._throttlers.popitem(last=False)
+
+    def __len__(self):
+        return len(self._throttlers)
+
+    def current_rate(self, key) -> int:
+        """Number of events of a key in its current window."""
+        with self._lock:
+            throttler = self._throttlers.get(key)
+        return throttler.current_rate() if throttler is not None else 0
+
+    def reserve(self, key) -> float:
+        """Reserves the next free slot of the key and returns the number of
+        seconds until it, without waiting."""
+        with self._lock:
+            # reserved under the lock, so that the throttler can't be
+            # evicted as idle in between
+            wait = self._throttler(key).reserve()
+            self._evict()
+        return wait
+
+    def throttle(self, key):
+        """Blocks until the event of the key may happen."""
+        wait = self.reserve(key)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AsyncThrottler():
+    """asyncio variant of SlidingWindowThrottler, for coroutines sharing a
+    limit without blocking the event loop:
+
+        await throttler.throttle()
+
+    or
+
+        async with throttler:
+            ...
+
+    The waiting coroutines are queued and released in FIFO order by a
+    single timer scheduled on the event loop for the next free slot, so
+    there is no polling however many are waiting. A throttler must only be
+    used from one event loop.
+    """
+
+    def __init__(self, max_events: int, per_every_seconds=60):
+        if max_events < 1:
+            raise ValueError('max_events must be at least 1')
+        self.max_events = max_events
+        self.per_every_seconds = per_every_seconds
+        # event loop times of the last events
+        self.events = deque(maxlen=max_events)
+        self._waiters = deque()
+        self._timer = None
+
+    def _next_slot(self, now):
+        if len(self.events) < self.max_events:
+            return now
+        return max(now, self.events[0] + self.per_every_seconds)
+
+    def _schedule(self, loop):
+        if self._timer is None and self._waiters:
+            self._timer = loop.call_at(self._next_slot(loop.time()),
+                                       self._release, loop)
+
+    def _release(self, loop):
+        self._timer = None
+        now = loop.time()
+        while self._waiters and self._next_slot(now) <= now:
+            waiter = self._waiters.popleft()
+            # skips the cancelled waiters
+            if not waiter.done():
+                waiter.set_result(None)
+                self.events.append(now)
+        self._schedule(loop)
+
+    def current_rate(self) -> int:
+        """Number of events in the current window of the event loop."""
+        window_start = asyncio.get_event_loop().time() - \
+            self.per_every_seconds
+        return sum(1 for t in self.events if t > window_start)
+
+    async def throttle(self):
+        """Waits until the event may happen."""
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        if not self._waiters and self._next_slot(now) <= now:
+            self.events.append(now)
+            return
+        waiter = loop.create_future()
+        self._waiters.append(waiter)
+        self._schedule(loop)
+        await waiter
+
+    async def __aenter__(self):
+        await self.throttle()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+class RedisThrottler():
+    """Throttler shared through Redis by all the processes using the same
+    `name`, e.g. all the replicas talking to the same PACS.
+
+    Like SlidingWindowThrottler, it allows up to `max_events` events in any
+    window of `per_every_seconds`. The times of the last `max_events`
+    events are kept in a sorted set and the next slot is reserved by a Lua
+    script, atomically on the Redis server and on its clock. The sorted set
+    expires when the throttler is idle.
+
+    A call reserves the next slot and returns the exact time until it, so
+    the callers sleep only as long as needed and are served in the order in
+    which they reached Redis.
+    """
+
+    # returns the microseconds until the reserved slot
+    SCRIPT = """
+redis.replicate_commands()
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000000 + tonumber(time[2])
+local period = tonumber(ARGV[1])
+local max_events = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - period)
+local slot = now
+if redis.call('ZCARD', KEYS[1]) >= max_events then
+    local oldest = redis.call('ZRANGE', KEYS[1], -max_events, -max_events,
+                              'WITHSCORES')
+    slot = math.max(now, tonumber(oldest[2]) + period)
+end
+redis.call('ZADD', KEYS[1], slot, ARGV[3])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -max_events - 1)
+redis.call('PEXPIRE', KEYS[1], math.ceil((slot + period - now) / 1000))
+return slot - now
+"""
+
+    def __init__(self, db, name: str, max_events: int, per_every_seconds=60,
+                 prefix='throttler'):
+        """
+        Parameters
+        ----------
+        db:
+            A redis.StrictRedis instance
+        name: str
+            Name of the limit, shared by all its throttlers
+        max_events: int
+            Number of events allowed per every `per_every_seconds`
+        per_every_seconds: float
+            Length of the window
+        prefix: str
+            Prefix of the Redis key of the limit
+        """
+        if max_events < 1:
+            raise ValueError('max_events must be at least 1')
+        self.max_events = max_events
+        self.per_every_seconds = per_every_seconds
+        self.key = '{}:{}'.format(prefix, name)
+        self._period_us = int(per_every_seconds * 1000000)
+        self._script = db.register_script(self.SCRIPT)
+
+    def reserve(self) -> float:
+        """Reserves the next free slot and returns the number of seconds
+        until it, without waiting."""
+        # events are identified uniquely, several may share the same time
+        wait_us = self._script(keys=[self.key],
+                               args=[self._period_us, self.max_events,
+                                     uuid.uuid4().hex])
+        return int(wait_us) / 1000000
+
+    def throttle(self):
+        """Blocks until the event may happen."""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,192 @@
+import fnmatch
+import queue
+import threading
+import time
+
+
+class FakePipeline():
+    """Buffers the commands and runs them against the fake on execute()"""
+
+    def __init__(self, db):
+        self.db = db
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((getattr(self.db, name), args, kwargs))
+            return self
+        return command
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [f(*args, **kwargs) for f, args, kwargs in commands]
+
+
+class FakePubSub():
+
+    def __init__(self, db):
+        self.db = db
+        self.handlers = {}
+        self.messages = queue.Queue()
+
+    def subscribe(self, **handlers):
+        self.handlers.update(handlers)
+        with self.db.lock:
+            self.db.subscribers.append(self)
+
+    def get_message(self, timeout=0):
+        try:
+            channel, data = self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self.handlers[channel]({'type': 'message', 'channel': channel,
+                                'data': data})
+
+    def close(self):
+        with self.db.lock:
+            self.db.subscribers.remove(self)
+
+
+class FakeRedis():
+    """A small in-memory stand-in for redis.StrictRedis"""
+
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+        self.subscribers = []
+        self.lock = threading.RLock()
+
+    def _expire_keys(self):
+        now = time.time()
+        for key, when in list(self.expiry.items()):
+            if when <= now:
+                self.data.pop(key, None)
+                del self.expiry[key]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self)
+
+    def publish(self, channel, data):
+        data = data if isinstance(data, bytes) else str(data).encode()
+        with self.lock:
+            subscribers = [s for s in self.subscribers
+                           if channel in s.handlers]
+        for subscriber in subscribers:
+            subscriber.messages.put((channel, data))
+        return len(subscribers)
+
+    def exists(self, key):
+        with self.lock:
+            self._expire_keys()
+            return int(key in self.data)
+
+    def get(self, key):
+        with self.lock:
+            self._expire_keys()
+            value = self.data.get(key)
+            if isinstance(value, (int, float)):
+                return str(value).encode()
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.expiry.pop(key, None)
+
+    def setex(self, key, secs, value):
+        with self.lock:
+            self.data[key] = value
+            self.expiry[key] = time.time() + secs
+
+    def expire(self, key, secs):
+        with self.lock:
+            self.expiry[key] = time.time() + secs
+
+    def ttl(self, key):
+        with self.lock:
+            self._expire_keys()
+            if key not in self.data:
+                return -2
+            if key not in self.expiry:
+                return -1
+            return int(self.expiry[key] - time.time())
+
+    def incr(self, key):
+        with self.lock:
+            self._expire_keys()
+            self.data[key] = int(self.data.get(key, 0)) + 1
+            return self.data[key]
+
+    def delete(self, *keys):
+        with self.lock:
+            removed = 0
+            for key in keys:
+                removed += int(self.data.pop(key, None) is not None)
+                self.expiry.pop(key, None)
+            return removed
+
+    def lpush(self, key, *values):
+        with self.lock:
+            lst = self.data.setdefault(key, [])
+            for value in values:
+                lst.insert(0, value)
+            return len(lst)
+
+    def rpush(self, key, *values):
+        with self.lock:
+            lst = self.data.setdefault(key, [])
+            lst.extend(values)
+            return len(lst)
+
+    def llen(self, key):
+        with self.lock:
+            return len(self.data.get(key, []))
+
+    def lindex(self, key, index):
+        with self.lock:
+            lst = self.data.get(key, [])
+            try:
+                return lst[index]
+            except IndexError:
+                return None
+
+    def lrange(self, key, start, end):
+        with self.lock:
+            lst = self.data.get(key, [])
+            return list(lst[start:] if end == -1 else lst[start:end + 1])
+
+    def lrem(self, key, count, value):
+        with self.lock:
+            lst = self.data.get(key, [])
+            removed = 0
+            while value in lst and (count == 0 or removed < count):
+                lst.remove(value)
+                removed += 1
+            return removed
+
+    def rpoplpush(self, src, dst):
+        with self.lock:
+            lst = self.data.get(src)
+            if not lst:
+                return None
+            value = lst.pop()
+            self.data.setdefault(dst, []).insert(0, value)
+            return value
+
+    def brpoplpush(self, src, dst, timeout=0):
+        deadline = time.time() + (timeout or 0)
+        while True:
+            value = self.rpoplpush(src, dst)
+            if value is not None or (timeout and time.time() >= deadline):
+                return value
+            time.sleep(0.01)
+
+    def scan_iter(self, match=None, count=None):
+        with self.lock:
+            keys = list(self.data)
+        for key in keys:
+            if match is None or fnmatch.fnmatchcase(key, match):
+                yield key.encode('utf-8')
@@ -0,0 +1,60 @@
+import time
+import unittest
+
+from fake_redis import FakeRedis
+from mediaire_toolbox.queue.cancellation import CancellationSignal
+
+
+class TestCancellationSignal(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeRedis()
+        self.signal = CancellationSignal(self.db, poll_secs=60)
+        self.other = CancellationSignal(self.db, poll_secs=60)
+
+    def tearDown(self):
+        self.signal.stop()
+        self.other.stop()
+
+    def _wait_for(self, condition):
+        start = time.time()
+        while not condition() and time.time() - start < 5:
+            time.sleep(0.01)
+
+    def test_request_cancel(self):
+        self.assertFalse(self.signal.is_cancelled(1))
+        self.assertFalse(self.other.is_cancelled(1))
+        self.signal.request_cancel(1)
+
+        self.assertTrue(self.signal.is_cancelled(1))
+        self.assertEqual(1, self.db.exists('cancellations:1'))
+        # the negative result is cached for poll_secs
+        self.assertFalse(self.other.is_cancelled(1))
+        self.other.poll_secs = 0
+        self.assertTrue(self.other.is_cancelled(1))
+
+    def test_no_t_id(self):
+        self.assertFalse(self.signal.is_cancelled(None))
+
+    def test_listen(self):
+        self.assertFalse(self.other.is_cancelled(2))
+        self.other.listen(sleep_time=0.01)
+        self.signal.request_cancel(2)
+        self._wait_for(lambda: self.other.is_cancelled(2))
+        self.assertTrue(self.other.is_cancelled(2))
+
+        self.signal.clear(2)
+        self._wait_for(lambda: not self.other.is_cancelled(2))
+        self.assertFalse(self.other.is_cancelled(2))
+        self.assertFalse(self.signal.is_cancelled(2))
+
+    def test_listen_checks_earlier_cancellations(self):
+        self.signal.request_cancel(3)
+        self.other.listen(sleep_time=0.01)
+        self.assertTrue(self.other.is_cancelled(3))
+
+    def test_cache_size(self):
+        self.signal.CACHE_SIZE = 2
+        for t_id in range(1, 4):
+            self.signal.is_cancelled(t_id)
+        self.assertEqual([2, 3], list(self.signal._cache))
@@ -0,0 +1,99 @@
+import unittest
+
+from mediaire_toolbox.queue.chain import ChainDaemon
+from mediaire_toolbox.queue.daemon import QueueDaemon
+from mediaire_toolbox.queue.redis_wq import RedisWQ
+from mediaire_toolbox.queue.tasks import Task
+
+
+class StageA(QueueDaemon):
+
+    def process_task(self, task):
+        child = task.create_child('b')
+        child.data['a'] = True
+        self.emit(child)
+
+
+class StageB(QueueDaemon):
+
+    def process_task(self, task):
+        if task.data.get('fail_b'):
+            raise Exception('B fails')
+        child = task.create_child('done')
+        child.data['b'] = True
+        # stages putting serialized tasks themselves are chained as well
+        self.result_queue.put(child.to_bytes())
+
+
+class MockQueue(RedisWQ):
+
+    def __init__(self, name):
+        super().__init__(name, None)
+        self.put_items = []
+        self.completed = []
+        self.errors = []
+
+    def lease(self, lease_secs=5, block=True, timeout=None,
+              limit=-1, timeunit='hour'):
+        return self.item
+
+    def put(self, item):
+        self.put_items.append(item)
+
+    def complete(self, item):
+        self.completed.append(item)
+
+    def error(self, item, msg=None):
+        self.errors.append(msg)
+
+
+class TestChainDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.input_queue = MockQueue('input')
+        self.result_queue = MockQueue('result')
+        self.stage_a = StageA(None, None, 60, 'stage_a', {})
+        self.stage_b = StageB(None, None, 60, 'stage_b', {})
+        self.chain = ChainDaemon(self.input_queue, self.result_queue, 60,
+                                 'chain', {},
+                                 [('a', self.stage_a), ('b', self.stage_b)])
+
+    def test_chain(self):
+        self.input_queue.item = Task(t_id=1, tag='a', data={}).to_bytes()
+        self.chain.run_once()
+
+        self.assertEqual([self.input_queue.item], self.input_queue.completed)
+        self.assertEqual(1, len(self.result_queue.put_items))
+        result = Task().read_bytes(self.result_queue.put_items[0])
+        self.assertEqual('done', result.tag)
+        self.assertEqual({'a': True, 'b': True}, result.data)
+        for stage, tag in (('stage_a', 'a'), ('stage_b', 'b')):
+            self.assertEqual(1, self.chain.tasks_counter.get(
+                daemon=stage, tag=tag, outcome='success'))
+            self.assertEqual(1, self.chain.process_seconds.get_count(
+                daemon=stage, tag=tag))
+
+    def test_chain_stage_error(self):
+        self.input_queue.item = Task(t_id=1, tag='a',
+                                     data={'fail_b': True}).to_bytes()
+        self.chain.run_once()
+
+        self.assertEqual([self.input_queue.item], self.input_queue.completed)
+        result = Task().read_bytes(self.result_queue.put_items[0])
+        self.assertEqual('b', result.tag)
+        self.assertIn('B fails', result.error)
+        self.assertEqual(1, self.chain.tasks_counter.get(
+            daemon='stage_b', tag='b', outcome='failure'))
+
+    def test_chain_stage_error_without_t_id(self):
+        self.input_queue.item = Task(tag='a',
+                                     data={'fail_b': True}).to_bytes()
+        self.chain.run_once()
+
+        self.assertEqual([], self.input_queue.completed)
+        self.assertEqual([], self.result_queue.put_items)
+        self.assertIn('B fails', self.input_queue.errors[0])
+
+    def test_chain_without_stages(self):
+        self.assertRaises(ValueError, ChainDaemon, self.input_queue,
+                          self.result_queue, 60, 'chain', {}, [])
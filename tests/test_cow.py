@@ -0,0 +1,82 @@
+import unittest
+
+from copy import deepcopy
+
+from mediaire_toolbox.queue.cow import CowDict, fork, materialize
+
+
+class TestCowDict(unittest.TestCase):
+
+    def setUp(self):
+        self.base = {'a': 1,
+                     'header': {'PatientName': 'Max', 'nested': {'x': 1}},
+                     'runtime': [['stage_1', 1]]}
+        self.original = deepcopy(self.base)
+
+    def test_reads_through(self):
+        view = CowDict(self.base)
+        self.assertEqual(1, view['a'])
+        self.assertEqual('Max', view['header']['PatientName'])
+        self.assertEqual(3, len(view))
+        self.assertIn('header', view)
+        self.assertEqual(self.base, view)
+        self.assertEqual(self.base, view.to_dict())
+
+    def test_writes_stay_in_layer(self):
+        view = CowDict(self.base)
+        view['a'] = 2
+        view['b'] = 3
+        view['header']['nested']['x'] = 2
+        view['runtime'].append(['stage_2', 1])
+        del view['header']['PatientName']
+
+        self.assertEqual(self.original, self.base)
+        self.assertEqual({'a': 2, 'b': 3,
+                          'header': {'nested': {'x': 2}},
+                          'runtime': [['stage_1', 1], ['stage_2', 1]]},
+                         view.to_dict())
+
+    def test_delete(self):
+        view = CowDict(self.base)
+        del view['a']
+        self.assertNotIn('a', view)
+        self.assertRaises(KeyError, view.__getitem__, 'a')
+        self.assertRaises(KeyError, view.__delitem__, 'a')
+        view['a'] = 5
+        self.assertEqual(5, view['a'])
+        self.assertEqual(['a', 'header', 'runtime'], sorted(view))
+
+    def test_fork_isolates_both_sides(self):
+        parent, child = fork(self.base)
+        child['header']['PatientName'] = 'Moritz'
+        parent['a'] = 2
+        self.assertEqual('Max', parent['header']['PatientName'])
+        self.assertEqual(1, child['a'])
+        self.assertEqual(self.original, self.base)
+
+    def test_fork_other_values(self):
+        data = ['a']
+        parent, child = fork(data)
+        child.append('b')
+        self.assertEqual(['a'], parent)
+        self.assertEqual((None, None), fork(None))
+
+    def test_depth_is_bounded(self):
+        view = CowDict(self.base)
+        for i in range(3 * CowDict.MAX_DEPTH):
+            view = CowDict(view)
+            view['a'] = i
+        self.assertLess(view._depth, CowDict.MAX_DEPTH)
+        self.assertEqual(3 * CowDict.MAX_DEPTH - 1, view['a'])
+        self.assertEqual(self.original, self.base)
+
+    def test_materialize(self):
+        view = CowDict(self.base)
+        value = materialize({'views': [view, CowDict({'b': 1})]})
+        self.assertEqual({'views': [self.base, {'b': 1}]}, value)
+        self.assertIs(dict, type(value['views'][0]['header']))
+        self.assertIs(dict, type(deepcopy(view)))
+
+
+if __name__ == '__main__':
+    unittest.main()
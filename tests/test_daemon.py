@@ -1,7 +1,17 @@
+import os
+import json
 import unittest
 import tempfile
 import shutil
+import signal
+import threading
+import time
 
+from unittest.mock import MagicMock, patch
+
+from fake_redis import FakeRedis
+from mediaire_toolbox.queue import task_codecs
+from mediaire_toolbox.queue.cancellation import CancellationSignal
 from mediaire_toolbox.queue.daemon import QueueDaemon
 from mediaire_toolbox.queue.redis_wq import RedisWQ
 from mediaire_toolbox.queue.tasks import Task
@@ -19,6 +29,113 @@ class FooFailingDaemon(QueueDaemon):
         raise Exception("I fail")
 
 
+class FooPoolDaemon(QueueDaemon):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+        self.processed = []
+
+    def process_task(self, task):
+        with self.lock:
+            self.processed.append((self.slot, self.processing_t_id))
+            if len(self.processed) >= 6:
+                self.stop()
+
+
+class FooProcessPoolDaemon(QueueDaemon):
+
+    def process_task(self, task):
+        open(os.path.join(self.config['data_dir'],
+                          'slot-{}'.format(self.slot)), 'a').close()
+        self.stop()
+
+
+class FooEmittingDaemon(QueueDaemon):
+
+    def process_task(self, task):
+        self.emit(task.create_child('next'))
+
+
+class FooStoppingDaemon(QueueDaemon):
+
+    def process_task(self, task):
+        time.sleep(0.05)
+        if len(self.input_queue.completed_items) >= 1:
+            self.stop()
+
+
+class FooBatchDaemon(QueueDaemon):
+
+    def process_task(self, task):
+        raise Exception("Should process in batches")
+
+    def process_tasks(self, tasks):
+        self.batches = getattr(self, 'batches', []) + [
+            [task.t_id for task in tasks]]
+        return [Exception("I fail") if task.t_id == 2 else None
+                for task in tasks]
+
+
+class FooRecyclingDaemon(QueueDaemon):
+
+    def setup(self):
+        self.setup_calls = getattr(self, 'setup_calls', 0) + 1
+        self.model = {'setup_pid': os.getpid()}
+
+    def process_task(self, task):
+        data_dir = self.config['data_dir']
+        with open(os.path.join(data_dir, str(os.getpid())), 'w') as f:
+            f.write(str(self.model['setup_pid']))
+        if len(os.listdir(data_dir)) >= 3:
+            self.stop()
+
+
+class FooHangingDaemon(QueueDaemon):
+
+    def process_task(self, task):
+        data_dir = self.config.get('data_dir')
+        if data_dir:
+            open(os.path.join(data_dir, str(os.getpid())), 'a').close()
+            if len(os.listdir(data_dir)) >= 2:
+                self.stop()
+                return
+            time.sleep(30)
+        start = time.time()
+        while not self.task_timed_out() and time.time() - start < 5:
+            time.sleep(0.01)
+        self.noticed_timeout = self.task_timed_out()
+
+
+class FooLateEmittingDaemon(QueueDaemon):
+
+    def process_task(self, task):
+        start = time.time()
+        while not self.task_timed_out() and time.time() - start < 5:
+            time.sleep(0.01)
+        self.emit(task.create_child('next'))
+
+
+class FooFreezingDaemon(QueueDaemon):
+
+    def process_task(self, task):
+        data_dir = self.config['data_dir']
+        open(os.path.join(data_dir, str(os.getpid())), 'a').close()
+        if len(os.listdir(data_dir)) >= 2:
+            self.stop()
+        else:
+            # no thread of the worker process can run anymore, as if it
+            # was stuck in C code holding the GIL
+            os.kill(os.getpid(), signal.SIGSTOP)
+
+
+class FooCancellableDaemon(QueueDaemon):
+
+    def process_task(self, task):
+        self.processed = True
+        self.cancelled = self.is_cancelled()
+
+
 class MockQueue(RedisWQ):
 
     def __init__(self):
@@ -28,6 +145,7 @@ class MockQueue(RedisWQ):
                                     data={'t1': 'foo', 't2': 'bar', 'out': 'foo'}).to_bytes()
         self.completed = False
         self.error_msg = None
+        self.put_items = []
 
     def lease(self, lease_secs=5, block=True, timeout=None,
               limit=-1, timeunit='hour'):
@@ -38,11 +156,47 @@ class MockQueue(RedisWQ):
 
     def put(self, item):
         self.put_item = item
+        self.put_items.append(item)
 
     def complete(self, item):
         if item == self.serialized_task:
             self.completed = True
 
+    def extend_lease(self, item, lease_secs):
+        pass
+
+    def release(self, item):
+        self.released = item
+
+
+class MockListQueue(MockQueue):
+
+    def __init__(self, n_items):
+        super().__init__()
+        self.items = [Task(t_id=i, tag='tag').to_bytes()
+                      for i in range(1, n_items + 1)]
+        self.completed_items = []
+        self.extended = []
+        self.lock = threading.Lock()
+
+    def lease(self, lease_secs=5, block=True, timeout=None,
+              limit=-1, timeunit='hour'):
+        with self.lock:
+            if self.items:
+                return self.items.pop(0)
+        time.sleep(0.01)
+        return None
+
+    def complete(self, item):
+        self.completed_items.append(item)
+
+    def extend_lease(self, item, lease_secs):
+        self.extended.append(item)
+
+    def release(self, item):
+        with self.lock:
+            self.items.insert(0, item)
+
 
 class TestDaemon(unittest.TestCase):
 
@@ -59,6 +213,11 @@ class TestDaemon(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.data_dir)
 
+    def _wait_for(self, condition):
+        start = time.time()
+        while not condition() and time.time() - start < 5:
+            time.sleep(0.01)
+
     def test_daemon_process_ok(self):
         self.foo_daemon.run_once()
 
@@ -87,3 +246,448 @@ class TestDaemon(unittest.TestCase):
         self.assertFalse(self.input_queue.error_msg)
         self.assertTrue(self.result_queue.put_item and
                         Task().read_bytes(self.result_queue.put_item).error)
+
+    def test_daemon_thread_pool(self):
+        daemon = FooPoolDaemon(self.input_queue, self.result_queue,
+                               60 * 30, 'foo',
+                               {'pool_size': 3, 'pool_mode': 'thread'})
+        daemon.run()
+
+        self.assertGreaterEqual(len(daemon.processed), 6)
+        self.assertTrue(all(t_id == 1 for _, t_id in daemon.processed))
+        self.assertTrue(all(0 <= slot < 3 for slot, _ in daemon.processed))
+        self.assertEqual({}, daemon.processing_t_ids)
+
+    def test_daemon_process_pool(self):
+        daemon = FooProcessPoolDaemon(self.input_queue, self.result_queue,
+                                      60 * 30, 'foo',
+                                      {'data_dir': self.data_dir,
+                                       'pool_size': 2,
+                                       'pool_mode': 'process'})
+        daemon.run()
+
+        self.assertEqual(['slot-0', 'slot-1'],
+                         sorted(os.listdir(self.data_dir)))
+
+    def test_daemon_invalid_pool_mode(self):
+        self.assertRaises(ValueError, FooDaemon, self.input_queue,
+                          self.result_queue, 60, 'foo',
+                          {'pool_size': 2, 'pool_mode': 'fiber'})
+
+    def test_exit_gracefully_pool_cancels_in_flight(self):
+        daemon = FooDaemon(self.input_queue, self.result_queue,
+                           60 * 30, 'foo', {'pool_size': 2})
+        daemon.cancellation = CancellationSignal(FakeRedis())
+        daemon.processing_t_ids = {0: 5, 1: 7}
+        with patch('mediaire_toolbox.queue.daemon.ASSUMED_SHARED_DATA',
+                   self.data_dir):
+            daemon.exit_gracefully(None, None)
+
+        self.assertTrue(daemon.stopped)
+        self.assertEqual(['cancel-5', 'cancel-7'],
+                         sorted(os.listdir(self.data_dir)))
+
+    def test_daemon_prefetch_returns_items_on_stop(self):
+        queue = MockListQueue(6)
+        all_items = list(queue.items)
+        daemon = FooStoppingDaemon(queue, queue, 1, 'foo',
+                                   {'prefetch': 2, 'lease_timeout': 0.1})
+        daemon.run()
+
+        self.assertEqual(all_items[:2], queue.completed_items)
+        # prefetched items are back at the head in their original order
+        self.assertEqual(all_items[2:], queue.items)
+        self.assertEqual(0, len(daemon._prefetched))
+
+    def test_exit_gracefully_returns_prefetched_items(self):
+        queue = MockListQueue(4)
+        all_items = list(queue.items)
+        release = threading.Event()
+        daemon = FooDaemon(queue, queue, 1, 'foo',
+                           {'prefetch': 2, 'lease_timeout': 0.1})
+        daemon.cancellation = CancellationSignal(FakeRedis())
+        daemon.process_task = lambda task: release.wait(5)
+        runner = threading.Thread(target=daemon.run, daemon=True)
+        runner.start()
+        # one item being processed, two prefetched
+        self._wait_for(lambda: len(queue.items) == 1)
+        with patch('mediaire_toolbox.queue.daemon.ASSUMED_SHARED_DATA',
+                   self.data_dir):
+            daemon.exit_gracefully(None, None)
+        release.set()
+        runner.join(timeout=5)
+
+        self.assertFalse(runner.is_alive())
+        self.assertEqual(['cancel-1'], os.listdir(self.data_dir))
+        self.assertEqual(all_items[:1], queue.completed_items)
+        self.assertEqual(all_items[1:], queue.items)
+
+    def test_daemon_prefetch_extends_leases(self):
+        queue = MockListQueue(3)
+        daemon = FooDaemon(queue, queue, 1, 'foo',
+                           {'prefetch': 1, 'lease_timeout': 0.1})
+        daemon._start_prefetching()
+        time.sleep(1.5)
+        daemon.stop()
+        daemon._stop_prefetching()
+
+        self.assertEqual(queue.items[0], queue.extended[0])
+        self.assertEqual(3, len(queue.items))
+
+    def test_daemon_batch(self):
+        queue = MockListQueue(5)
+        all_items = list(queue.items)
+        daemon = FooBatchDaemon(queue, queue, 60, 'foo',
+                                {'batch_size': 3, 'batch_max_wait': 0.1})
+        daemon.run_once()
+        daemon.run_once()
+
+        self.assertEqual([[1, 2, 3], [4, 5]], daemon.batches)
+        self.assertEqual([all_items[0]] + all_items[2:],
+                         queue.completed_items)
+        failed = Task().read_bytes(queue.put_item)
+        self.assertEqual(2, failed.t_id)
+        self.assertIn('I fail', failed.error)
+        self.assertEqual({}, daemon.processing_batches)
+
+    def test_daemon_batch_default_process_tasks(self):
+        queue = MockListQueue(2)
+        daemon = FooFailingDaemon(queue, queue, 60, 'foo',
+                                  {'batch_size': 2, 'batch_max_wait': 0.1})
+        daemon.run_once()
+
+        self.assertEqual([], queue.completed_items)
+        self.assertEqual(2, Task().read_bytes(queue.put_item).t_id)
+
+    def test_daemon_task_class_and_codec_per_queue(self):
+        class FooTask(Task):
+            pass
+
+        class FooRecordingDaemon(QueueDaemon):
+            def process_task(self, task):
+                self.task = task
+                raise Exception("I fail")
+
+        task_codecs.register_queue('', 'marshal', FooTask)
+        self.addCleanup(task_codecs._queues.pop, '')
+        self.input_queue.serialized_task = Task(t_id=1, tag='tag').to_bytes()
+        daemon = FooRecordingDaemon(self.input_queue, self.result_queue,
+                                    60, 'foo', {})
+        daemon.run_once()
+
+        self.assertIsInstance(daemon.task, FooTask)
+        self.assertEqual(b'\x01', self.result_queue.put_item[:1])
+        self.assertEqual(1, Task().read_bytes(self.result_queue.put_item).t_id)
+
+    def test_daemon_metrics(self):
+        self.foo_daemon.run_once()
+        failing_daemon = FooFailingDaemon(self.input_queue,
+                                          self.result_queue, 60, 'bar', {})
+        failing_daemon.run_once()
+
+        daemon = self.foo_daemon
+        self.assertEqual(1, daemon.tasks_counter.get(
+            daemon='foo', tag='tag', outcome='success'))
+        self.assertEqual(1, failing_daemon.tasks_counter.get(
+            daemon='bar', tag='tag', outcome='failure'))
+        self.assertEqual(1, daemon.lease_seconds.get_count(daemon='foo'))
+        self.assertEqual(1, daemon.deserialize_seconds.get_count(
+            daemon='foo'))
+        self.assertEqual(1, daemon.queue_wait_seconds.get_count(
+            daemon='foo', tag='tag'))
+        self.assertEqual(1, daemon.process_seconds.get_count(
+            daemon='foo', tag='tag'))
+        self.assertEqual(1, daemon.ack_seconds.get_count(
+            daemon='foo', op='complete'))
+        self.assertEqual(1, failing_daemon.ack_seconds.get_count(
+            daemon='bar', op='error'))
+        self.assertIn('queue_daemon_tasks_total{daemon="foo",tag="tag",'
+                      'outcome="success"} 1', daemon.metrics.render())
+
+    def test_daemon_profiling(self):
+        profile_dir = os.path.join(self.data_dir, 'profiles')
+        daemon = FooDaemon(self.input_queue, self.result_queue, 60, 'foo',
+                           {'profile_dir': profile_dir})
+        daemon.run_once()
+        self.assertFalse(os.path.exists(profile_dir))
+
+        daemon.toggle_profiling(None, None)
+        daemon.run_once()
+        self.assertEqual(['foo-tag.pstats'], os.listdir(profile_dir))
+
+    def test_daemon_process_pool_recycling(self):
+        daemon = FooRecyclingDaemon(self.input_queue, self.result_queue,
+                                    60, 'foo',
+                                    {'data_dir': self.data_dir,
+                                     'pool_mode': 'process',
+                                     'max_tasks_per_child': 1})
+        daemon.run()
+
+        self.assertEqual(1, daemon.setup_calls)
+        pids = os.listdir(self.data_dir)
+        self.assertEqual(3, len(pids))
+        for pid in pids:
+            with open(os.path.join(self.data_dir, pid)) as f:
+                self.assertEqual(str(os.getpid()), f.read())
+
+    def test_daemon_process_pool_without_gc_freeze(self):
+        # gc.freeze() is only available from Python 3.7
+        daemon = FooProcessPoolDaemon(self.input_queue, self.result_queue,
+                                      60, 'foo',
+                                      {'data_dir': self.data_dir,
+                                       'pool_mode': 'process'})
+        with patch('mediaire_toolbox.queue.daemon.gc',
+                   MagicMock(spec=['collect'])):
+            daemon.run()
+
+        self.assertEqual(['slot-0'], os.listdir(self.data_dir))
+
+    def test_should_recycle_rss(self):
+        daemon = FooDaemon(self.input_queue, self.result_queue, 60, 'foo',
+                           {'max_rss_mb': 1})
+        self.assertTrue(daemon._should_recycle())
+        daemon.max_rss_mb = 1024 * 1024
+        self.assertFalse(daemon._should_recycle())
+
+    def test_daemon_timeout_error(self):
+        daemon = FooHangingDaemon(self.input_queue, self.result_queue,
+                                  60, 'foo', {'task_timeouts': {'tag': 0.1}})
+        daemon.run_once()
+        # the watchdog handles the task concurrently
+        self._wait_for(lambda: hasattr(self.result_queue, 'put_item'))
+
+        self.assertTrue(daemon.noticed_timeout)
+        self.assertFalse(self.input_queue.completed)
+        self.assertIn('timed out',
+                      Task().read_bytes(self.result_queue.put_item).error)
+        self.assertEqual(1, daemon.tasks_counter.get(
+            daemon='foo', tag='tag', outcome='timeout'))
+
+    def test_daemon_timeout_requeue(self):
+        daemon = FooHangingDaemon(self.input_queue, self.result_queue,
+                                  60, 'foo', {'task_timeout': 0.1,
+                                              'timeout_policy': 'requeue'})
+        daemon.run_once()
+        self._wait_for(lambda: hasattr(self.input_queue, 'released'))
+
+        self.assertTrue(daemon.noticed_timeout)
+        self.assertFalse(self.input_queue.completed)
+        self.assertEqual(self.input_queue.serialized_task,
+                         self.input_queue.released)
+        self.assertFalse(hasattr(self.result_queue, 'put_item'))
+
+    def test_daemon_drops_tasks_emitted_after_timeout(self):
+        daemon = FooLateEmittingDaemon(self.input_queue, self.result_queue,
+                                       60, 'foo', {'task_timeout': 0.1})
+        daemon.run_once()
+        self._wait_for(lambda: self.result_queue.put_items)
+
+        self.assertEqual(1, len(self.result_queue.put_items))
+        task = Task().read_bytes(self.result_queue.put_item)
+        self.assertEqual('tag', task.tag)
+        self.assertIn('timed out', task.error)
+
+    def test_daemon_drops_tasks_emitted_after_timeout_requeue(self):
+        daemon = FooLateEmittingDaemon(self.input_queue, self.result_queue,
+                                       60, 'foo',
+                                       {'task_timeout': 0.1,
+                                        'timeout_policy': 'requeue'})
+        daemon.run_once()
+        self._wait_for(lambda: hasattr(self.input_queue, 'released'))
+
+        self.assertEqual(self.input_queue.serialized_task,
+                         self.input_queue.released)
+        self.assertEqual([], self.result_queue.put_items)
+
+    def test_daemon_no_timeout(self):
+        self.foo_daemon.run_once()
+        self.assertIsNone(self.foo_daemon.watchdog._thread)
+
+    def test_daemon_timeout_kills_worker_process(self):
+        daemon = FooHangingDaemon(self.input_queue, self.result_queue,
+                                  60, 'foo', {'data_dir': self.data_dir,
+                                              'pool_mode': 'process',
+                                              'task_timeout': 0.1})
+        start = time.time()
+        daemon.run()
+
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(2, len(os.listdir(self.data_dir)))
+
+    def test_daemon_timeout_kills_frozen_worker_process(self):
+        daemon = FooFreezingDaemon(self.input_queue, self.result_queue,
+                                   60, 'foo', {'data_dir': self.data_dir,
+                                               'pool_mode': 'process',
+                                               'task_timeout': 0.2})
+        start = time.time()
+        daemon.run()
+
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(2, len(os.listdir(self.data_dir)))
+        # the parent process errored the task
+        self.assertIn('timed out',
+                      Task().read_bytes(self.result_queue.put_item).error)
+        self.assertEqual(1, daemon.tasks_counter.get(
+            daemon='foo', tag='tag', outcome='timeout'))
+
+    def test_daemon_timeout_spares_worker_process_in_time(self):
+        daemon = FooProcessPoolDaemon(self.input_queue, self.result_queue,
+                                      60, 'foo',
+                                      {'data_dir': self.data_dir,
+                                       'pool_mode': 'process',
+                                       'task_timeout': 0.5})
+        daemon.run()
+
+        self.assertEqual(['slot-0'], os.listdir(self.data_dir))
+        self.assertEqual(0, daemon.tasks_counter.get(
+            daemon='foo', tag='tag', outcome='timeout'))
+        self.assertFalse(hasattr(self.result_queue, 'put_item'))
+
+    def test_daemon_invalid_timeout_policy(self):
+        self.assertRaises(ValueError, FooDaemon, self.input_queue,
+                          self.result_queue, 60, 'foo',
+                          {'timeout_policy': 'ignore'})
+
+    def test_daemon_is_cancelled(self):
+        daemon = FooCancellableDaemon(self.input_queue, self.result_queue,
+                                      60, 'foo', {})
+        daemon.cancellation = CancellationSignal(FakeRedis())
+        daemon.run_once()
+        self.assertTrue(daemon.processed)
+        self.assertFalse(daemon.cancelled)
+
+        daemon.request_cancel(1)
+        daemon.run_once()
+        self.assertTrue(daemon.cancelled)
+
+    def test_daemon_skips_cancelled_tasks_when_listening(self):
+        daemon = FooCancellableDaemon(self.input_queue, self.result_queue,
+                                      60, 'foo', {})
+        daemon.cancellation = CancellationSignal(FakeRedis())
+        daemon.cancellation.listen()
+        self.addCleanup(daemon.cancellation.stop)
+        daemon.request_cancel(1)
+        daemon.run_once()
+
+        self.assertFalse(hasattr(daemon, 'processed'))
+        self.assertTrue(self.input_queue.completed)
+        self.assertEqual(1, daemon.tasks_counter.get(
+            daemon='foo', tag='tag', outcome='cancelled'))
+
+    def test_daemon_buffers_results(self):
+        db = FakeRedis()
+        input_queue = RedisWQ('in', db=db)
+        result_queue = RedisWQ('out', db=db)
+        for t_id in (1, 2):
+            input_queue.put(Task(t_id=t_id, tag='tag').to_bytes())
+        daemon = FooDaemon(input_queue, result_queue, 60, 'foo',
+                           {'result_buffer_size': 100,
+                            'result_buffer_delay': 60})
+        daemon.run_once()
+        daemon.emit(Task(t_id=1, tag='next'))
+        daemon.run_once()
+
+        self.assertEqual(3, len(daemon.result_buffer))
+        self.assertEqual(2, db.llen('in:processing'))
+        self.assertEqual(0, db.llen('out'))
+        self.assertEqual(2, daemon.tasks_processed)
+
+        daemon.result_buffer.stop()
+        self.assertTrue(input_queue.empty())
+        self.assertEqual(1, db.llen('out'))
+
+    def test_daemon_resource_accounting(self):
+        daemon = FooDaemon(self.input_queue, self.result_queue, 60, 'foo',
+                           {'resource_accounting': True})
+        daemon.run_once()
+
+        self.assertTrue(self.input_queue.completed)
+        self.assertEqual(1, daemon.peak_rss_delta_bytes.get_count(
+            daemon='foo', tag='tag'))
+        self.assertGreaterEqual(daemon.cpu_seconds.get(
+            daemon='foo', tag='tag', mode='user'), 0)
+        self.assertIn('queue_daemon_io_bytes_total', daemon.metrics.render())
+
+    def test_daemon_resource_accounting_of_emitted_tasks(self):
+        daemon = FooEmittingDaemon(self.input_queue, self.result_queue, 60,
+                                   'foo', {'resource_accounting': True})
+        daemon.run_once()
+
+        self.assertTrue(self.input_queue.completed)
+        self.assertEqual(1, len(self.result_queue.put_items))
+        task = Task().read_bytes(self.result_queue.put_item)
+        self.assertEqual('next', task.tag)
+        self.assertEqual(1, len(task.data['resources']))
+        self.assertEqual('tag', task.data['resources'][0][0])
+
+    def test_daemon_resource_accounting_of_failed_task(self):
+        daemon = FooFailingDaemon(self.input_queue, self.result_queue, 60,
+                                  'foo', {'resource_accounting': True})
+        daemon.run_once()
+
+        task = Task().read_bytes(self.result_queue.put_item)
+        self.assertTrue(task.error)
+        self.assertEqual(1, len(task.data['resources']))
+        self.assertEqual('tag', task.data['resources'][0][0])
+
+    def test_daemon_shared_data_cache(self):
+        self.assertIsNone(self.foo_daemon.shared_data_cache)
+        cache_dir = os.path.join(self.data_dir, 'cache')
+        daemon = FooDaemon(self.input_queue, self.result_queue, 60, 'foo',
+                           {'shared_data_cache_dir': cache_dir,
+                            'shared_data_cache_mb': 1})
+        path = os.path.join(self.data_dir, 'input.nii')
+        with open(path, 'wb') as f:
+            f.write(b'nifti')
+        with daemon.shared_data_cache.open(path, version=1) as f:
+            self.assertEqual(b'nifti', f.read())
+        self.assertIn('shared_data_cache_requests_total{outcome="miss"} 1',
+                      daemon.metrics.render())
+
+    def test_daemon_tracing(self):
+        trace_file = os.path.join(self.data_dir, 'spans.jsonl')
+        daemon = FooEmittingDaemon(self.input_queue, self.result_queue, 60,
+                                   'foo', {'trace_file': trace_file})
+        daemon.run_once()
+        child = Task().read_bytes(self.result_queue.put_item)
+
+        next_queue = MockQueue()
+        next_queue.serialized_task = self.result_queue.put_item
+        next_daemon = FooFailingDaemon(next_queue, next_queue, 60, 'bar',
+                                       {'trace_file': trace_file})
+        next_daemon.run_once()
+
+        with open(trace_file) as f:
+            spans = [span for line in f
+                     for span in json.loads(line)['resourceSpans'][0]
+                     ['scopeSpans'][0]['spans']]
+        by_name = {}
+        for span in spans:
+            by_name.setdefault(span['name'], []).append(span)
+        self.assertEqual(2, len(by_name['queue_wait']))
+        self.assertEqual(2, len(by_name['process']))
+        # the child and the failed task are published
+        self.assertEqual(2, len(by_name['publish']))
+        self.assertEqual(1, len({span['traceId'] for span in spans}))
+
+        process, next_process = by_name['process']
+        self.assertNotIn('parentSpanId', process)
+        self.assertEqual(process['spanId'], child.trace['span_id'])
+        self.assertEqual(process['spanId'], next_process['parentSpanId'])
+        self.assertEqual(process['spanId'],
+                         by_name['queue_wait'][1]['parentSpanId'])
+        self.assertEqual(2, next_process['status']['code'])
+        self.assertEqual(
+            str(int(child.trace['emitted'] * 1e9)),
+            by_name['queue_wait'][1]['startTimeUnixNano'])
+
+    def test_exit_gracefully_signals_cancellation(self):
+        daemon = FooDaemon(self.input_queue, self.result_queue,
+                           60 * 30, 'foo', {'pool_size': 2})
+        daemon.cancellation = CancellationSignal(FakeRedis())
+        daemon.processing_t_ids = {0: 5}
+        with patch('mediaire_toolbox.queue.daemon.ASSUMED_SHARED_DATA',
+                   self.data_dir):
+            daemon.exit_gracefully(None, None)
+
+        self.assertTrue(daemon.is_cancelled(5))
@@ -0,0 +1,138 @@
+import json
+import unittest
+
+from fake_redis import FakeRedis
+from mediaire_toolbox.queue import task_codecs
+from mediaire_toolbox.queue.delta import DeltaCodec, diff, apply_patch
+from mediaire_toolbox.queue.tasks import Task
+
+
+class TestPatches(unittest.TestCase):
+
+    def setUp(self):
+        self.old = {'a': 1, 'b': [1, 2],
+                    'header': {'PatientName': 'Max', 'Rows': 256}}
+
+    def test_diff_and_apply(self):
+        new = {'a': 1, 'b': [1, 2, 3], 'c': None,
+               'header': {'PatientName': 'Max', 'Columns': 256}}
+        patch = diff(self.old, new)
+        self.assertEqual({'s': {'b': [1, 2, 3], 'c': None},
+                          'n': {'header': {'s': {'Columns': 256},
+                                           'd': ['Rows']}}}, patch)
+        self.assertEqual(new, apply_patch(self.old, patch))
+        self.assertEqual(256, self.old['header']['Rows'])
+
+    def test_equal(self):
+        self.assertEqual({}, diff(self.old, dict(self.old)))
+        self.assertEqual({'s': {'a': True}},
+                         diff(self.old, dict(self.old, a=True)))
+
+    def test_apply_shares_unchanged_values(self):
+        result = apply_patch(self.old, {'s': {'a': 2}})
+        self.assertIs(self.old['header'], result['header'])
+
+
+class TestDeltaCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeRedis()
+        self.codec = DeltaCodec(self.db, compact_every=3)
+        task_codecs.register_codec(self.codec)
+        self.task = Task(t_id=1, tag='stage_0',
+                         data={'dicom_info': {'t1': {'path': 'path',
+                                                     'header': 'x' * 1000}}})
+
+    def _bases(self):
+        return [k for k in self.db.data if k.startswith('task_bases:')]
+
+    def _hand_off(self, task, tag, value):
+        task = Task().read_bytes(task.to_bytes(codec='delta'))
+        child = task.create_child(tag)
+        child.data['out_' + tag] = value
+        return child
+
+    def test_children_carry_patches(self):
+        payload = self.task.to_bytes(codec='delta')
+        self.assertEqual(1, len(self._bases()))
+        self.assertLess(len(payload), 300)
+
+        task = Task().read_bytes(payload)
+        child = task.create_child('stage_1')
+        child.data['out'] = 'foo'
+        child_payload = child.to_bytes(codec='delta')
+        self.assertLess(len(child_payload), 300)
+        self.assertEqual(1, len(self._bases()))
+
+        child_from_bytes = Task().read_bytes(child_payload)
+        self.assertEqual('foo', child_from_bytes.data['out'])
+        self.assertEqual(
+            'path', child_from_bytes.data['dicom_info']['t1']['path'])
+        self.assertEqual(1, child_from_bytes.codec_state['hops'])
+
+    def test_decoded_data_is_a_plain_dict(self):
+        payload = self._hand_off(self.task, 'stage_1', 1).to_bytes(
+            codec='delta')
+        task = Task().read_bytes(payload)
+        self.assertIs(dict, type(task.data))
+        self.assertIn('"out_stage_1": 1', json.dumps(task.data))
+
+        # modifying it leaves the cached base alone
+        task.data['dicom_info']['t1']['path'] = 'other'
+        self.assertEqual('path', Task().read_bytes(
+            payload).data['dicom_info']['t1']['path'])
+
+    def test_compaction(self):
+        task = self.task
+        for i in range(1, 6):
+            task = self._hand_off(task, 'stage_{}'.format(i), i)
+        task = Task().read_bytes(task.to_bytes(codec='delta'))
+        # compacted after 3 hops
+        self.assertEqual(2, len(self._bases()))
+        self.assertEqual(2, task.codec_state['hops'])
+        self.assertEqual([1, 2, 3, 4, 5],
+                         [task.data['out_stage_{}'.format(i)]
+                          for i in range(1, 6)])
+
+    def test_other_codecs(self):
+        task = Task().read_bytes(self.task.to_bytes(codec='delta'))
+        child = task.create_child('stage_1')
+        child.data['out'] = 'foo'
+        self.assertEqual(
+            ['dicom_info', 'out'], sorted(json.loads(child.to_json())['data']))
+        child_from_json = Task().read_bytes(child.to_bytes())
+        self.assertEqual('foo', child_from_json.data['out'])
+        self.assertIsNone(child_from_json.codec_state)
+        # back to delta, against a new base
+        child_from_json.data['out'] = 'bar'
+        payload = child_from_json.to_bytes(codec='delta')
+        self.assertEqual(2, len(self._bases()))
+        self.assertEqual('bar', Task().read_bytes(payload).data['out'])
+
+    def test_expired_base(self):
+        child = self._hand_off(self.task, 'stage_1', 1)
+        payload = child.to_bytes(codec='delta')
+        for key in self._bases():
+            self.db.delete(key)
+        self.codec._cache.clear()
+        self.assertRaises(ValueError, Task().read_bytes, payload)
+
+    def test_expired_base_when_encoding(self):
+        task = Task().read_bytes(self.task.to_bytes(codec='delta'))
+        for key in self._bases():
+            self.db.delete(key)
+        self.codec._cache.clear()
+        payload = task.create_child('stage_1').to_bytes(codec='delta')
+        self.assertEqual(1, len(self._bases()))
+        self.assertEqual('path', Task().read_bytes(
+            payload).data['dicom_info']['t1']['path'])
+
+    def test_data_without_dictionary(self):
+        task = Task(tag='tag')
+        self.assertIsNone(
+            Task().read_bytes(task.to_bytes(codec='delta')).data)
+        self.assertEqual([], self._bases())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -55,6 +55,9 @@ class TestLogging(unittest.TestCase):
             [['stage_1', 0], ['stage_2', 0]],
             task.data['runtime']
         )
+        self.assertEqual(['stage_1', 'stage_2'],
+                         [r[0] for r in task.data['resources']])
+        self.assertTrue(all(len(r) == 6 for r in task.data['resources']))
 
     @patch('time.time')
     def test_log_runtime_raise_error(self, mock_time):
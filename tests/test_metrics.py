@@ -0,0 +1,64 @@
+import unittest
+import urllib.request
+
+from mediaire_toolbox.queue.metrics import MetricsRegistry, start_http_server
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter(self):
+        counter = self.registry.counter('tasks', 'Tasks', ('tag',))
+        counter.inc(tag='a')
+        counter.inc(2, tag='a')
+        counter.inc(tag='b"c')
+
+        self.assertEqual(3, counter.get(tag='a'))
+        self.assertEqual(
+            '# HELP tasks Tasks\n'
+            '# TYPE tasks counter\n'
+            'tasks_total{tag="a"} 3\n'
+            'tasks_total{tag="b\\"c"} 1\n',
+            self.registry.render())
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('duration', 'Duration', (),
+                                            buckets=(0.1, 1))
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        self.assertEqual(3, histogram.get_count())
+        self.assertEqual(5.6, histogram.get_sum())
+        self.assertEqual(
+            '# HELP duration Duration\n'
+            '# TYPE duration histogram\n'
+            'duration_bucket{le="0.1"} 1\n'
+            'duration_bucket{le="1"} 2\n'
+            'duration_bucket{le="+Inf"} 3\n'
+            'duration_sum 5.6\n'
+            'duration_count 3\n',
+            self.registry.render())
+
+    def test_invalid_labels(self):
+        counter = self.registry.counter('tasks', 'Tasks', ('tag',))
+        self.assertRaises(ValueError, counter.inc, foo='a')
+
+    def test_register_twice(self):
+        counter = self.registry.counter('tasks', 'Tasks')
+        self.assertIs(counter, self.registry.counter('tasks', 'Tasks'))
+        self.assertRaises(ValueError, self.registry.histogram,
+                          'tasks', 'Tasks')
+
+    def test_http_server(self):
+        self.registry.counter('tasks', 'Tasks').inc()
+        server = start_http_server(self.registry, 0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+        with urllib.request.urlopen(url, timeout=5) as response:
+            body = response.read().decode('utf-8')
+
+        self.assertIn('tasks_total 1', body)
@@ -0,0 +1,56 @@
+import os
+import shutil
+import pstats
+import tempfile
+import unittest
+
+from mediaire_toolbox.queue.profiling import TaskProfiler
+
+
+def busy_function():
+    return sum(i * i for i in range(10000))
+
+
+class TestTaskProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp(suffix='_test_profiling_')
+
+    def tearDown(self):
+        shutil.rmtree(self.profile_dir)
+
+    def _run(self, profiler, n, tag='tag'):
+        for _ in range(n):
+            with profiler.profile(tag):
+                busy_function()
+
+    def test_disabled(self):
+        profiler = TaskProfiler(self.profile_dir, 'foo')
+        self._run(profiler, 2)
+        self.assertEqual([], os.listdir(self.profile_dir))
+
+    def test_every_n_aggregates(self):
+        profiler = TaskProfiler(self.profile_dir, 'foo', every_n=2,
+                                enabled=True)
+        self._run(profiler, 4)
+
+        stats = pstats.Stats(profiler.profile_path('tag'))
+        calls = [v[0] for k, v in stats.stats.items()
+                 if k[2] == 'busy_function']
+        self.assertEqual([2], calls)
+
+    def test_min_seconds(self):
+        profiler = TaskProfiler(self.profile_dir, 'foo', every_n=0,
+                                min_seconds=3600, enabled=True)
+        self._run(profiler, 2)
+        self.assertEqual([], os.listdir(self.profile_dir))
+
+        profiler.min_seconds = 0
+        self._run(profiler, 1, tag='slow')
+        self.assertEqual(['foo-slow.pstats'], os.listdir(self.profile_dir))
+
+    def test_toggle(self):
+        profiler = TaskProfiler(self.profile_dir, 'foo')
+        profiler.toggle()
+        self._run(profiler, 1)
+        self.assertEqual(['foo-tag.pstats'], os.listdir(self.profile_dir))
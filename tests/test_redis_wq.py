@@ -1,13 +1,32 @@
 import unittest
 import sys
+import fnmatch
 from unittest.mock import patch
 from mediaire_toolbox.queue.redis_wq import RedisWQ
 
 
+class MockPipeline():
+    """Buffers the commands and runs them against the mock on execute()"""
+    def __init__(self, db):
+        self.db = db
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args):
+            self.commands.append((getattr(self.db, name), args))
+        return command
+
+    def execute(self):
+        results = [f(*args) for f, args in self.commands]
+        self.commands = []
+        return results
+
+
 class MockRedis():
     def __init__(self):
         self.hashmap = {}
         self.expiremap = {}
+        self.scan_counts = []
 
     def incr(self, key):
         if key in self.hashmap:
@@ -25,11 +44,36 @@ class MockRedis():
     def expire(self, key, time):
         self.expiremap[key] = time
 
-    def execute(self):
-        pass
+    def pipeline(self, transaction=True):
+        return MockPipeline(self)
+
+    def scan_iter(self, match=None, count=None):
+        self.scan_counts.append(count)
+        for key in list(self.hashmap):
+            if fnmatch.fnmatchcase(key, match):
+                yield key.encode('utf-8')
+
+    def execute_command(self, command, key):
+        key = key.decode('utf-8')
+        self.expiremap.pop(key, None)
+        return 1 if self.hashmap.pop(key, None) is not None else 0
+
+    def delete(self, key):
+        return 1 if self.hashmap.pop(key, None) is not None else 0
+
+    def lrange(self, key, start, end):
+        return list(self.hashmap.get(key, []))
+
+    def lrem(self, key, count, value):
+        self.hashmap[key].remove(value)
+        return 1
+
+    def rpush(self, key, value):
+        self.hashmap[key].append(value)
 
-    def pipeline(self):
-        return self
+    def ttl(self, key):
+        key = key.decode('utf-8')
+        return self.expiremap.get(key, -1)
 
     def rpoplpush(self, src, dst):
         value = self.hashmap[src].pop()
@@ -126,3 +170,75 @@ class TestRedisWQ(unittest.TestCase):
             # sleep function in lease should not be called
             self.assertTrue(mock_sleep.call_count == 0)
 
+    def _fill_queue(self):
+        q = self.r_wq
+        self.mock_redis.hashmap.update({
+            q._main_q_key: [b'pending'],
+            q._processing_q_key: [b'running'],
+            q._error_q_key: [b'failed'],
+            q._error_messages_q_key: [b'msg'],
+            q._lease_key_prefix + q._itemkey(b'running'): 'session',
+            q._lease_key_prefix + q._itemkey(b'failed'): 'session',
+            q._limit_key_prefix + '1': 3,
+            q._limit_key_prefix + '2': 3,
+            'other_queue:processing': [b'other']
+        })
+        self.mock_redis.expiremap[q._limit_key_prefix + '1'] = 60
+
+    def test_purge(self):
+        self._fill_queue()
+        removed = self.r_wq.purge(batch_size=2)
+        self.assertEqual({'processing': 1, 'errors': 1, 'error_messages': 1,
+                          'leased_by_session': 2, 'limit': 2}, removed)
+        self.assertEqual(
+            [self.r_wq._main_q_key, 'other_queue:processing'],
+            sorted(self.mock_redis.hashmap))
+        self.assertEqual([2], self.mock_redis.scan_counts)
+
+    def test_purge_include_main_queue(self):
+        self._fill_queue()
+        removed = self.r_wq.purge(include_main_queue=True)
+        self.assertEqual(1, removed['main'])
+        self.assertEqual(['other_queue:processing'],
+                         list(self.mock_redis.hashmap))
+
+    def test_gc(self):
+        self._fill_queue()
+        q = self.r_wq
+        removed = self.r_wq.gc(batch_size=1)
+        self.assertEqual({'leased_by_session': 1, 'limit': 1}, removed)
+        hashmap = self.mock_redis.hashmap
+        self.assertIn(q._lease_key_prefix + q._itemkey(b'running'), hashmap)
+        self.assertNotIn(q._lease_key_prefix + q._itemkey(b'failed'),
+                         hashmap)
+        self.assertIn(q._limit_key_prefix + '1', hashmap)
+        self.assertNotIn(q._limit_key_prefix + '2', hashmap)
+        self.assertIn(q._error_q_key, hashmap)
+
+    def test_gc_keeps_leases_taken_during_scan(self):
+        self._fill_queue()
+        q = self.r_wq
+        new_lease = q._lease_key_prefix + q._itemkey(b'new')
+        self.mock_redis.hashmap[new_lease] = 'session'
+        scan_iter = self.mock_redis.scan_iter
+
+        def scan_and_lease(match=None, count=None):
+            yield from scan_iter(match, count)
+            # b'new' is leased after its lease key was scanned
+            self.mock_redis.hashmap[q._processing_q_key].append(b'new')
+
+        self.mock_redis.scan_iter = scan_and_lease
+        removed = q.gc()
+        self.assertEqual({'leased_by_session': 1, 'limit': 1}, removed)
+        self.assertIn(new_lease, self.mock_redis.hashmap)
+
+    def test_release(self):
+        q = self.r_wq
+        self.mock_redis.hashmap[q._main_q_key] = [b'3', b'2']
+        self.mock_redis.hashmap[q._processing_q_key] = [b'1']
+        self.mock_redis.hashmap[
+            q._lease_key_prefix + q._itemkey(b'1')] = 'session'
+        q.release(b'1')
+        # the released item is the next one to be leased
+        self.assertEqual({q._main_q_key: [b'3', b'2', b'1'],
+                          q._processing_q_key: []}, self.mock_redis.hashmap)
@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+
+from mediaire_toolbox.queue.tasks import Task
+from mediaire_toolbox.resource_usage import (
+    ResourceMeter, TaskResources, record_resources, current_rss_bytes,
+    peak_rss_bytes)
+
+
+class TestResourceUsage(unittest.TestCase):
+
+    def test_rss(self):
+        self.assertGreater(current_rss_bytes(), 0)
+        self.assertGreaterEqual(peak_rss_bytes(), current_rss_bytes())
+
+    def test_meter_cpu_time(self):
+        with ResourceMeter() as meter:
+            sum(i * i for i in range(10 ** 6))
+        self.assertGreater(meter.resources.cpu_user, 0)
+        self.assertGreaterEqual(meter.resources.cpu_system, 0)
+
+    def test_meter_peak_rss(self):
+        with ResourceMeter() as meter:
+            data = bytearray(64 * 1024 * 1024)
+            del data
+        self.assertGreater(meter.resources.peak_rss_delta,
+                           32 * 1024 * 1024)
+
+    @unittest.skipUnless(os.path.exists('/proc/thread-self/io'),
+                         'needs /proc/thread-self/io')
+    def test_meter_io_bytes(self):
+        with tempfile.TemporaryFile() as f:
+            with ResourceMeter() as meter:
+                f.write(b'x' * 100000)
+                f.flush()
+                f.seek(0)
+                f.read()
+        self.assertGreaterEqual(meter.resources.write_bytes, 100000)
+        self.assertGreaterEqual(meter.resources.read_bytes, 100000)
+
+    def test_record_resources(self):
+        task = Task(tag='stage_1', data={})
+        record_resources(task, TaskResources(1.5, 0.25, 1024, 10, 20))
+        task.tag = 'stage_2'
+        record_resources(task, TaskResources(0, 0, 0, 0, 0))
+        self.assertEqual([['stage_1', 1.5, 0.25, 1024, 10, 20],
+                          ['stage_2', 0, 0, 0, 0, 0]],
+                         task.data['resources'])
+
+
+if __name__ == '__main__':
+    unittest.main()
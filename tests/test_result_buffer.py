@@ -0,0 +1,93 @@
+import time
+import unittest
+
+from fake_redis import FakeRedis
+from mediaire_toolbox.queue.redis_wq import RedisWQ
+from mediaire_toolbox.queue.result_buffer import ResultBuffer
+
+
+class FailingPipeline():
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def execute(self):
+        raise ConnectionError('Redis is gone')
+
+
+class TestResultBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeRedis()
+        self.input_queue = RedisWQ('in', db=self.db)
+        self.result_queue = RedisWQ('out', db=self.db)
+        for i in range(3):
+            self.input_queue.put(str(i).encode())
+
+    def _lease_all(self):
+        return [self.input_queue.lease(lease_secs=60, block=False)
+                for _ in range(3)]
+
+    def test_flushes_when_full(self):
+        buffer = ResultBuffer(max_size=4, max_delay=60)
+        self.addCleanup(buffer.stop)
+        items = self._lease_all()
+
+        buffer.put(self.result_queue, b'result')
+        buffer.complete(self.input_queue, items[0])
+        buffer.complete(self.input_queue, items[1])
+        self.assertEqual(3, len(buffer))
+        self.assertEqual(0, self.db.llen('out'))
+        self.assertEqual(3, self.db.llen('in:processing'))
+
+        buffer.complete(self.input_queue, items[2])
+        self.assertEqual(0, len(buffer))
+        self.assertEqual([b'result'], self.db.lrange('out', 0, -1))
+        self.assertTrue(self.input_queue.empty())
+
+    def test_flushes_after_delay(self):
+        buffer = ResultBuffer(max_size=100, max_delay=0.05)
+        self.addCleanup(buffer.stop)
+        item = self._lease_all()[0]
+
+        buffer.complete(self.input_queue, item)
+        start = time.time()
+        while len(buffer) and time.time() - start < 5:
+            time.sleep(0.01)
+        self.assertEqual(2, self.db.llen('in:processing'))
+
+    def test_flushes_on_stop(self):
+        buffer = ResultBuffer(max_size=100, max_delay=60)
+        buffer.put(self.result_queue, b'result')
+        buffer.stop()
+        self.assertEqual([b'result'], self.db.lrange('out', 0, -1))
+
+    def test_keeps_operations_when_flush_fails(self):
+        buffer = ResultBuffer(max_size=100, max_delay=60)
+        self.addCleanup(buffer.stop)
+        buffer.put(self.result_queue, b'result')
+        self.db.pipeline = lambda transaction=True: FailingPipeline()
+
+        self.assertRaises(ConnectionError, buffer.flush)
+        self.assertEqual(1, len(buffer))
+        del self.db.pipeline
+        buffer.flush()
+        self.assertEqual([b'result'], self.db.lrange('out', 0, -1))
+
+    def test_buffering_does_not_raise_when_flush_fails(self):
+        buffer = ResultBuffer(max_size=2, max_delay=60)
+        self.addCleanup(buffer.stop)
+        item = self._lease_all()[0]
+        self.db.pipeline = lambda transaction=True: FailingPipeline()
+
+        buffer.put(self.result_queue, b'result')
+        buffer.complete(self.input_queue, item)
+        self.assertEqual(2, len(buffer))
+        del self.db.pipeline
+        buffer.flush()
+        self.assertEqual([b'result'], self.db.lrange('out', 0, -1))
+        self.assertEqual(2, self.db.llen('in:processing'))
+
+
+if __name__ == '__main__':
+    unittest.main()
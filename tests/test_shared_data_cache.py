@@ -0,0 +1,96 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from mediaire_toolbox.queue.metrics import MetricsRegistry
+from mediaire_toolbox.shared_data_cache import SharedDataCache
+
+
+class TestSharedDataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.shared_dir = tempfile.mkdtemp(suffix='_test_shared_')
+        self.cache_dir = tempfile.mkdtemp(suffix='_test_cache_')
+        self.cache = SharedDataCache(self.cache_dir, 1000, min_age_secs=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.shared_dir)
+        shutil.rmtree(self.cache_dir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.shared_dir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_read_through(self):
+        path = self._write('a.dcm', b'a' * 100)
+        local_path = self.cache.get(path)
+        self.assertNotEqual(path, local_path)
+        with self.cache.open(path) as f:
+            self.assertEqual(b'a' * 100, f.read())
+        self.assertEqual({'hits': 1, 'misses': 1, 'evictions': 0,
+                          'fetched_bytes': 100, 'size_bytes': 100},
+                         self.cache.stats())
+
+    def test_content_addressed(self):
+        path_a = self._write('a.dcm', b'same')
+        path_b = self._write('b.dcm', b'same')
+        self.assertEqual(self.cache.get(path_a), self.cache.get(path_b))
+        self.assertEqual(4, self.cache.stats()['size_bytes'])
+
+    def test_version_invalidation(self):
+        path = self._write('a.dcm', b'v1')
+        with self.cache.open(path, version=1) as f:
+            self.assertEqual(b'v1', f.read())
+        self._write('a.dcm', b'v2')
+        with self.cache.open(path, version=1) as f:
+            self.assertEqual(b'v1', f.read())
+        with self.cache.open(path, version=2) as f:
+            self.assertEqual(b'v2', f.read())
+
+        self._write('a.dcm', b'v3')
+        self.cache.invalidate(path)
+        with self.cache.open(path, version=2) as f:
+            self.assertEqual(b'v3', f.read())
+
+    def test_rewritten_file_is_refetched(self):
+        path = self._write('a.dcm', b'v1')
+        self.cache.get(path)
+        self._write('a.dcm', b'v2-longer')
+        with self.cache.open(path) as f:
+            self.assertEqual(b'v2-longer', f.read())
+
+    def test_lru_eviction(self):
+        paths = [self._write('{}.dcm'.format(i), bytes([i]) * 400)
+                 for i in range(3)]
+        self.cache.get(paths[0], version=1)
+        self.cache.get(paths[1], version=1)
+        # make paths[0] the most recently used one
+        time.sleep(0.01)
+        self.cache.get(paths[0], version=1)
+        self.cache.get(paths[2], version=1)
+
+        stats = self.cache.stats()
+        self.assertEqual(1, stats['evictions'])
+        self.assertEqual(800, stats['size_bytes'])
+        self.cache.get(paths[0], version=1)
+        self.cache.get(paths[1], version=1)
+        self.assertEqual(4, self.cache.stats()['misses'])
+
+    def test_metrics(self):
+        registry = MetricsRegistry()
+        cache = SharedDataCache(self.cache_dir, 1000, registry=registry)
+        cache.get(self._write('a.dcm', b'a'))
+        self.assertIn('shared_data_cache_requests_total{outcome="miss"} 1',
+                      registry.render())
+
+    def test_read_only(self):
+        path = self._write('a.dcm', b'a')
+        self.assertRaises(ValueError, self.cache.open, path, 'wb')
+
+
+if __name__ == '__main__':
+    unittest.main()
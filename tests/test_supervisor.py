@@ -0,0 +1,197 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from unittest.mock import patch
+
+from fake_redis import FakeRedis
+from mediaire_toolbox.queue.daemon import QueueDaemon
+from mediaire_toolbox.queue.redis_wq import RedisWQ
+from mediaire_toolbox.queue.supervisor import ScalingPolicy, Supervisor
+from mediaire_toolbox.queue.tasks import Task
+
+
+class IdleDaemon():
+
+    def __init__(self, data_dir, slot):
+        self.path = os.path.join(data_dir, 'slot-{}'.format(slot))
+        self.stopped = False
+
+    def run(self):
+        open(self.path, 'a').close()
+        while not self.stopped:
+            time.sleep(0.01)
+        os.remove(self.path)
+
+    def stop(self):
+        self.stopped = True
+
+
+class StubbornDaemon(IdleDaemon):
+
+    def stop(self):
+        pass
+
+
+class SleepingDaemon(QueueDaemon):
+
+    def process_task(self, task):
+        time.sleep(60)
+
+
+class TestScalingPolicy(unittest.TestCase):
+
+    def test_target_follows_backlog_within_bounds(self):
+        policy = ScalingPolicy(min_workers=1, max_workers=4,
+                               backlog_per_worker=2)
+        self.assertEqual(1, policy.target(2, 0))
+        self.assertEqual(2, policy.target(1, 3))
+        self.assertEqual(4, policy.target(1, 100))
+
+    def test_target_scales_up_on_wait_time(self):
+        policy = ScalingPolicy(min_workers=1, max_workers=4,
+                               backlog_per_worker=10, max_wait_secs=30)
+        self.assertEqual(1, policy.target(2, 5, wait_secs=10))
+        self.assertEqual(3, policy.target(2, 5, wait_secs=60))
+
+    def test_hysteresis(self):
+        policy = ScalingPolicy(min_workers=1, max_workers=4,
+                               scale_up_checks=2, scale_down_checks=3)
+        self.assertEqual(1, policy.desired(1, 4))
+        self.assertEqual(4, policy.desired(1, 4))
+        # flapping backlog resets the streaks
+        self.assertEqual(4, policy.desired(4, 0))
+        self.assertEqual(4, policy.desired(4, 0))
+        self.assertEqual(4, policy.desired(4, 4))
+        self.assertEqual(4, policy.desired(4, 0))
+        self.assertEqual(4, policy.desired(4, 0))
+        # scales down one worker at a time
+        self.assertEqual(3, policy.desired(4, 0))
+        self.assertEqual(3, policy.desired(3, 0))
+
+    def test_bounds_are_enforced_immediately(self):
+        policy = ScalingPolicy(min_workers=2, max_workers=4)
+        self.assertEqual(2, policy.desired(0, 0))
+        self.assertEqual(4, policy.desired(6, 100))
+        self.assertRaises(ValueError, ScalingPolicy, 3, 2)
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(suffix='_test_supervisor_')
+        self.db = FakeRedis()
+        self.input_queue = RedisWQ('in', db=self.db)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def _running_slots(self):
+        return sorted(os.listdir(self.data_dir))
+
+    def _wait_for(self, condition):
+        start = time.time()
+        while not condition() and time.time() - start < 5:
+            time.sleep(0.01)
+
+    def test_observe(self):
+        supervisor = Supervisor(None, self.input_queue, ScalingPolicy(0, 1))
+        self.assertEqual((0, None), supervisor.observe())
+        self.input_queue.put(
+            Task(tag='tag', timestamp=int(time.time()) - 100).to_bytes())
+        self.input_queue.put(Task(tag='tag').to_bytes())
+        backlog, wait_secs = supervisor.observe()
+        self.assertEqual(2, backlog)
+        self.assertGreaterEqual(wait_secs, 99)
+
+    def test_observe_counts_live_leases_only(self):
+        supervisor = Supervisor(None, self.input_queue, ScalingPolicy(0, 1))
+        for _ in range(3):
+            self.input_queue.put(Task(tag='tag').to_bytes())
+        self.input_queue.lease(lease_secs=60, block=False)
+        # failed item left in the processing queue without a lease
+        self.db.lpush('in:processing', b'failed')
+
+        # without walking the keyspace
+        with patch.object(self.db, 'scan_iter', side_effect=AssertionError):
+            self.assertEqual(3, supervisor.observe()[0])
+
+    def test_scales_with_backlog(self):
+        policy = ScalingPolicy(min_workers=1, max_workers=3,
+                               scale_up_checks=1, scale_down_checks=1)
+        supervisor = Supervisor(
+            lambda slot: IdleDaemon(self.data_dir, slot),
+            self.input_queue, policy)
+        self.addCleanup(supervisor.shutdown, 5)
+
+        supervisor.step()
+        self._wait_for(lambda: len(self._running_slots()) == 1)
+        self.assertEqual(['slot-0'], self._running_slots())
+
+        for _ in range(5):
+            self.input_queue.put(Task(tag='tag').to_bytes())
+        supervisor.step()
+        self.assertEqual(3, supervisor.workers)
+        self._wait_for(lambda: len(self._running_slots()) == 3)
+        self.assertEqual(['slot-0', 'slot-1', 'slot-2'],
+                         self._running_slots())
+
+        self.db.delete('in')
+        supervisor.step()
+        self.assertEqual(2, supervisor.workers)
+        self._wait_for(lambda: len(self._running_slots()) == 2)
+        self.assertEqual(['slot-0', 'slot-1'], self._running_slots())
+        self._wait_for(lambda: supervisor.reap() or
+                       not supervisor._stopping)
+        self.assertEqual(2, len(supervisor._workers))
+
+    def test_replaces_crashed_workers(self):
+        policy = ScalingPolicy(min_workers=1, max_workers=1)
+        supervisor = Supervisor(
+            lambda slot: IdleDaemon(self.data_dir, slot),
+            self.input_queue, policy)
+        self.addCleanup(supervisor.shutdown, 5)
+        supervisor.step()
+        self._wait_for(lambda: len(self._running_slots()) == 1)
+
+        pid = list(supervisor._workers)[0]
+        os.kill(pid, 9)
+        self._wait_for(lambda: supervisor.reap() or
+                       pid not in supervisor._workers)
+        self.assertEqual([0], list(supervisor._workers.values()))
+        self.assertNotIn(pid, supervisor._workers)
+
+    def test_shutdown_stops_queue_daemons(self):
+        input_queue = self.input_queue
+        policy = ScalingPolicy(min_workers=2, max_workers=2)
+        supervisor = Supervisor(
+            lambda slot: SleepingDaemon(input_queue, None, 60, 'sleeping',
+                                        {'lease_timeout': 0.1}),
+            input_queue, policy)
+        # the worker processing this task is cancelled, the other one waits
+        # for a task
+        input_queue.put(Task(t_id=1, tag='tag').to_bytes())
+        supervisor.step()
+        self._wait_for(lambda: input_queue._main_qsize() == 0)
+
+        start = time.time()
+        supervisor.shutdown(timeout=10)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual({}, supervisor._workers)
+
+    def test_shutdown_kills_workers_after_timeout(self):
+        policy = ScalingPolicy(min_workers=1, max_workers=1)
+        supervisor = Supervisor(
+            lambda slot: StubbornDaemon(self.data_dir, slot),
+            self.input_queue, policy)
+        supervisor.step()
+        self._wait_for(lambda: len(self._running_slots()) == 1)
+
+        supervisor.shutdown(timeout=0.2)
+        self.assertEqual({}, supervisor._workers)
+
+
+if __name__ == '__main__':
+    unittest.main()
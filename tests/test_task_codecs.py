@@ -0,0 +1,136 @@
+import json
+import unittest
+
+from unittest.mock import patch
+
+from mediaire_toolbox.queue import task_codecs
+from mediaire_toolbox.queue.tasks import Task, LazyTask
+
+
+class TestTaskCodecs(unittest.TestCase):
+
+    def setUp(self):
+        self.task = Task(t_id=1, tag='spm_lesion', user_id=2,
+                         data={'dicom_info':
+                               {'t1': {'path': 'path',
+                                       'header': {'PatientName': 'Max',
+                                                  'Rows': 256}}},
+                               'runtime': [['a', 1.5]]})
+
+    def tearDown(self):
+        task_codecs._queues.pop('test_queue', None)
+
+    def test_marshal_round_trip(self):
+        payload = self.task.to_bytes(codec='marshal')
+        self.assertEqual(b'\x01', payload[:1])
+        task = Task().read_bytes(payload)
+        self.assertEqual(self.task.to_dict(), task.to_dict())
+
+    def test_marshal_smaller_than_json(self):
+        self.assertLess(len(self.task.to_bytes(codec='marshal')),
+                        len(self.task.to_bytes(codec='json')))
+
+    def test_strict_marshal_rejects_what_json_would_change(self):
+        codec = task_codecs.MarshalCodec(strict=True)
+        codec.encode(self.task.to_dict())
+        for data in ({1: 'int key'}, {'a': ('tuple',)}, {'a': [b'bytes']}):
+            d = Task(t_id=1, data=data).to_dict()
+            self.assertRaises(TypeError, codec.encode, d)
+            # not checked by default
+            task_codecs.encode(d, 'marshal')
+
+    def test_codecs_are_abstract(self):
+        self.assertRaises(TypeError, task_codecs.TaskCodec)
+
+    def test_legacy_json_still_decodes(self):
+        payload = self.task.to_json().encode('utf-8')
+        self.assertEqual(payload, self.task.to_bytes())
+        self.assertEqual(self.task.to_dict(),
+                         Task().read_bytes(payload).to_dict())
+
+    def test_unknown_header(self):
+        self.assertRaises(ValueError, task_codecs.decode, b'\x7fwhatever')
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, self.task.to_bytes, 'yaml')
+        self.assertRaises(ValueError, task_codecs.register_queue,
+                          'test_queue', 'yaml')
+
+    def test_register_codec_header_clash(self):
+        class OtherCodec(task_codecs.JsonCodec):
+            name = 'other'
+        self.assertRaises(ValueError, task_codecs.register_codec,
+                          OtherCodec())
+
+    def test_register_queue(self):
+        self.assertEqual(('json', None),
+                         task_codecs.get_queue_codec('test_queue'))
+        task_codecs.register_queue('test_queue', 'marshal', Task)
+        self.assertEqual(('marshal', Task),
+                         task_codecs.get_queue_codec('test_queue'))
+
+    def test_lazy_round_trip(self):
+        payload = self.task.to_bytes(codec='lazy')
+        self.assertEqual(b'\x02', payload[:1])
+        self.assertEqual(self.task.to_dict(),
+                         Task().read_bytes(payload).to_dict())
+
+    def test_lazy_envelope(self):
+        payload = self.task.to_bytes(codec='lazy')
+        d = task_codecs.decode_envelope(payload)
+        self.assertEqual('spm_lesion', d['tag'])
+        self.assertIsInstance(d['data'], task_codecs.RawData)
+        self.assertEqual(self.task.data, d['data'].decode())
+        # other codecs decode everything
+        d = task_codecs.decode_envelope(self.task.to_bytes())
+        self.assertEqual(self.task.data, d['data'])
+
+
+class TestLazyTask(unittest.TestCase):
+
+    def setUp(self):
+        self.task = Task(t_id=1, tag='spm_lesion', user_id=2,
+                         data={'dicom_info': {'t1': {'path': 'path'}}})
+        self.payload = self.task.to_bytes(codec='lazy')
+
+    def test_decodes_data_on_access(self):
+        task = LazyTask().read_bytes(self.payload)
+        self.assertEqual((1, 'spm_lesion', 2),
+                         (task.t_id, task.tag, task.user_id))
+        self.assertFalse(task.data_decoded)
+        self.assertEqual('path', task.data['dicom_info']['t1']['path'])
+        self.assertTrue(task.data_decoded)
+
+    def test_passes_through_unchanged_data(self):
+        task = LazyTask().read_bytes(self.payload)
+        child_task = task.create_child('child')
+        self.assertFalse(child_task.data_decoded)
+        with patch('json.dumps', wraps=json.dumps) as dumps:
+            payload = child_task.to_bytes(codec='lazy')
+        # only the envelope was encoded
+        self.assertEqual(1, dumps.call_count)
+        self.assertTrue(payload.endswith(
+            json.dumps(self.task.data).encode('utf-8')))
+        child_from_bytes = Task().read_bytes(payload)
+        self.assertEqual('child', child_from_bytes.tag)
+        self.assertEqual(self.task.data, child_from_bytes.data)
+
+    def test_reencodes_changed_data(self):
+        task = LazyTask().read_bytes(self.payload)
+        child_task = task.create_child('child')
+        child_task.data['out'] = 'foo'
+        for codec in ('lazy', 'json', 'marshal'):
+            task_from_bytes = Task().read_bytes(child_task.to_bytes(codec))
+            self.assertEqual('foo', task_from_bytes.data['out'])
+        self.assertNotIn('out', task.data)
+
+    def test_other_codecs_decode_raw_data(self):
+        task = LazyTask().read_bytes(self.payload)
+        self.assertEqual(self.task.to_dict(),
+                         Task().read_bytes(task.to_bytes('marshal')).to_dict())
+        self.assertEqual(self.task.to_dict(), task.to_dict())
+
+    def test_reads_other_codecs(self):
+        task = LazyTask().read_bytes(self.task.to_bytes())
+        self.assertTrue(task.data_decoded)
+        self.assertEqual(self.task.to_dict(), task.to_dict())
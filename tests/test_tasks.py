@@ -1,7 +1,8 @@
+import json
 import unittest
 from copy import deepcopy
 
-from mediaire_toolbox.queue.tasks import Task
+from mediaire_toolbox.queue.tasks import Task, CompactTask
 
 
 class TestTask(unittest.TestCase):
@@ -59,3 +60,81 @@ class TestTask(unittest.TestCase):
         # this should not change output of parent task
         self.assertEqual(task.data, parent_task_data)
 
+    def test_child_data_is_an_independent_dict(self):
+        task = Task().read_dict(self.task_d)
+        info = task.data['dicom_info']
+        child_task = task.create_child('child_task')
+        info['t1']['path'] = 'x'
+        self.assertIsInstance(task.data, dict)
+        self.assertIsInstance(child_task.data, dict)
+        self.assertEqual('path', Task().read_bytes(
+            child_task.to_bytes()).data['dicom_info']['t1']['path'])
+        json.dumps(task.data)
+
+    def test_child_does_not_influence_parent_nested(self):
+        task = Task().read_dict(self.task_d)
+        child_task = task.create_child('child_task', share_data=True)
+        child_task.data['dicom_info']['t1']['path'] = 'other'
+        task.data['dicom_info']['t2'] = {}
+        self.assertEqual('path', task.data['dicom_info']['t1']['path'])
+        self.assertNotIn('t2', child_task.data['dicom_info'])
+        # the payload the parent was read from is unchanged
+        self.assertEqual({'t1': {'path': 'path',
+                                 'header': {'PatientName': 'Max'}}},
+                         self.task_d['data']['dicom_info'])
+
+    def test_child_shares_data(self):
+        task = Task().read_dict(self.task_d)
+        base = task.data
+        child_task = task.create_child('child_task', share_data=True)
+        grandchild_task = child_task.create_child('grandchild_task',
+                                                  share_data=True)
+        self.assertIs(base, task.data._base)
+        self.assertIs(base, child_task.data._base._base)
+        self.assertIs(child_task.data._base, grandchild_task.data._base)
+
+    def test_child_serialization(self):
+        task = Task().read_dict(self.task_d)
+        child_task = task.create_child('child_task', share_data=True)
+        child_task.data['out'] = {'path': 'out'}
+        for codec in ('json', 'marshal'):
+            task_from_bytes = Task().read_bytes(
+                child_task.to_bytes(codec=codec))
+            self.assertEqual('out', task_from_bytes.data['out']['path'])
+            self.assertEqual(
+                'path', task_from_bytes.data['dicom_info']['t1']['path'])
+        self.assertNotIn('out', Task().read_bytes(task.to_bytes()).data)
+
+
+class TestCompactTask(unittest.TestCase):
+
+    def setUp(self):
+        self.task_d = {"t_id": 1,
+                       "tag": "spm_lesion",
+                       "timestamp": 1530368396,
+                       "data": {"dicom_info": {"t1": {"path": "path"}}}}
+
+    def test_has_no_instance_dict(self):
+        task = CompactTask(tag='tag')
+        self.assertFalse(hasattr(task, '__dict__'))
+        self.assertRaises(AttributeError, setattr, task, 'foo', 1)
+
+    def test_round_trip_compatible_with_task(self):
+        task = CompactTask.from_dict(self.task_d)
+        self.assertEqual(Task().read_dict(self.task_d).to_dict(),
+                         task.to_dict())
+        self.assertEqual(task.to_dict(),
+                         Task().read_bytes(task.to_bytes()).to_dict())
+        self.assertEqual(task.to_dict(), CompactTask().read_bytes(
+            Task().read_dict(self.task_d).to_bytes(codec='marshal'))
+            .to_dict())
+
+    def test_create_child(self):
+        task = CompactTask.from_dict(self.task_d)
+        child_task = task.create_child('child_task')
+        child_task.data['out'] = 'bar'
+        self.assertIsInstance(child_task, CompactTask)
+        self.assertEqual('child_task', child_task.tag)
+        self.assertEqual(1, child_task.t_id)
+        self.assertIsNotNone(child_task.update_timestamp)
+        self.assertNotIn('out', task.data)
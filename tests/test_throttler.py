@@ -1,7 +1,15 @@
 import time
+import shutil
+import socket
+import asyncio
 import unittest
+import subprocess
 from threading import Thread
-from mediaire_toolbox.throttler import Throttler
+from unittest.mock import MagicMock, patch
+from mediaire_toolbox.throttler import (
+    Throttler, SlidingWindowThrottler, TokenBucketThrottler, KeyedThrottler,
+    AsyncThrottler, RedisThrottler
+)
 
 
 class TestThrottler(unittest.TestCase):
@@ -40,3 +48,313 @@ class TestThrottler(unittest.TestCase):
         elapsed_seconds = int(end - start)
 
         self.assertTrue(7 <= elapsed_seconds <= 8)
+
+
+class TestSlidingWindowThrottler(unittest.TestCase):
+
+    def test_throttler(self):
+        throttler = SlidingWindowThrottler(max_events=2,
+                                           per_every_seconds=0.2)
+
+        start = time.monotonic()
+        for _ in range(0, 8):
+            throttler.throttle()
+        elapsed_seconds = time.monotonic() - start
+
+        # the last two events happen 3 windows after the first ones
+        self.assertTrue(0.6 <= elapsed_seconds < 0.75)
+        self.assertEqual(2, throttler.current_rate())
+
+    def test_reserve(self):
+        throttler = SlidingWindowThrottler(max_events=2,
+                                           per_every_seconds=10)
+
+        self.assertEqual(0, throttler.reserve())
+        self.assertEqual(0, throttler.reserve())
+        # exact wait until the first event leaves the window
+        self.assertAlmostEqual(10, throttler.reserve(), delta=0.1)
+        self.assertAlmostEqual(10, throttler.reserve(), delta=0.1)
+        self.assertAlmostEqual(20, throttler.reserve(), delta=0.1)
+        self.assertEqual(2, len(throttler.events))
+
+    def test_thread_safe(self):
+        throttler = SlidingWindowThrottler(max_events=2,
+                                           per_every_seconds=0.2)
+        timestamps = []
+
+        def test_throttler():
+            for _ in range(0, 2):
+                throttler.throttle()
+                timestamps.append(time.monotonic())
+
+        start = time.monotonic()
+        threads = [Thread(target=test_throttler) for _ in range(0, 8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed_seconds = time.monotonic() - start
+
+        self.assertTrue(1.4 <= elapsed_seconds < 1.6)
+        # never more than 2 events in any window
+        timestamps.sort()
+        for first, third in zip(timestamps, timestamps[2:]):
+            self.assertGreaterEqual(third - first, 0.2 - 0.01)
+
+    def test_invalid_max_events(self):
+        with self.assertRaises(ValueError):
+            SlidingWindowThrottler(max_events=0)
+
+
+class TestTokenBucketThrottler(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        throttler = TokenBucketThrottler(max_events=10, per_every_seconds=1,
+                                         burst=3)
+
+        start = time.monotonic()
+        for _ in range(3):
+            throttler.throttle()
+        self.assertLess(time.monotonic() - start, 0.05)
+        # then one every 0.1 seconds
+        for _ in range(4):
+            throttler.throttle()
+        elapsed_seconds = time.monotonic() - start
+
+        self.assertTrue(0.4 <= elapsed_seconds < 0.5)
+
+    def test_cost(self):
+        throttler = TokenBucketThrottler(max_events=10, per_every_seconds=10)
+
+        self.assertEqual(0, throttler.reserve(cost=8))
+        self.assertEqual(0, throttler.reserve(cost=2))
+        self.assertAlmostEqual(5, throttler.reserve(cost=5), delta=0.1)
+        self.assertAlmostEqual(-5, throttler.available(), delta=0.1)
+        with self.assertRaises(ValueError):
+            throttler.reserve(cost=11)
+
+    def test_thread_safe(self):
+        throttler = TokenBucketThrottler(max_events=10, per_every_seconds=1,
+                                         burst=1)
+
+        def test_throttler():
+            for _ in range(0, 2):
+                throttler.throttle(cost=0.5)
+
+        start = time.monotonic()
+        threads = [Thread(target=test_throttler) for _ in range(0, 8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed_seconds = time.monotonic() - start
+
+        # 8 tokens, of which 1 from the burst, at 10 per second
+        self.assertTrue(0.7 <= elapsed_seconds < 0.8)
+
+
+class TestKeyedThrottler(unittest.TestCase):
+
+    def test_keys_are_throttled_separately(self):
+        throttler = KeyedThrottler(max_events=1, per_every_seconds=10,
+                                   limits={'pacs': (2, 10)})
+
+        self.assertEqual(0, throttler.reserve('a'))
+        self.assertEqual(0, throttler.reserve('b'))
+        self.assertAlmostEqual(10, throttler.reserve('a'), delta=0.1)
+        self.assertEqual(0, throttler.reserve('pacs'))
+        self.assertEqual(0, throttler.reserve('pacs'))
+        self.assertAlmostEqual(10, throttler.reserve('pacs'), delta=0.1)
+        self.assertEqual(2, throttler.current_rate('pacs'))
+        self.assertEqual(0, throttler.current_rate('c'))
+
+    def test_set_limit(self):
+        throttler = KeyedThrottler(max_events=1, per_every_seconds=10)
+        throttler.reserve('a')
+
+        throttler.set_limit('a', 2, 10)
+
+        self.assertEqual(0, throttler.reserve('a'))
+        self.assertEqual(0, throttler.reserve('a'))
+        self.assertAlmostEqual(10, throttler.reserve('a'), delta=0.1)
+
+    def test_idle_keys_are_evicted(self):
+        throttler = KeyedThrottler(max_events=1, per_every_seconds=0.05)
+        for key in range(100):
+            throttler.throttle(key)
+        time.sleep(0.06)
+
+        throttler.throttle('last')
+
+        self.assertEqual(1, len(throttler))
+
+    def test_least_recently_used_keys_are_evicted(self):
+        throttler = KeyedThrottler(max_events=1, per_every_seconds=10,
+                                   max_keys=2)
+        throttler.reserve('a')
+        throttler.reserve('b')
+        throttler.reserve('a')
+        throttler.reserve('c')
+
+        self.assertEqual(2, len(throttler))
+        self.assertEqual(1, throttler.current_rate('a'))
+        self.assertEqual(0, throttler.current_rate('b'))
+
+
+class TestAsyncThrottler(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(self.loop.close)
+
+    def test_throttler(self):
+        throttler = AsyncThrottler(max_events=2, per_every_seconds=0.2)
+
+        async def run():
+            for _ in range(8):
+                await throttler.throttle()
+            return throttler.current_rate()
+
+        start = time.monotonic()
+        rate = self.loop.run_until_complete(run())
+        elapsed_seconds = time.monotonic() - start
+
+        self.assertTrue(0.6 <= elapsed_seconds < 0.75)
+        self.assertEqual(2, rate)
+
+    def test_waiters_are_released_in_order(self):
+        throttler = AsyncThrottler(max_events=2, per_every_seconds=0.1)
+        released = []
+
+        async def worker(i):
+            async with throttler:
+                released.append((i, time.monotonic()))
+
+        async def run():
+            await asyncio.gather(*[worker(i) for i in range(10)])
+
+        start = time.monotonic()
+        self.loop.run_until_complete(run())
+
+        self.assertEqual(list(range(10)), [i for i, _ in released])
+        self.assertTrue(0.4 <= released[-1][1] - start < 0.55)
+        # never more than 2 events in any window
+        for (_, first), (_, third) in zip(released, released[2:]):
+            self.assertGreaterEqual(third - first, 0.1 - 0.01)
+
+    def test_cancelled_waiters_are_skipped(self):
+        throttler = AsyncThrottler(max_events=1, per_every_seconds=0.1)
+
+        async def run():
+            await throttler.throttle()
+            cancelled = asyncio.ensure_future(throttler.throttle())
+            waiting = asyncio.ensure_future(throttler.throttle())
+            await asyncio.sleep(0)
+            cancelled.cancel()
+            start = time.monotonic()
+            await waiting
+            return time.monotonic() - start
+
+        elapsed_seconds = self.loop.run_until_complete(run())
+
+        # the cancelled waiter doesn't use up the next slot
+        self.assertTrue(0.08 <= elapsed_seconds < 0.15)
+
+
+class TestRedisThrottler(unittest.TestCase):
+
+    def test_reserve(self):
+        db = MagicMock()
+        db.register_script.return_value.return_value = 1500000
+        throttler = RedisThrottler(db, 'pacs', max_events=3,
+                                   per_every_seconds=1)
+
+        self.assertEqual(1.5, throttler.reserve())
+        db.register_script.assert_called_once_with(RedisThrottler.SCRIPT)
+        kwargs = db.register_script.return_value.call_args[1]
+        self.assertEqual(['throttler:pacs'], kwargs['keys'])
+        self.assertEqual([1000000, 3], kwargs['args'][:2])
+
+    def test_throttle_sleeps_the_wait_hint(self):
+        db = MagicMock()
+        db.register_script.return_value.side_effect = [0, 250000]
+        throttler = RedisThrottler(db, 'pacs', max_events=1,
+                                   per_every_seconds=0.25)
+
+        with patch('mediaire_toolbox.throttler.time.sleep') as sleep:
+            throttler.throttle()
+            sleep.assert_not_called()
+            throttler.throttle()
+            sleep.assert_called_once_with(0.25)
+
+
+@unittest.skipUnless(shutil.which('redis-server'),
+                     'needs the redis-server executable')
+class TestRedisThrottlerScript(unittest.TestCase):
+    """Runs the script against a throwaway Redis server."""
+
+    @classmethod
+    def setUpClass(cls):
+        import redis
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        cls.server = subprocess.Popen(
+            ['redis-server', '--port', str(port), '--bind', '127.0.0.1',
+             '--save', '', '--appendonly', 'no'],
+            stdout=subprocess.DEVNULL)
+        cls.db = redis.StrictRedis(port=port)
+        start = time.monotonic()
+        while True:
+            try:
+                cls.db.ping()
+                break
+            except redis.exceptions.ConnectionError:
+                if time.monotonic() - start > 5:
+                    cls.server.kill()
+                    raise
+                time.sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+
+    def setUp(self):
+        self.db.flushall()
+
+    def test_never_more_than_max_events_per_window(self):
+        throttler = RedisThrottler(self.db, 'pacs', max_events=3,
+                                   per_every_seconds=1)
+
+        start = time.monotonic()
+        slots = sorted(start + throttler.reserve() for _ in range(10))
+
+        self.assertEqual([0, 0, 0, 1, 1, 1, 2, 2, 2, 3],
+                         [round(slot - start) for slot in slots])
+        for first, fourth in zip(slots, slots[3:]):
+            self.assertGreaterEqual(fourth - first, 1 - 0.001)
+
+    def test_shared_limit(self):
+        throttlers = [RedisThrottler(self.db, 'pacs', max_events=2,
+                                     per_every_seconds=0.2)
+                      for _ in range(2)]
+
+        start = time.monotonic()
+        for i in range(8):
+            throttlers[i % 2].throttle()
+        elapsed_seconds = time.monotonic() - start
+
+        self.assertTrue(0.6 <= elapsed_seconds < 0.75)
+
+    def test_state_is_bounded_and_expires(self):
+        throttler = RedisThrottler(self.db, 'pacs', max_events=2,
+                                   per_every_seconds=0.2)
+        for _ in range(5):
+            throttler.reserve()
+
+        self.assertEqual(2, self.db.zcard(throttler.key))
+        time.sleep(1.1)
+        self.assertFalse(self.db.exists(throttler.key))
@@ -0,0 +1,62 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from mediaire_toolbox.queue import tracing
+
+
+class TestTracing(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(suffix='_test_tracing_')
+        self.path = os.path.join(self.tmp_dir, 'traces', 'spans.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_new_context(self):
+        context = tracing.new_context()
+        self.assertEqual(32, len(context['trace_id']))
+        self.assertIsNone(context['span_id'])
+
+    def test_span_to_otlp(self):
+        span = tracing.Span('process', 'a' * 32, 'b' * 16, start=1.5,
+                            attributes={'tag': 'spm', 't_id': 1,
+                                        'ratio': 0.5, 'ok': True})
+        span.finish(end=2.5, error=ValueError('boom'))
+        otlp = span.to_otlp()
+        self.assertEqual('1500000000', otlp['startTimeUnixNano'])
+        self.assertEqual('2500000000', otlp['endTimeUnixNano'])
+        self.assertEqual('b' * 16, otlp['parentSpanId'])
+        self.assertEqual(16, len(otlp['spanId']))
+        self.assertEqual({'code': 2, 'message': 'boom'}, otlp['status'])
+        self.assertEqual(
+            [{'key': 'tag', 'value': {'stringValue': 'spm'}},
+             {'key': 't_id', 'value': {'intValue': '1'}},
+             {'key': 'ratio', 'value': {'doubleValue': 0.5}},
+             {'key': 'ok', 'value': {'boolValue': True}}],
+            otlp['attributes'])
+
+    def test_exporter_appends_lines(self):
+        exporter = tracing.TraceExporter(self.path, 'foo')
+        self.addCleanup(exporter.close)
+        exporter.export([tracing.Span('a', 'a' * 32).finish()])
+        exporter.export([])
+        exporter.export([tracing.Span('b', 'a' * 32).finish(),
+                         tracing.Span('c', 'a' * 32).finish()])
+
+        with open(self.path) as f:
+            requests = [json.loads(line) for line in f]
+        self.assertEqual(2, len(requests))
+        resource_spans = requests[1]['resourceSpans'][0]
+        self.assertEqual(
+            [{'key': 'service.name', 'value': {'stringValue': 'foo'}}],
+            resource_spans['resource']['attributes'])
+        self.assertEqual(['b', 'c'], [
+            span['name'] for span in resource_spans['scopeSpans'][0]['spans']])
+
+
+if __name__ == '__main__':
+    unittest.main()
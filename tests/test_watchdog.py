@@ -0,0 +1,30 @@
+import time
+import unittest
+
+from mediaire_toolbox.queue.watchdog import Watchdog
+
+
+class TestWatchdog(unittest.TestCase):
+
+    def setUp(self):
+        self.timed_out = []
+        self.watchdog = Watchdog(self.timed_out.append)
+        self.watchdog.INTERVAL = 0.01
+
+    def tearDown(self):
+        self.watchdog.stop()
+
+    def test_timeout(self):
+        watched = self.watchdog.watch(0, [('item', 'task')], 0.05)
+        time.sleep(0.3)
+
+        self.assertEqual([watched], self.timed_out)
+        self.assertTrue(self.watchdog.timed_out(0))
+        self.assertFalse(self.watchdog.unwatch(watched))
+        self.assertFalse(self.watchdog.timed_out(0))
+
+    def test_finished_in_time(self):
+        watched = self.watchdog.watch(0, [('item', 'task')], 10)
+        self.assertTrue(self.watchdog.unwatch(watched))
+        self.assertFalse(self.watchdog.timed_out(0))
+        self.assertEqual([], self.timed_out)